@@ -9,20 +9,24 @@ Bibliographies (Biber and BibTeX).
 from rubber.util import _
 import logging
 msg = logging.getLogger (__name__)
+import rubber.contents
 import rubber.util
 import rubber.depend
+import hashlib
+import json
 import os
 import re
+import shutil
 import subprocess
 
 class BibToolDep (rubber.depend.Node):
 
-    def __init__ (self):
+    def __init__ (self, env):
         super ().__init__ ()
         self.tool = "bibtex"
         self.environ = os.environ.copy ()
-        self.bib_paths = rubber.util.explode_path ("BIBINPUTS")
-        self.bst_paths = rubber.util.explode_path ("BSTINPUTS")
+        self.bib_paths = rubber.util.tool_path (env, "BIBINPUTS")
+        self.bst_paths = rubber.util.tool_path (env, "BSTINPUTS")
 
     def do_path (self, args):
         if len (args) != 1:
@@ -30,6 +34,9 @@ class BibToolDep (rubber.depend.Node):
         path = args [0]
         self.bib_paths.insert (0, path)
 
+    def tools (self):
+        return (self.tool,)
+
     def run (self):
         # command might have been updated in the mean time, so get it now
         self.environ["BIBINPUTS"] = ":".join (self.bib_paths)
@@ -101,6 +108,132 @@ class BibToolDep (rubber.depend.Node):
 re_error = re.compile(
     "---(line (?P<line>[0-9]+) of|while reading) file (?P<file>.*)")
 
+# The lines of .aux files read by BibTeX.
+bibtex_aux_prefixes = (b'\\citation{', b'\\bibdata{', b'\\bibstyle{')
+re_aux_input = re.compile (rb'\\@input{([^}]*)}')
+re_citation = re.compile (rb'\\citation{([^}]*)}')
+
+def aux_lines (path, seen):
+    """
+    Yield the lines of an .aux file that are read by BibTeX, following
+    the files included with \\@input.
+    """
+    seen.add (path)
+    try:
+        with open (path, 'rb') as aux:
+            for line in aux:
+                if line.startswith (bibtex_aux_prefixes):
+                    yield line
+                else:
+                    match = re_aux_input.match (line)
+                    if match:
+                        sub = match.group (1).decode ('utf_8', 'replace')
+                        if sub not in seen:
+                            yield from aux_lines (sub, seen)
+    except OSError:
+        # A missing included file is ignored, as by BibTeX.
+        pass
+
+# Subsets of large databases
+
+# The start of an entry, with its type, delimiter and key.
+re_entry = re.compile (rb'@[ \t\n]*([a-zA-Z]+)[ \t\n]*([{(])[ \t\n]*([^,\s]*)')
+re_crossref = re.compile (rb'crossref[ \t\n]*=[ \t\n]*[{"]?[ \t\n]*([^}",\s]+)',
+                          re.IGNORECASE)
+
+def index_database (data):
+    """
+    Index the contents of a .bib file.  Return a pair (entries, always)
+    where entries maps the lower-case key of each entry to its byte
+    range and the keys of its crossref fields, and always lists the
+    byte ranges of @string and @preamble entries, which may be needed
+    by any entry.
+    """
+    entries = {}
+    always = []
+    pos = 0
+    while True:
+        start = data.find (b'@', pos)
+        if start < 0:
+            break
+        match = re_entry.match (data, start)
+        if match is None:
+            pos = start + 1
+            continue
+        kind = match.group (1).lower ()
+        if kind == b'comment':
+            pos = match.end (1)
+            continue
+        closing = b'}' if match.group (2) == b'{' else b')'
+        depth = 0
+        end = match.end (2)
+        while end < len (data):
+            c = data [end:end + 1]
+            end += 1
+            if c == b'{':
+                depth += 1
+            elif c == b'}' and depth:
+                depth -= 1
+            elif c == closing and not depth:
+                break
+        if kind in (b'string', b'preamble'):
+            always.append ((start, end))
+        else:
+            key = match.group (3).decode ('utf_8', 'replace').lower ()
+            crossrefs = [m.group (1).decode ('utf_8', 'replace').lower ()
+                         for m in re_crossref.finditer (data, match.end (), end)]
+            entries [key] = (start, end, crossrefs)
+        pos = end
+    return entries, always
+
+class Database:
+    """
+    An index of a .bib file, saved in a JSON file and rebuilt when the
+    size or the modification time of the .bib file change.
+    """
+    def __init__ (self, path, index_path):
+        self.path = path
+        st = os.stat (path)
+        stamp = [st.st_size, st.st_mtime_ns]
+        try:
+            with open (index_path, encoding='utf_8') as f:
+                saved = json.load (f)
+            if saved ['stamp'] == stamp:
+                self.entries = saved ['entries']
+                self.always = saved ['always']
+                return
+        except (OSError, ValueError, KeyError):
+            pass
+        msg.info (_("indexing %s"), path)
+        with open (path, 'rb') as f:
+            self.entries, self.always = index_database (f.read ())
+        with open (index_path, 'w', encoding='utf_8') as f:
+            json.dump ({'stamp': stamp, 'entries': self.entries,
+                        'always': self.always}, f)
+
+    def subset (self, keys):
+        """
+        Return the contents of the .bib file restricted to the given
+        keys and the entries they refer to with crossref.
+        """
+        ranges = set (tuple (r) for r in self.always)
+        todo = [key.lower () for key in keys]
+        done = set ()
+        while todo:
+            key = todo.pop ()
+            if key in done or key not in self.entries:
+                continue
+            done.add (key)
+            start, end, crossrefs = self.entries [key]
+            ranges.add ((start, end))
+            todo.extend (crossrefs)
+        parts = []
+        with open (self.path, 'rb') as f:
+            for start, end in sorted (ranges):
+                f.seek (start)
+                parts.append (f.read (end - start))
+        return b'\n\n'.join (parts) + b'\n'
+
 class BibTeXDep (BibToolDep):
     """
     This class represents a single bibliography for a document.
@@ -110,7 +243,7 @@ class BibTeXDep (BibToolDep):
         Initialise the bibiliography for the given document. The base name is
         that of the aux file from which citations are taken.
         """
-        super ().__init__ ()
+        super ().__init__ (document.env)
 
         self.log = document.basename(with_suffix=".log")
         self.aux = aux_basename + ".aux"
@@ -125,6 +258,82 @@ class BibTeXDep (BibToolDep):
         self.set_style ("plain")
         self.db = {}
         self.crossrefs = None
+        # The minimal size in bytes of the databases replaced by the
+        # subset of the cited entries, or None.
+        self.subset_limit = None
+        self.subset_dir = aux_basename + "-subset"
+
+    def snapshot_source (self, path):
+        """
+        BibTeX only reads the \\citation, \\bibdata and \\bibstyle lines of
+        the .aux file and of the files it includes with \\@input, while
+        LaTeX updates the other lines on almost every compilation.
+        """
+        if path != self.aux:
+            return super ().snapshot_source (path)
+        if not os.path.exists (path):
+            return rubber.contents.NO_SUCH_FILE
+        digest = hashlib.md5 ()
+        for line in aux_lines (path, set ()):
+            digest.update (line)
+        return digest.digest ()
+
+    def run (self):
+        if not self.write_subsets ():
+            return super ().run ()
+        # BibTeX finds the subsets first.  An empty component is kept
+        # for the default path.
+        paths = self.bib_paths
+        self.bib_paths = [self.subset_dir] + (paths or [""])
+        try:
+            return super ().run ()
+        finally:
+            self.bib_paths = paths
+
+    def write_subsets (self):
+        """
+        Write the subsets of the large databases in the subset directory,
+        and return true if there is at least one.
+        """
+        if self.subset_limit is None:
+            return False
+        keys = set ()
+        for line in aux_lines (self.aux, set ()):
+            match = re_citation.match (line)
+            if match:
+                keys.update (key.strip ().decode ('utf_8', 'replace')
+                             for key in match.group (1).split (b','))
+        if '*' in keys:
+            # \nocite{*} needs all entries.
+            return False
+        result = False
+        for name, filename in self.db.items ():
+            # BibTeX does not search the path for names with a directory.
+            if os.path.dirname (name) \
+               or os.path.getsize (filename) < self.subset_limit:
+                continue
+            os.makedirs (self.subset_dir, exist_ok=True)
+            target = os.path.join (self.subset_dir, os.path.basename (filename))
+            if not target.endswith ('.bib'):
+                target += '.bib'
+            database = Database (filename, target [:-4] + '.index')
+            data = database.subset (keys)
+            msg.debug (_("%s: %i entries cited"), filename, len (keys))
+            try:
+                with open (target, 'rb') as f:
+                    unchanged = f.read () == data
+            except OSError:
+                unchanged = False
+            if not unchanged:
+                with open (target, 'wb') as f:
+                    f.write (data)
+            result = True
+        return result
+
+    def clean (self):
+        if os.path.isdir (self.subset_dir):
+            msg.info (_("removing %s"), self.subset_dir)
+            shutil.rmtree (self.subset_dir)
 
     def build_command (self):
         ret = [ self.tool ]
@@ -151,6 +360,17 @@ class BibTeXDep (BibToolDep):
         path = args [0]
         self.bst_paths.insert (0, path)
 
+    def do_subset (self, args):
+        if len (args) > 1:
+            raise rubber.SyntaxError (_("invalid syntax for directive '{}'")
+                                      .format ('subset'))
+        try:
+            megabytes = float (args [0]) if args else 10
+        except ValueError:
+            raise rubber.SyntaxError (_("invalid syntax for directive '{}'")
+                                      .format ('subset'))
+        self.subset_limit = megabytes * 1024 * 1024
+
     def do_sorted (self, args):
         msg.debug (_("directive '%s' is no longer supported") % "sorted")
 
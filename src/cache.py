@@ -0,0 +1,309 @@
+# This file is part of Rubber and thus covered by the GPL
+# vim: noet:ts=4
+"""
+Persistent stores for files produced by previous builds.
+
+A store is a directory, by default under $XDG_CACHE_HOME/rubber,
+containing one entry per key.  Callers compute the keys from
+everything that determines the contents of the saved files (checksums
+of the sources, command line, identity of the tools...), so an entry
+never needs to be invalidated: a stale entry is simply never looked
+up again, and disappears once the size limit forces its eviction.
+
+Entries are inserted atomically.  The files are first copied into a
+private temporary directory inside the store, which is then renamed
+into place.  When concurrent writers race for the same key, the
+rename fails for all but one of them and the other copies are
+discarded, as their content is the same.
+"""
+
+import hashlib
+import logging
+msg = logging.getLogger (__name__)
+import os
+import shutil
+import tempfile
+import threading
+import time
+import rubber.dircache
+import rubber.util
+from rubber.util import _, prog_available
+
+# The list of manifest lines is written last in each entry.
+_manifest = 'manifest'
+
+# Temporary directories older than this (in seconds) have been left
+# by an interrupted writer and may be removed.
+_stale_delay = 24 * 3600
+
+class Store:
+    """
+    A bounded directory of entries, each one saving a list of files
+    under a key.  When the total size exceeds the limit, the least
+    recently used entries are removed.
+    """
+    def __init__ (self, root, limit):
+        self.root = root
+        self.limit = limit
+        self.hits = 0
+        self.misses = 0
+        # The counters are updated by concurrent threads.
+        self.lock = threading.Lock ()
+
+    def entry (self, key):
+        return os.path.join (self.root, key [:2], key)
+
+    def restore (self, key, overwrite=True):
+        """
+        Copy the files saved under `key' back to their original paths.
+        Return the list of restored paths, or None if there is no such
+        entry.  Each file is replaced atomically, but the set of files
+        is not: after a failure, a caller must rebuild them all.
+        If overwrite is false, existing files are left untouched.
+        """
+        entry = self.entry (key)
+        try:
+            with open (os.path.join (entry, _manifest), encoding='utf_8') as f:
+                paths = f.read ().splitlines ()
+            if not overwrite:
+                files = [(i, path) for i, path in enumerate (paths)
+                         if not os.path.exists (path)]
+            else:
+                files = list (enumerate (paths))
+            for i, path in files:
+                copy_atomically (os.path.join (entry, str (i)), path)
+            paths = [path for i, path in files]
+            # Record the use for the eviction.
+            os.utime (entry)
+        except OSError:
+            with self.lock:
+                self.misses += 1
+            return None
+        with self.lock:
+            self.hits += 1
+        msg.debug (_("%s: restored %s"), self.root, " ".join (paths))
+        return paths
+
+    def insert (self, key, paths):
+        """
+        Save the files in `paths' under `key'.  Nothing happens if the
+        entry already exists.  Failures are only reported as debug
+        messages, the cache is an optimization.
+        """
+        entry = self.entry (key)
+        if os.path.isdir (entry):
+            return
+        try:
+            os.makedirs (os.path.dirname (entry), exist_ok=True)
+            tmp = tempfile.mkdtemp (dir=self.root, prefix='tmp-')
+        except OSError as e:
+            msg.debug (_("%s: cannot create entry: %s"), self.root, e)
+            return
+        try:
+            for i, path in enumerate (paths):
+                shutil.copyfile (path, os.path.join (tmp, str (i)))
+            with open (os.path.join (tmp, _manifest), 'w', encoding='utf_8') as f:
+                for path in paths:
+                    f.write (path)
+                    f.write ('\n')
+            os.rename (tmp, entry)
+        except OSError as e:
+            # Most probably, a concurrent writer has been faster.
+            msg.debug (_("%s: entry not inserted: %s"), self.root, e)
+            shutil.rmtree (tmp, ignore_errors=True)
+            return
+        msg.debug (_("%s: saved %s"), self.root, " ".join (paths))
+
+    def replace (self, key, paths):
+        """
+        Like insert, but an existing entry is replaced.  Concurrent
+        readers see either the old entry, or the new one, or none.
+        """
+        self.discard (key)
+        self.insert (key, paths)
+
+    def discard (self, key):
+        entry = self.entry (key)
+        try:
+            tmp = tempfile.mkdtemp (dir=self.root, prefix='tmp-')
+            os.rename (entry, os.path.join (tmp, 'old'))
+        except OSError:
+            pass
+        else:
+            shutil.rmtree (tmp, ignore_errors=True)
+
+    def trim (self):
+        """
+        Remove the least recently used entries until the total size
+        fits the limit.
+        """
+        entries = []
+        total = 0
+        now = time.time ()
+        try:
+            buckets = os.listdir (self.root)
+        except OSError:
+            return
+        for bucket in buckets:
+            path = os.path.join (self.root, bucket)
+            if bucket.startswith ('tmp-'):
+                try:
+                    if os.path.getmtime (path) + _stale_delay < now:
+                        shutil.rmtree (path, ignore_errors=True)
+                except OSError:
+                    pass
+                continue
+            try:
+                names = os.listdir (path)
+            except OSError:
+                continue
+            for name in names:
+                entry = os.path.join (path, name)
+                try:
+                    size = sum (f.stat ().st_size for f in os.scandir (entry))
+                    entries.append ((os.path.getmtime (entry), size, name))
+                except OSError:
+                    continue
+                total += size
+        entries.sort ()
+        for mtime, size, key in entries:
+            if total <= self.limit:
+                break
+            msg.debug (_("%s: evicting %s"), self.root, key)
+            self.discard (key)
+            total -= size
+
+    def report (self):
+        if self.hits or self.misses:
+            msg.info (_("%s: %i hits, %i misses"),
+                      self.root, self.hits, self.misses)
+
+def copy_atomically (source, destination):
+    """
+    Copy source to destination, so that a concurrent reader of
+    destination never sees a partial copy.
+    """
+    fd, tmp = tempfile.mkstemp (dir=os.path.dirname (destination) or '.',
+                                prefix='.rubber-')
+    try:
+        rubber.util.set_replacement_mode (fd, destination)
+    finally:
+        os.close (fd)
+    try:
+        shutil.copyfile (source, tmp)
+        os.replace (tmp, destination)
+    except:
+        os.remove (tmp)
+        raise
+    finally:
+        rubber.dircache.invalidate ()
+
+def key (*parts):
+    """
+    Compute a key from a list of values with a stable representation
+    (strings, bytes, numbers and tuples or lists of them).
+    """
+    result = hashlib.md5 ()
+    for part in parts:
+        result.update (repr (part).encode ('utf_8'))
+        result.update (b'\0')
+    return result.hexdigest ()
+
+_tools = {}
+_tools_lock = threading.Lock ()
+
+def tool_identity (prog):
+    """
+    Describe the executable that would run for prog.
+
+    Asking each tool for its version would start one more process per
+    tool, with a command line that differs among tools.  The path, size
+    and modification time of the executable change on each upgrade,
+    and are obtained with a single stat.
+    """
+    with _tools_lock:
+        try:
+            return _tools [prog]
+        except KeyError:
+            pass
+        path = prog_available (prog)
+        if path is None:
+            result = None
+        else:
+            st = os.stat (path)
+            result = (path, st.st_size, st.st_mtime_ns)
+        _tools [prog] = result
+        return result
+
+def git_branch (directory):
+    """
+    Return the branch checked out in the Git working tree containing
+    directory, the commit if the head is detached, or None outside of
+    any working tree.  The files are read directly, as starting git
+    would cost more than the rest of the key computation.
+    """
+    directory = os.path.abspath (directory)
+    while True:
+        dot_git = os.path.join (directory, '.git')
+        try:
+            if os.path.isfile (dot_git):
+                # A linked working tree, or a submodule.
+                with open (dot_git, encoding='utf_8') as f:
+                    line = f.readline ().strip ()
+                if not line.startswith ('gitdir:'):
+                    return None
+                dot_git = os.path.join (directory, line [7:].strip ())
+            if os.path.isdir (dot_git):
+                with open (os.path.join (dot_git, 'HEAD'), encoding='utf_8') as f:
+                    head = f.readline ().strip ()
+                if head.startswith ('ref:'):
+                    head = head [4:].strip ()
+                    if head.startswith ('refs/heads/'):
+                        head = head [11:]
+                return head
+        except OSError:
+            return None
+        parent = os.path.dirname (directory)
+        if parent == directory:
+            return None
+        directory = parent
+
+def default_directory ():
+    base = os.getenv ('XDG_CACHE_HOME')
+    if not base:
+        base = os.path.join (os.path.expanduser ('~'), '.cache')
+    return os.path.join (base, 'rubber')
+
+# The store for the products of conversion rules, or None when the
+# persistent cache is disabled.
+artifacts = None
+
+# The store for the products of whole documents, or None.
+builds = None
+
+# The store for the last known-good auxiliary files of each document
+# on each branch, or None.
+seeds = None
+
+# The store for the files written by each LaTeX compilation, or None.
+passes = None
+
+_stores = []
+
+def enable (directory, limit):
+    """
+    Enable the persistent cache in directory.  The limit is the
+    maximal size in bytes of each store.
+    """
+    global artifacts, builds, seeds, passes
+    artifacts = Store (os.path.join (directory, 'artifacts'), limit)
+    builds = Store (os.path.join (directory, 'builds'), limit)
+    seeds = Store (os.path.join (directory, 'seeds'), limit)
+    passes = Store (os.path.join (directory, 'passes'), limit)
+    _stores.extend ((artifacts, builds, seeds, passes))
+
+def close ():
+    """Trim all stores and report their statistics."""
+    for store in _stores:
+        store.trim ()
+        store.report ()
@@ -7,11 +7,13 @@ This is the command line interface for Rubber.
 """
 
 import argparse
+import errno
 import os.path
 import sys
 import shutil
 import tempfile
-# bzip2 and/or gzip may be imported depending on command line options.
+import rubber.cache
+import rubber.contents
 import rubber.converters.compressor
 import rubber.converters.latex
 import rubber.converters.literate
@@ -22,6 +24,7 @@ import logging
 msg = logging.getLogger (__name__)
 import rubber.util
 import rubber.version
+import rubber.worker
 
 # The expected entry point is the main procedure, with one of these
 # three values to track the command name (which may differ from
@@ -36,6 +39,10 @@ def parse_opts (command_name):
         def __call__(self, parser, namespace, values, option_string=None):
             raise rubber.SyntaxError ('obsolete option: ' + option_string)
 
+    class UnsupportedAction (argparse.Action):
+        def __call__(self, parser, namespace, values, option_string=None):
+            raise rubber.SyntaxError ('unsupported option: ' + option_string)
+
     if command_name == RUBBER_PLAIN:
         parser = argparse.ArgumentParser (
             description = 'Run TeX until a document is built.')
@@ -95,12 +102,31 @@ def parse_opts (command_name):
     # Non-mode options, sorted by short name, else by long name.
 
     compress.add_argument ('-b', '--bzip2', action='store_const',
-        const='bzip2', dest='compress',
+        const=('bzip2', None), dest='compress',
         help='compress the final document with bzip2')
 
     parser.add_argument ('-c', '--command', action='append', dest='prologue',
         metavar='CMD', help='run the directive CMD before parsing')
 
+    def compression (value):
+        try:
+            return rubber.converters.compressor.parse (value)
+        except ValueError as e:
+            raise argparse.ArgumentTypeError (str (e))
+    compress.add_argument ('--compress', type=compression,
+        metavar='CODEC[:LEVEL]',
+        help='compress the final document with CODEC (one of '
+        + ', '.join (rubber.converters.compressor.codecs) + ') at LEVEL')
+
+    if command_name != RUBBER_INFO:
+        parser.add_argument ('--cache', action='store_true',
+            help='reuse files produced by previous builds, possibly in other directories')
+        parser.add_argument ('--cache-dir', metavar='DIR',
+            default=rubber.cache.default_directory (),
+            help='location of the cache (default %(default)s)')
+        parser.add_argument ('--cache-size', type=int, default=1024,
+            metavar='MB', help='maximal size of each cache store (default %(default)i)')
+
     class PDFAction (argparse.Action):
         def __call__(self, parser, namespace, values, option_string=None):
             if 'module dvips' in namespace.epilogue:
@@ -110,6 +136,15 @@ def parse_opts (command_name):
     parser.add_argument ('-d', '--pdf', action=PDFAction, nargs=0,
         help="shortcut for -c 'module pdftex' or -e 'module ps2pdf'")
 
+    if command_name == RUBBER_PLAIN:
+        parser.add_argument ('--daemon', action='store_true',
+            help='keep the knitr interpreter running between invocations')
+
+    if command_name != RUBBER_INFO:
+        parser.add_argument ('--draft-graphics', type=int, nargs='?',
+            const=1024, metavar='PIXELS',
+            help='use copies of bitmaps reduced to PIXELS (default %(const)i)')
+
     parser.add_argument ('-e', '--epilogue', action='append', metavar='CMD',
         help='run the directive CMD after parsing')
 
@@ -121,20 +156,33 @@ def parse_opts (command_name):
         place.add_argument ('--inplace', action='store_const', dest='place',
             const=None,
             help='compile the documents from their source directory')
+    else:
+        place.add_argument ('--inplace', nargs=0, action=UnsupportedAction,
+            help='not supported, the document is compiled in a private directory')
 
-    place.add_argument ('--into', dest='place', metavar='DIR',
-        help='go to directory DIR before compiling')
+    if command_name == RUBBER_PIPE:
+        place.add_argument ('--into', dest='place', metavar='DIR',
+            default=tempfile.gettempdir (),
+            help='compile in a private directory created in DIR (default %(default)s)')
+    else:
+        place.add_argument ('--into', dest='place', metavar='DIR',
+            help='go to directory DIR before compiling')
 
     parser.set_defaults (texpath  = [])
     parser.add_argument ('-I', '--texpath', action='append', metavar='DIR',
         help='add DIR to the search path for LaTeX')
 
+    if command_name != RUBBER_INFO:
+        parser.add_argument ('-j', '--jobs', type=int,
+            default=os.cpu_count () or 1, metavar='N',
+            help='make at most N independent documents at once (default %(default)i)')
+
     parser.add_argument ('--jobname',
         help='set the job name for the first target')
 
     if command_name == RUBBER_PIPE:
         parser.add_argument ('-k', '--keep', action='store_true',
-            help='keep the temporary files after compiling')
+            help='keep the private directory after compiling')
 
     parser.add_argument ('-l', '--landscape', nargs=0,
         action=DeprecatedAction,
@@ -183,6 +231,10 @@ def parse_opts (command_name):
         dest='prologue', const='set src-specials yes',
         help="shortcut for -c 'set src-specials yes'")
 
+    if command_name != RUBBER_INFO:
+        parser.add_argument ('--streaming', action='store_true',
+            help='pipe the output of dvips into ps2pdf or the compressor, without intermediate files')
+
     parser.add_argument ('--synctex', action='append_const', dest='prologue',
         const='synctex', help='shortcut for -c synctex')
 
@@ -212,8 +264,9 @@ def parse_opts (command_name):
             metavar='TYPE', choices=warn_values,
             help='report warnings matching TYPE: '   + ','.join (warn_values))
 
-    compress.add_argument ('-z', '--gzip', action='store_const', const='gzip',
-        dest='compress', help='compress the final document with gzip')
+    compress.add_argument ('-z', '--gzip', action='store_const',
+        const=('gzip', None), dest='compress',
+        help='compress the final document with gzip')
 
     args = parser.parse_args ()
 
@@ -263,6 +316,8 @@ def prepare_source (filename, command_name, env, options):
                 raise rubber.GenericError (
                     _("Producing the main LaTeX file {} failed: {}")
                     .format (src, e.msg))
+        elif command_name == RUBBER_PLAIN:
+            src_node.clean ()
     else:
         src = path
 
@@ -278,33 +333,55 @@ def main (command_name):
 
         msg.debug (_("This is Rubber version %s.") % rubber.version.version)
 
+        if command_name != RUBBER_INFO and options.cache \
+           and not (command_name == RUBBER_PLAIN and options.clean):
+            rubber.cache.enable (options.cache_dir,
+                                 options.cache_size * 1024 * 1024)
+
+        if command_name != RUBBER_INFO:
+            rubber.depend.jobs = max (options.jobs, 1)
+        if command_name == RUBBER_PLAIN:
+            rubber.worker.enabled = options.daemon
+        if command_name == RUBBER_PIPE \
+           or (command_name == RUBBER_PLAIN and not options.clean):
+            rubber.depend.background = True
+
         if command_name == RUBBER_PIPE:
-            # Generate a temporary source file, and pretend it has
-            # been given on the command line.
-            args = (prepare_source_pipe (), )
+            # Generate a temporary source file in a private directory,
+            # and pretend it has been given on the command line with
+            # --inplace.
+            args = (os.path.join (prepare_workspace (options), 'rubtmp.tex'), )
+            place = None
+            prepare_source_pipe (args [0])
         else:
             args = options.source
+            place = options.place
 
-        if options.place is None: # --inplace
+        if place is None: # --inplace
             # Compute all absolute paths before the first chdir.
             args = map (os.path.abspath, args)
-        elif options.place != '.': # non default --into
-            print ("                       into", options.place)
+        elif place != '.': # non default --into
+            print ("                       into", place)
             # Make arguments relative to the new directory,
             # go there then proceed normally.
-            args = map (lambda p:os.path.relpath (p, options.place), args)
+            args = map (lambda p:os.path.relpath (p, place), args)
             try:
-                os.chdir (options.place)
+                os.chdir (place)
             except OSError as e:
                 raise rubber.GenericError \
                     (_("Error changing to %s from --into option: %s") \
-                     % (options.place, e.strerror))
+                     % (place, e.strerror))
+
+        # The products of the documents given on the command line, and
+        # of the external documents they refer to, see --clean.
+        cleaned = set ()
+        external = set ()
 
         for src in args:
 
             msg.debug (_("about to process file '%s'") % src)
 
-            if options.place is None: # --inplace
+            if place is None: # --inplace
                 # Chdir to the absolute path, then keep the base name.
                 src_dirname, src = os.path.split (src)
                 try:
@@ -319,6 +396,9 @@ def main (command_name):
             # in case of build mode, preprocessors will be run as part of
             # prepare_source.
             env = rubber.environment.Environment ()
+            if command_name != RUBBER_INFO:
+                env.draft_graphics = options.draft_graphics
+                env.streaming = options.streaming
             src = prepare_source (src, command_name, env, options)
 
             # safe mode is off during the prologue
@@ -336,7 +416,12 @@ def main (command_name):
             if not os.path.exists (src):
                 raise rubber.GenericError (_("LaTeX source file not found: '%s'") % src)
 
-            env.path.extend (options.texpath)
+            if command_name == RUBBER_PIPE:
+                env.path.extend (workspace_path)
+                env.read_only_path.extend (workspace_path)
+                env.tool_path.extend (workspace_path)
+            else:
+                env.path.extend (options.texpath)
 
             saved_vars = env.main.vars.copy ()
             for cmd in options.prologue:
@@ -347,6 +432,17 @@ def main (command_name):
             # safe mode is enforced for anything that comes from the .tex file
             env.is_in_unsafe_mode_ = options.unsafe
 
+            if rubber.depend.background:
+                # The conversions started while parsing need the cache.
+                if command_name == RUBBER_PLAIN and options.force:
+                    rubber.depend.preload_cache (None)
+                else:
+                    rubber.depend.preload_cache (env.main.basename ('.rubbercache'))
+                if rubber.cache.builds is not None \
+                   and command_name == RUBBER_PLAIN and not options.force:
+                    # A hit in the build cache must run nothing, see build.
+                    rubber.depend.hold_background ()
+
             env.main.parse()
 
             saved_vars = env.main.vars.copy ()
@@ -358,23 +454,37 @@ def main (command_name):
             if options.compress is not None:
                 last_node = env.final
                 filename = last_node.primary_product ()
-                if options.compress == 'gzip':
-                    import gzip
-                    env.final = rubber.converters.compressor.Node (
-                        gzip.GzipFile, '.gz', filename)
+                compressor = rubber.converters.compressor.Compressor (
+                    *options.compress)
+                if env.streaming and isinstance (last_node, rubber.depend.Pipeline) \
+                   and last_node.compressor is None:
+                    env.final = rubber.depend.Pipeline (
+                        last_node.stages, filename + compressor.extension,
+                        virtual=last_node.virtual + (filename,),
+                        compressor=compressor)
+                elif env.streaming and rubber.depend.streamable (last_node):
+                    env.final = rubber.depend.Pipeline (
+                        (last_node,), filename + compressor.extension,
+                        virtual=(filename,), compressor=compressor)
                 else:
-                    assert options.compress == 'bzip2'
-                    import bz2
                     env.final = rubber.converters.compressor.Node (
-                        bz2.BZ2File, '.bz2', filename)
+                        compressor, filename)
 
             if command_name == RUBBER_PIPE:
-                process_source_pipe (env, src, options)
+                process_source_pipe (env, options)
             elif command_name == RUBBER_INFO:
                 process_source_info (env, options.info_action, options.short)
             elif options.clean:
-                for node in env.final.all_producers ():
+                # The external documents of the xr module are only
+                # cleaned when they are given on the command line.
+                others = [doc for doc in env.documents.values ()
+                          if doc is not env.main]
+                for node in env.final.all_producers (stop=others):
                     node.clean ()
+                    cleaned.update (node.products ())
+                for doc in others:
+                    for node in doc.all_producers ():
+                        external.update (node.products ())
                 cache_path = env.main.basename ('.rubbercache')
                 if os.path.exists (cache_path):
                     msg.debug (_("removing %s"), cache_path)
@@ -382,9 +492,8 @@ def main (command_name):
             else:
                 build (options, RUBBER_PLAIN, env)
 
-        if (command_name == RUBBER_PLAIN and options.clean) \
-           or (command_name == RUBBER_PIPE and not options.keep):
-            rubber.depend.clean_all_products ()
+        if command_name == RUBBER_PLAIN and options.clean:
+            rubber.depend.clean_all_products (keep=external - cleaned)
 
     except KeyboardInterrupt:
         msg.warning (_("*** interrupted"))
@@ -395,6 +504,10 @@ def main (command_name):
     except rubber.GenericError as e:
         print ('error: ' + str (e), file=sys.stderr)
         sys.exit (2)
+    finally:
+        rubber.cache.close ()
+        if workspace is not None:
+            remove_workspace (options.keep)
 
 def build (options, command_name, env):
     """
@@ -403,6 +516,12 @@ def build (options, command_name, env):
     assert command_name == RUBBER_PIPE \
             or (command_name == RUBBER_PLAIN and not options.clean)
 
+    # The build cache may restore the files being converted.
+    rubber.depend.wait_background ()
+
+    cached = rubber.cache.builds is not None \
+        and command_name == RUBBER_PLAIN and not options.force
+
     cache_path = env.main.basename ('.rubbercache')
     if os.path.exists (cache_path):
         if command_name == RUBBER_PLAIN and options.force:
@@ -410,6 +529,65 @@ def build (options, command_name, env):
         else:
             rubber.depend.load_cache (cache_path)
 
+    if cached:
+        leaves = env.final.all_leaves ()
+        key = build_key (env, leaves)
+        if up_to_date (env):
+            # Restoring the products would only replace them.
+            msg.debug (_("%s is up to date"), env.final.primary_product ())
+            rubber.depend.release_background (False)
+        elif rubber.cache.builds.restore (key) is not None:
+            rubber.depend.release_background (False)
+            msg.info (_("%s restored from the build cache"),
+                      env.final.primary_product ())
+            # The restored cache file describes the directory where the
+            # entry was saved, the files are now those restored here.
+            for node in env.final.all_producers ():
+                node.snapshots = tuple (map (node.snapshot_source,
+                                             node.sources))
+            rubber.depend.save_cache (cache_path, env.final)
+        else:
+            seed_key = rubber.cache.key (
+                os.path.abspath (env.main.source ()), os.getcwd (),
+                rubber.cache.git_branch (os.path.dirname (env.main.source ())))
+            # Node.make still checks that the contents settle, so a stale
+            # seed costs the compilations that an empty file would cost.
+            seeded = rubber.cache.seeds.restore (seed_key, overwrite=False)
+            if seeded:
+                msg.info (_("starting from %s"), " ".join (seeded))
+            rubber.depend.release_background (True)
+            make (options, command_name, env, cache_path)
+            rubber.cache.seeds.replace (seed_key, [
+                path for path in seed_paths (env) if os.path.exists (path)])
+            # If the compilation has revealed new dependencies, the key
+            # computed before does not describe the products.
+            if os.path.exists (cache_path) \
+               and env.final.all_leaves () == leaves:
+                paths = [path for path in rubber.depend.products_of (
+                             env.final.all_producers ())
+                         if os.path.exists (path)]
+                paths.append (cache_path)
+                rubber.cache.builds.insert (key, paths)
+    else:
+        make (options, command_name, env, cache_path)
+
+    if options.warn_boxes or options.warn_misc or options.warn_refs:
+        # FIXME
+        log = env.main.log
+        if not env.main.parse_log ():
+            msg.error(_("cannot read the log file"))
+            return 1
+        for err in log.parse(boxes=options.warn_boxes,
+            refs=options.warn_refs, warnings=options.warn_misc):
+            display (options.short, **err)
+
+def make (options, command_name, env, cache_path):
+    """
+    Bring the final product up to date, and save the cache file with
+    the steps that succeeded, even if a later one fails or the build is
+    interrupted.
+    """
+    rubber.depend.save_cache_on_exit (cache_path, env.final)
     try:
         if command_name == RUBBER_PLAIN and options.force:
             ret = env.main.make ()
@@ -429,21 +607,61 @@ def build (options, command_name, env):
             number -= 1
         # Ensure a message even with -q.
         raise rubber.GenericError (_("Stopping because of compilation errors."))
+    finally:
+        rubber.depend.flush_cache ()
 
-    if ret:
-        rubber.depend.save_cache (cache_path, env.final)
-    else:
+    if not ret:
         msg.info (_("nothing to be done for %s"), env.main.source ())
 
-    if options.warn_boxes or options.warn_misc or options.warn_refs:
-        # FIXME
-        log = env.main.log
-        if not env.main.parse_log ():
-            msg.error(_("cannot read the log file"))
-            return 1
-        for err in log.parse(boxes=options.warn_boxes,
-            refs=options.warn_refs, warnings=options.warn_misc):
-            display (options.short, **err)
+def seed_paths (env):
+    """
+    Return the auxiliary files of the document: the products that are
+    read again by a later step and depend on a LaTeX compilation (.aux,
+    .toc, .bbl, .ind...).  Other intermediate files like converted
+    figures do not converge, and are handled by the artifact cache.
+    """
+    producers = list (env.final.all_producers ())
+    sources = set ()
+    for node in producers:
+        sources.update (node.sources)
+    return [path for path in rubber.depend.products_of (
+                node for node in producers
+                if env.main in node.all_producers ())
+            if path in sources]
+
+def up_to_date (env):
+    """
+    Return true if the primary products exist and all sources are as
+    they were at the last successful run of each node, according to the
+    cache file, so that making the final product would run nothing.
+    """
+    for node in env.final.all_producers ():
+        if node.snapshots is None \
+           or not os.path.exists (node.primary_product ()) \
+           or tuple (map (node.snapshot_source, node.sources)) \
+              != tuple (node.snapshots):
+            return False
+    return True
+
+def build_key (env, leaves):
+    """
+    Compute the key of the document in the build cache from the contents
+    of the sources that are not produced, the LaTeX command line, the
+    active modules, the dependency graph and the tools running each step.
+    """
+    cmd, cmd_env = env.main.command_line ()
+    steps = []
+    for node in env.final.all_producers ():
+        steps.append ((node.primary_product (), tuple (node.sources),
+                       tuple (rubber.cache.tool_identity (tool)
+                              for tool in node.tools ())))
+    steps.sort ()
+    return rubber.cache.key (
+        tuple ((path, rubber.contents.snapshot (path))
+               for path in sorted (leaves)),
+        cmd, sorted (cmd_env.items ()),
+        sorted (env.main.modules.objects),
+        steps)
 
 def display (short, kind, text, **info):
     """
@@ -470,55 +688,91 @@ def display (short, kind, text, **info):
         assert kind == "warning"
         msg.warning (rubber.util._format (info, text))
 
-def prepare_source_pipe ():
+# The private directory of rubber-pipe, and the directories where
+# the files of the user are searched, see prepare_workspace.
+workspace = None
+workspace_path = []
+
+def prepare_workspace (options):
     """
-    Dump the standard input in a file, and set up that file
-    the same way we would normally process LaTeX sources.
+    Create the private directory where rubber-pipe compiles the document,
+    so that concurrent invocations never share a file, and return its
+    absolute path.  The files of the user are still found in the current
+    directory and the directories given with --texpath, but the files
+    converted from them are written in the private directory.
+    """
+    global workspace, workspace_path
+    workspace_path = [os.getcwd ()]
+    workspace_path.extend (os.path.abspath (p) for p in options.texpath)
+    try:
+        workspace = os.path.abspath (
+            tempfile.mkdtemp (prefix='rubtmp', dir=options.place))
+    except OSError as e:
+        raise rubber.GenericError (_("cannot create a directory in %s: %s")
+                                   % (options.place, e.strerror))
+    msg.debug (_("compiling in %s"), workspace)
+    return workspace
+
+def remove_workspace (keep):
+    if not os.path.isdir (workspace):
+        return
+    if keep:
+        msg.info (_("keeping %s"), workspace)
+        return
+    msg.debug (_("removing tree %s"), workspace)
+    # Leave the directory before removing it.
+    os.chdir (workspace_path [0])
+    shutil.rmtree (workspace, ignore_errors=True)
+
+def prepare_source_pipe (path):
+    """
+    Dump the standard input in the file path, to process it the same
+    way we would normally process LaTeX sources.
     """
-
-    # FIXME: with a better program structure, the context manager
-    # should remove the input file.
-
     try:
-        # Make a temporary on-disk copy of the standard input,
-        # in the current working directory.
-        # The name will have the form "rubtmpXXX.tex.
-        with tempfile.NamedTemporaryFile (suffix='.tex', prefix='rubtmp', dir='.', delete=False) as srcfile:
-            # note the tempfile name so we can remove it later
-            pipe_tempfile = srcfile.name
-            # copy stdin into the tempfile
-            msg.info (_("saving the input in %s") % pipe_tempfile)
+        with open (path, 'wb') as srcfile:
+            msg.info (_("saving the input in %s") % path)
             shutil.copyfileobj (sys.stdin.buffer, srcfile)
     except IOError:
         raise rubber.GenericError (_("cannot create temporary file for the main LaTeX source"))
 
-    return pipe_tempfile
-
-def process_source_pipe (env, pipe_tempfile, options):
+def send_file (path, out):
     """
-    Build the document, and dump the result on stdout.
+    Copy the file path to the binary file out, without copying the data
+    through Python when the system allows it.
     """
-    try:
-        build (options, RUBBER_PIPE, env)
-        filename = env.final.primary_product ()
+    out.flush ()
+    with open (path, 'rb') as f:
+        size = os.fstat (f.fileno ()).st_size
+        offset = 0
         try:
-            # dump the results on standard output
-            with open (filename, "rb") as output:
-                shutil.copyfileobj (output, sys.stdout.buffer)
-        except IOError:
-            raise rubber.GenericError (_("error copying the product '%s' to stdout") % filename)
-    finally:
-        # clean the intermediate files
-        if not options.keep:
-            for node in env.final.all_producers ():
-                node.clean ()
-            cache_path = env.main.basename ('.rubbercache')
-            if os.path.exists (cache_path):
-                msg.debug (_("removing %s"), cache_path)
-                os.remove (cache_path)
-            if os.path.exists (pipe_tempfile):
-                msg.info (_("removing %s"), pipe_tempfile)
-                os.remove (pipe_tempfile)
+            while offset < size:
+                sent = os.sendfile (out.fileno (), f.fileno (), offset,
+                                    size - offset)
+                if sent == 0:
+                    break
+                offset += sent
+            return
+        except (AttributeError, OSError) as e:
+            # No sendfile, or not to this kind of file.
+            if isinstance (e, OSError) and e.errno not in (
+                    errno.EINVAL, errno.ENOSYS, errno.ENOTSOCK,
+                    errno.EOPNOTSUPP):
+                raise
+        f.seek (offset)
+        shutil.copyfileobj (f, out)
+
+def process_source_pipe (env, options):
+    """
+    Build the document, and dump the result on stdout.  The private
+    directory is removed by main.
+    """
+    build (options, RUBBER_PIPE, env)
+    filename = env.final.primary_product ()
+    try:
+        send_file (filename, sys.stdout.buffer)
+    except IOError:
+        raise rubber.GenericError (_("error copying the product '%s' to stdout") % filename)
 
 def process_source_info (env, act, short):
     if act == "deps":
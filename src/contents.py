@@ -3,9 +3,13 @@ import logging
 log = logging.getLogger (__name__)
 import io
 import os.path
+import threading
 
 _cache = {}
 
+# The nodes made in concurrent threads snapshot their sources together.
+_lock = threading.Lock ()
+
 def snapshot (path):
     """
         A snapshot of the contents of an external file.
@@ -31,6 +35,10 @@ def snapshot (path):
 
     # Distinct paths refering to the same external file should be
     # rare, so we do not attempt to detect them.
+    with _lock:
+        return _snapshot (path)
+
+def _snapshot (path):
     try:
         c, t = _cache [path]
     except KeyError:
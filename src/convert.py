@@ -3,15 +3,76 @@ This module contains code for file conversion, including implicit conversion
 rule management.
 """
 
+import heapq
 import re, imp, os.path
-from configparser import ConfigParser
+from configparser import ConfigParser, NoOptionError, ParsingError
 import logging
 msg = logging.getLogger (__name__)
 from rubber.util import _
 import rubber.converters
+import rubber.dircache
 
 re_variable = re.compile('[a-zA-Z]+')
 
+# A target ending with a literal extension, or a choice of them.
+re_extension = re.compile (r'\\\.(?:\(([a-zA-Z0-9_|]+)\)|([a-zA-Z0-9_]+))$')
+
+# A source template naming a file in the directory of the target, with a
+# literal extension.
+re_source_extension = re.compile (r'\\1\.([a-zA-Z0-9_]+)$')
+
+# The maximal number of rules applied in a chain to make one file.  The
+# search explores every rule matching each intermediate name, so it
+# grows quickly with this limit.  It is documented in the manuals.
+max_steps = 3
+
+# The rules read from each file, keyed by the path and modification
+# time of the file, so that all converters share them.  Each rule is
+# a triple (dictionary, expanded source templates, target extensions).
+_tables = {}
+
+# The converter modules, shared by all converters.
+_modules = {}
+
+def target_extensions (target):
+    """
+    Return the list of the extensions of all names matched by the
+    regular expression 'target', or None if they cannot be deduced.
+    """
+    m = re_extension.search (target)
+    if m is None:
+        return None
+    if m.group (1) is not None:
+        return m.group (1).split ('|')
+    return [m.group (2)]
+
+def literal_prefix (pattern):
+    """
+    Return the longest string that starts all names matched by the
+    regular expression 'pattern'.
+    """
+    prefix = ''
+    pos = 0
+    while pos < len (pattern):
+        c = pattern [pos]
+        if c == '\\' and pos + 1 < len (pattern) \
+           and not pattern [pos + 1].isalnum ():
+            prefix += pattern [pos + 1]
+            pos += 2
+        elif c in '\\.^$*+?{}[]|()':
+            break
+        else:
+            prefix += c
+            pos += 1
+    # The last character may be optional or repeated.
+    if pos < len (pattern) and pattern [pos] in '*?{':
+        prefix = prefix [:-1]
+    return prefix
+
+def extension (name):
+    """Return the part of a file name after the last dot."""
+    return name [name.rfind ('.') + 1:]
+
 def expand_cases (string, vars):
     """
     Expand variables and cases in a template string. Variables must occur as
@@ -111,20 +172,44 @@ class Converter (object):
         an empty set of rules.
         """
         self.env = env
-        self.modules = {}
+        self.modules = _modules
         self.rules = []
+        # For each extension, the rules that may produce a target with this
+        # extension, in the order of the rule files, as (dictionary, source
+        # templates) pairs.  The rules whose target extension is unknown
+        # are in all lists, and in the wildcard list.
+        self.by_extension = {}
+        self.wildcard = []
+        # For each target extension, the result of source_extensions.
+        self.source_exts = {}
 
     def read_ini (self, filename):
         """
         Read a set of rules from a file. The file has the form of an INI file,
         each section describes a rule.
         """
+        try:
+            key = (filename, os.stat (filename).st_mtime_ns)
+        except OSError:
+            key = (filename, None)
+        try:
+            table = _tables [key]
+        except KeyError:
+            table = _tables [key] = self.parse_ini (filename)
+        for rule, templates, extensions in table:
+            self.add_rule (rule, templates, extensions)
+
+    def parse_ini (self, filename):
+        """
+        Parse a rule file, and return its rules in the format of _tables.
+        """
+        table = []
         cp = ConfigParser()
         try:
             cp.read(filename)
         except ParsingError:
             msg.error (rubber.util._format ({'file':filename}, _("parse error, ignoring it")))
-            return
+            return table
         for name in cp.sections():
             dict = { 'name': name }
             for key in cp.options(name):
@@ -142,10 +227,26 @@ class Converter (object):
                 continue
             if 'rule' not in dict:
                 msg.warning (rubber.util._format ({'file':filename}, _("ignoring rule `%s' (no module found)") % name))
+                continue
             if not self.load_module(dict['rule']):
                 msg.warning (rubber.util._format ({'file':filename}, _("ignoring rule `%s' (module `%s' not found)") % (name, dict['rule'])))
+                continue
             dict ["re_target"] = re.compile (dict ['target'] + '$')
-            self.rules.append (dict)
+            templates, _pos = expand_cases (dict ['source'], {})
+            table.append ((dict, templates, target_extensions (dict ['target'])))
+        return table
+
+    def add_rule (self, rule, templates, extensions):
+        self.rules.append (rule)
+        self.source_exts.clear ()
+        entry = (rule, templates)
+        if extensions is None:
+            self.wildcard.append (entry)
+            for rules in self.by_extension.values ():
+                rules.append (entry)
+        else:
+            for ext in extensions:
+                self.by_extension.setdefault (ext, list (self.wildcard)).append (entry)
 
     def load_module (self, name):
         """
@@ -168,11 +269,46 @@ class Converter (object):
         this converter, i.e. if it matches one of the target regular
         expressions.
         """
-        for rule in self.rules:
+        for rule, templates in self.by_extension.get (extension (name), self.wildcard):
             if rule ["re_target"].match(name):
                 return True
         return False
 
+    def source_extensions (self, ext):
+        """
+        Return a pair (extensions, prefixes) for the chains of rules making
+        a target with extension 'ext'.  The extensions are those of the
+        sources in the directory of the target, or None if a rule may use
+        a source with another extension.  The prefixes are those of the
+        names matched by the other rules, which are not followed.  The
+        result is remembered for each extension.
+        """
+        if ext not in self.source_exts:
+            self.source_exts [ext] = self.find_source_extensions (ext)
+        return self.source_exts [ext]
+
+    def find_source_extensions (self, ext):
+        result = set ()
+        prefixes = set ()
+        current = {ext}
+        for step in range (max_steps):
+            following = set ()
+            for name in current:
+                for rule, templates in self.by_extension.get (name, self.wildcard):
+                    # The sources made from the target by the other rules
+                    # start like the target.
+                    if not rule ['target'].startswith ('(.*'):
+                        prefixes.add (literal_prefix (rule ['target']))
+                        continue
+                    for template in templates:
+                        m = re_source_extension.match (template)
+                        if m is None:
+                            return None, prefixes
+                        following.add (m.group (1))
+            result |= following
+            current = following
+        return result, prefixes
+
     def best_rule (self, target, check, context):
         """
         Search for an applicable rule for the given target with the least
@@ -182,46 +318,81 @@ class Converter (object):
         dictionary that contains at least 'source' and 'target') and can
         return false if the rule is refused. The optional argument 'context'
         is expected to be a Variables instance attached to a Node.
+
+        The source of the rule may itself be produced by another rule, up to
+        max_steps rules, in which case the dictionary for the rule making the
+        source is in the 'previous' entry. The 'cost' entry then holds the
+        total cost of the chain. The 'check' function only applies to the
+        rule making the target.
         """
-        candidates = []
+        # Most names tried for a figure cannot be made from any file.
+        exts, prefixes = self.source_extensions (extension (target))
+        if exts is not None \
+           and not any (target.startswith (prefix) for prefix in prefixes) \
+           and not rubber.dircache.has_extension (os.path.dirname (target), exts):
+            return None
 
-        for rule in self.rules:
-            match = rule ["re_target"].match(target)
-            if not match:
-                continue
-            templates, _ = expand_cases(rule['source'], {})
-            for template in templates:
-                source = match.expand(template)
-                if source == target:
-                    continue
-                if not os.path.exists(source):
-                    continue
-                candidates.append((rule['cost'], source, target, rule))
-
-        candidates.sort()
-        for cost, source, target, rule in candidates:
-            instance = context.copy ()
-            for k, v in rule.items ():
-                instance [k] = v
-            # Replace in this instance generic patterns set from rule with actual paths.
-            instance['source'] = source
-            instance['target'] = target
-            if check is not None and not check(instance):
+        # Dijkstra's algorithm, backwards from the target.  Each item in
+        # the queue is a source, either existing or to be made by another
+        # rule, with the chain of instances making the target from it.
+        # Only compare the costs and sources, then the lengths of the
+        # chains, rules are not ordered.
+        queue = [(0, target, 0, 0, ())]
+        expanded = set ()
+        count = 0
+        while queue:
+            cost, name, steps, _count, chain = heapq.heappop (queue)
+            if chain and rubber.dircache.exists (name):
+                for instance, previous in zip (chain, chain [1:]):
+                    instance ['previous'] = previous
+                chain [0] ['cost'] = cost
+                return chain [0]
+            if steps == max_steps or name in expanded:
                 continue
-            module = self.modules[rule['rule']]
-            if hasattr(module, 'check'):
-                if not module.check (source=source, target=target, context=instance):
+            expanded.add (name)
+            made = set (instance ['target'] for instance in chain)
+            for rule, templates in self.by_extension.get (extension (name), self.wildcard):
+                match = rule ["re_target"].match(name)
+                if not match:
                     continue
-            return instance
+                for template in templates:
+                    source = match.expand(template)
+                    if source == name or source in made:
+                        continue
+                    instance = self.instance (rule, source, name, context)
+                    if not steps and check is not None and not check (instance):
+                        continue
+                    module = self.modules[rule['rule']]
+                    if hasattr(module, 'check'):
+                        if not module.check (source=source, target=name, context=instance):
+                            continue
+                    count += 1
+                    heapq.heappush (queue, (cost + rule ['cost'], source,
+                                            steps + 1, count, chain + (instance,)))
 
         return None
 
+    def instance (self, rule, source, target, context):
+        """
+        Return the variables for the application of a rule.
+        """
+        instance = context.copy ()
+        for k, v in rule.items ():
+            instance [k] = v
+        # Replace in this instance generic patterns set from rule with actual paths.
+        instance['source'] = source
+        instance['target'] = target
+        return instance
+
     def apply (self, instance):
         """
         Apply a rule with the variables given in the dictionary passed as
         argument (as returned from the 'best_rule' method), and return a
-        dependency node for the result.
+        dependency node for the result. The rules making the intermediate
+        files are applied first.
         """
+        if 'previous' in instance:
+            self.apply (instance ['previous'])
         module = self.modules[instance['rule']]
         return module.convert(
                 source = instance['source'],
@@ -0,0 +1,788 @@
+# This file is covered by the GPL as part of Rubber.
+# vim: noet:ts=4
+"""
+Extraction of bounding boxes, as done by 'extractbb'.
+
+The graphics drivers of dvipdfm and dvipdfmx read the size of bitmaps and
+PDF figures from .bb and .xbb files, and the dvips driver reads the bounding
+box of a gzipped PostScript figure from a .bb file.  The files are written
+here without starting any program, reading only the headers of PostScript
+(DSC comments, or the trailer when the box is declared '(atend)'), PNG
+(IHDR and pHYs chunks) and JPEG (JFIF density and SOF segment) files.  For
+PDF files, the CropBox or the MediaBox of the first page is found through
+the cross-reference sections and the page tree, including in compressed
+object streams.  If a PDF file cannot be read this way, for example if it
+is encrypted, extractbb is run instead.
+
+The results are kept in the artifact cache under the checksum of the source.
+"""
+
+import collections
+import gzip
+import logging
+msg = logging.getLogger (__name__)
+import math
+import os.path
+import re
+import struct
+import subprocess
+import tempfile
+import zlib
+from rubber.util import _
+import rubber.cache
+import rubber.contents
+import rubber.depend
+import rubber.util
+
+# Changing the output format must change the keys in the artifact cache.
+format_version = 1
+
+class BoundingBoxError (Exception):
+    pass
+
+#--  PostScript  {{{1
+
+re_dsc_bbox = re.compile (
+    rb'^%%(?P<hires>HiRes)?BoundingBox:[ \t]*(?P<value>\(atend\)|[-+.0-9eE \t]+)',
+    re.MULTILINE)
+
+# The size of the blocks read, and of the trailer read first from the end
+# of uncompressed files.
+block_size = 0x10000
+
+def _parse_box (value):
+    try:
+        box = tuple (float (x) for x in value.split ())
+    except ValueError:
+        box = ()
+    if len (box) != 4:
+        raise BoundingBoxError (_("invalid bounding box: %s")
+                                % value.decode ('latin_1').strip ())
+    return box
+
+def _dsc_boxes (text):
+    """
+    Return the last bounding box and high resolution bounding box found
+    in text (None if absent), and whether one of them is deferred to the
+    trailer.
+    """
+    boxes = {False: None, True: None}
+    atend = False
+    for match in re_dsc_bbox.finditer (text.replace (b'\r', b'\n')):
+        value = match.group ('value')
+        if value.startswith (b'(atend)'):
+            atend = True
+        else:
+            boxes [bool (match.group ('hires'))] = _parse_box (value)
+    return boxes [False], boxes [True], atend
+
+def _header (stream):
+    """Return the DSC header at the beginning of stream."""
+    header = b''
+    while True:
+        data = stream.read (block_size)
+        header += data
+        end = re.search (rb'^(%%EndComments|[^%\r\n])', header.replace (b'\r', b'\n'),
+                         re.MULTILINE)
+        if end is not None:
+            return header [:end.start ()]
+        if not data:
+            return header
+
+def _trailer_boxes (stream, size):
+    """
+    Return the boxes declared last in the stream, for '(atend)'.  When the
+    size of the stream is known, its end is read first.
+    """
+    if size is not None and size > block_size:
+        stream.seek (size - block_size)
+        box, hires, atend = _dsc_boxes (stream.read ())
+        if box is not None:
+            return box, hires
+    stream.seek (0)
+    box = hires = None
+    tail = b''
+    while True:
+        data = stream.read (block_size)
+        if not data:
+            return box, hires
+        # Keep the beginning of a comment split between two blocks.
+        text = tail + data
+        cut = max (text.rfind (b'\n'), text.rfind (b'\r'))
+        if cut < 0:
+            tail = text
+            continue
+        text, tail = text [:cut], text [cut:]
+        b, h, atend = _dsc_boxes (text)
+        box = b or box
+        hires = h or hires
+
+def ps_bbox (stream, size):
+    """
+    Return the bounding box and the high resolution bounding box (or None)
+    of a PostScript stream of known size (or None for compressed data).
+    """
+    start = stream.read (12)
+    offset = 0
+    if start [:4] == b'\xc5\xd0\xd3\xc6':
+        # The binary header of DOS EPS files, with the position and length
+        # of the PostScript section.
+        offset, length = struct.unpack ('<II', start [4:12])
+        size = None
+    stream.seek (offset)
+    box, hires, atend = _dsc_boxes (_header (stream))
+    if atend:
+        stream.seek (offset)
+        box, hires = _trailer_boxes (stream, size)
+    if box is None:
+        raise BoundingBoxError (_("no bounding box was found"))
+    return box, hires
+
+#--  PDF  {{{1
+
+# The objects of a PDF file are read through its cross-reference
+# sections, found from the end of the file, so that only these sections,
+# the objects of the page tree down to the first page, and the object
+# streams containing them are read.
+
+class _Truncated (Exception):
+    """The data read ends inside the object being parsed."""
+
+class Name (bytes):
+    pass
+
+Ref = collections.namedtuple ('Ref', 'num gen')
+
+_regular = rb'[^\0\t\n\f\r ()<>\[\]{}/%]'
+re_space = re.compile (rb'(?:[\0\t\n\f\r ]+|%[^\r\n]*)*')
+re_regular = re.compile (_regular + rb'+')
+re_number = re.compile (rb'[-+]?(\d+\.?\d*|\.\d+)$')
+re_ref = re.compile (rb'[\0\t\n\f\r ]+(\d+)[\0\t\n\f\r ]+R(?!' + _regular + rb')')
+re_obj = re.compile (rb'(\d+)[\0\t\n\f\r ]+\d+[\0\t\n\f\r ]+obj(?!' + _regular + rb')')
+re_subsection = re.compile (rb'(\d+)[ \t]+(\d+)')
+re_entry = re.compile (rb'(\d{10})[ \t]\d{5}[ \t]([fn])')
+re_startxref = re.compile (rb'startxref[\0\t\n\f\r ]+(\d+)')
+
+# Bounds against loops in malformed files.
+_max_depth = 64
+
+def _invalid (what):
+    return BoundingBoxError (_("invalid PDF file: %s") % what)
+
+class _Parser:
+    """
+    A parser of PDF objects in data, read at offset in a file.  If
+    complete is false, the file continues after data, and _Truncated is
+    raised when an object may continue there.
+    """
+    def __init__ (self, data, complete, offset=0):
+        self.data = data
+        self.complete = complete
+        self.offset = offset
+
+    def check (self, pos):
+        if pos >= len (self.data) and not self.complete:
+            raise _Truncated ()
+
+    def skip (self, pos):
+        """Return the position of the next token after pos."""
+        pos = re_space.match (self.data, pos).end ()
+        self.check (pos)
+        return pos
+
+    def value (self, pos):
+        """Return the object starting after pos, and the position after it."""
+        data = self.data
+        pos = self.skip (pos)
+        if pos >= len (data):
+            raise _invalid (_("unexpected end"))
+        if data.startswith (b'<<', pos):
+            result = {}
+            pos += 2
+            while True:
+                pos = self.skip (pos)
+                if data.startswith (b'>>', pos):
+                    return result, pos + 2
+                key, pos = self.value (pos)
+                if not isinstance (key, Name):
+                    raise _invalid (_("dictionary key"))
+                result [bytes (key)], pos = self.value (pos)
+        char = data [pos]
+        if char == ord ('['):
+            result = []
+            pos += 1
+            while True:
+                pos = self.skip (pos)
+                if data.startswith (b']', pos):
+                    return result, pos + 1
+                item, pos = self.value (pos)
+                result.append (item)
+        if char == ord ('/'):
+            match = re_regular.match (data, pos + 1)
+            end = pos + 1 if match is None else match.end ()
+            self.check (end)
+            return Name (data [pos + 1:end]), end
+        if char == ord ('('):
+            depth = 0
+            end = pos + 1
+            while True:
+                self.check (end)
+                if end >= len (data):
+                    raise _invalid (_("unexpected end"))
+                char = data [end]
+                if char == ord ('\\'):
+                    end += 1
+                elif char == ord ('('):
+                    depth += 1
+                elif char == ord (')'):
+                    if depth == 0:
+                        return data [pos + 1:end], end + 1
+                    depth -= 1
+                end += 1
+        if char == ord ('<'):
+            end = data.find (b'>', pos)
+            if end < 0:
+                self.check (len (data))
+                raise _invalid (_("unexpected end"))
+            return data [pos + 1:end], end + 1
+        match = re_regular.match (data, pos)
+        if match is None:
+            raise _invalid (_("unexpected %r") % data [pos:pos + 1])
+        token = match.group ()
+        end = match.end ()
+        self.check (end)
+        if re_number.match (token) is None:
+            return {b'true': True, b'false': False,
+                    b'null': None}.get (token, token), end
+        if b'.' in token:
+            return float (token), end
+        ref = re_ref.match (data, end)
+        if ref is None:
+            # The rest of a reference may be after the data.
+            self.check (end + 32)
+            return int (token), end
+        return Ref (int (token), int (ref.group (1))), ref.end ()
+
+    def indirect (self):
+        """
+        Return the indirect object at the beginning of data, and the
+        position of its stream, or None.
+        """
+        pos = self.skip (0)
+        match = re_obj.match (self.data, pos)
+        if match is None:
+            self.check (pos + 32)
+            raise _invalid (_("no object at the expected offset"))
+        value, pos = self.value (match.end ())
+        if not isinstance (value, dict):
+            return value, None
+        pos = self.skip (pos)
+        if not self.data.startswith (b'stream', pos):
+            return value, None
+        pos += 6
+        self.check (pos + 2)
+        if self.data.startswith (b'\r\n', pos):
+            return value, pos + 2
+        if self.data.startswith (b'\n', pos) or self.data.startswith (b'\r', pos):
+            return value, pos + 1
+        return value, pos
+
+def _unpredict (data, params):
+    """Undo the PNG predictors of a stream, as used by xref streams."""
+    predictor = params.get (b'Predictor', 1)
+    if predictor == 1:
+        return data
+    if not isinstance (predictor, int) or predictor < 10:
+        raise BoundingBoxError (_("unsupported PDF predictor %s") % predictor)
+    bits = params.get (b'Colors', 1) * params.get (b'BitsPerComponent', 8)
+    step = max (1, bits // 8)
+    width = (bits * params.get (b'Columns', 1) + 7) // 8
+    result = bytearray ()
+    previous = bytearray (width)
+    for start in range (0, len (data), width + 1):
+        kind = data [start]
+        row = bytearray (data [start + 1:start + 1 + width].ljust (width, b'\0'))
+        for i in range (width):
+            left = row [i - step] if i >= step else 0
+            up = previous [i]
+            if kind == 1:
+                row [i] = (row [i] + left) & 0xff
+            elif kind == 2:
+                row [i] = (row [i] + up) & 0xff
+            elif kind == 3:
+                row [i] = (row [i] + (left + up) // 2) & 0xff
+            elif kind == 4:
+                corner = previous [i - step] if i >= step else 0
+                guess = left + up - corner
+                nearest = min ((abs (guess - left), left),
+                               (abs (guess - up), up),
+                               (abs (guess - corner), corner),
+                               key=lambda pair: pair [0]) [1]
+                row [i] = (row [i] + nearest) & 0xff
+        result += row
+        previous = row
+    return bytes (result)
+
+class _Document:
+    """The objects of a PDF file, read on demand."""
+
+    def __init__ (self, stream):
+        self.stream = stream
+        # For each object number, its offset, a pair (number of the
+        # object stream, index in it), or None if it is free.
+        self.xref = {}
+        # The decompressed object streams, with the offsets of their
+        # objects.
+        self.object_streams = {}
+        self.trailer = self.read_xref (self.startxref ())
+
+    def read (self, offset, parse):
+        """
+        Call parse with a _Parser for the data at offset, reading more
+        data until nothing is truncated, and return its result.
+        """
+        length = 0x1000
+        while True:
+            self.stream.seek (offset)
+            data = self.stream.read (length)
+            try:
+                return parse (_Parser (data, len (data) < length, offset))
+            except _Truncated:
+                length *= 4
+
+    def startxref (self):
+        size = self.stream.seek (0, os.SEEK_END)
+        self.stream.seek (max (0, size - 1024))
+        matches = re_startxref.findall (self.stream.read ())
+        if not matches:
+            raise _invalid (_("no startxref"))
+        return int (matches [-1])
+
+    def read_xref (self, offset):
+        """
+        Read the cross-reference section at offset and the previous ones,
+        and return the newest trailer.
+        """
+        result = None
+        seen = set ()
+        while isinstance (offset, int) and offset not in seen:
+            seen.add (offset)
+            entries, trailer = self.read (offset, self.parse_xref)
+            stream = trailer.get (b'XRefStm')
+            if isinstance (stream, int) and stream not in seen:
+                # In hybrid files, the stream completes the table.
+                seen.add (stream)
+                more, _trailer = self.read (stream, self.parse_xref)
+                for num, entry in more.items ():
+                    entries.setdefault (num, entry)
+            for num, entry in entries.items ():
+                self.xref.setdefault (num, entry)
+            if result is None:
+                result = trailer
+            offset = trailer.get (b'Prev')
+        return result
+
+    def parse_xref (self, parser):
+        """Return the entries and the trailer of a cross-reference section."""
+        data = parser.data
+        pos = parser.skip (0)
+        if not data.startswith (b'xref', pos):
+            return self.parse_xref_stream (parser)
+        entries = {}
+        pos += 4
+        while True:
+            pos = parser.skip (pos)
+            if data.startswith (b'trailer', pos):
+                trailer, pos = parser.value (pos + 7)
+                if not isinstance (trailer, dict):
+                    raise _invalid (_("trailer"))
+                return entries, trailer
+            match = re_subsection.match (data, pos)
+            if match is None:
+                parser.check (pos + 32)
+                raise _invalid (_("cross-reference table"))
+            first, count = int (match.group (1)), int (match.group (2))
+            pos = match.end ()
+            for num in range (first, first + count):
+                pos = parser.skip (pos)
+                match = re_entry.match (data, pos)
+                if match is None:
+                    parser.check (pos + 20)
+                    raise _invalid (_("cross-reference table"))
+                pos = match.end ()
+                if match.group (2) == b'n':
+                    entries [num] = int (match.group (1))
+                else:
+                    entries [num] = None
+
+    def parse_xref_stream (self, parser):
+        dictionary, start = parser.indirect ()
+        if start is None or dictionary.get (b'Type') != b'XRef':
+            raise _invalid (_("cross-reference stream"))
+        data = self.stream_data (dictionary, parser.offset + start)
+        widths = dictionary.get (b'W')
+        if not isinstance (widths, list) or len (widths) != 3 \
+           or not all (isinstance (w, int) and w >= 0 for w in widths):
+            raise _invalid (_("cross-reference stream"))
+        index = dictionary.get (b'Index', [0, dictionary.get (b'Size', 0)])
+        entries = {}
+        pos = 0
+        for first, count in zip (index [::2], index [1::2]):
+            for num in range (first, first + count):
+                fields = []
+                for width in widths:
+                    fields.append (int.from_bytes (data [pos:pos + width], 'big'))
+                    pos += width
+                if pos > len (data):
+                    raise _invalid (_("cross-reference stream"))
+                kind = fields [0] if widths [0] else 1
+                if kind == 1:
+                    entries [num] = fields [1]
+                elif kind == 2:
+                    entries [num] = (fields [1], fields [2])
+                elif kind == 0:
+                    entries [num] = None
+        return entries, dictionary
+
+    def stream_data (self, dictionary, offset):
+        """Return the decoded data of a stream starting at offset."""
+        length = self.resolve (dictionary.get (b'Length'))
+        if not isinstance (length, int) or length < 0:
+            raise _invalid (_("stream length"))
+        self.stream.seek (offset)
+        data = self.stream.read (length)
+        filters = self.resolve (dictionary.get (b'Filter', []))
+        params = self.resolve (dictionary.get (b'DecodeParms', []))
+        if not isinstance (filters, list):
+            filters, params = [filters], [params]
+        if not isinstance (params, list):
+            params = [params]
+        for i, name in enumerate (filters):
+            if name not in (b'FlateDecode', b'Fl'):
+                raise BoundingBoxError (_("unsupported PDF filter %s")
+                                        % name.decode ('latin_1'))
+            data = zlib.decompressobj ().decompress (data)
+            param = self.resolve (params [i]) if i < len (params) else None
+            if isinstance (param, dict):
+                data = _unpredict (data, param)
+        return data
+
+    def object (self, num):
+        """Return the object of the given number, or None."""
+        entry = self.xref.get (num)
+        if isinstance (entry, int):
+            return self.read (entry, _Parser.indirect) [0]
+        if entry is None:
+            return None
+        stream, index = entry
+        if stream not in self.object_streams:
+            self.object_streams [stream] = self.object_stream (stream)
+        data, offsets = self.object_streams [stream]
+        if index >= len (offsets):
+            raise _invalid (_("object stream index"))
+        return _Parser (data, True).value (offsets [index]) [0]
+
+    def object_stream (self, num):
+        offset = self.xref.get (num)
+        if not isinstance (offset, int):
+            raise _invalid (_("object stream"))
+        dictionary, start = self.read (offset, _Parser.indirect)
+        if start is None or not isinstance (dictionary.get (b'First'), int):
+            raise _invalid (_("object stream"))
+        data = self.stream_data (dictionary, offset + start)
+        parser = _Parser (data, True)
+        offsets = []
+        pos = 0
+        for i in range (dictionary.get (b'N', 0)):
+            _num, pos = parser.value (pos)
+            relative, pos = parser.value (pos)
+            offsets.append (dictionary [b'First'] + relative)
+        return data, offsets
+
+    def resolve (self, value):
+        """Replace a reference by the object it designates."""
+        for i in range (_max_depth):
+            if not isinstance (value, Ref):
+                return value
+            value = self.object (value.num)
+        raise _invalid (_("too many references"))
+
+    def first_page_box (self):
+        """
+        Return the CropBox, or the MediaBox, of the first page in the
+        page tree, which may be inherited from its ancestors.
+        """
+        root = self.resolve (self.trailer.get (b'Root'))
+        if not isinstance (root, dict):
+            raise _invalid (_("no document catalog"))
+        box = self.page_box (self.resolve (root.get (b'Pages')), {}, 0)
+        if box is None:
+            raise BoundingBoxError (_("no page size was found"))
+        return box
+
+    def page_box (self, node, inherited, depth):
+        if not isinstance (node, dict) or depth > _max_depth:
+            return None
+        inherited = dict (inherited)
+        for name in (b'CropBox', b'MediaBox'):
+            if name in node:
+                inherited [name] = node [name]
+        kids = self.resolve (node.get (b'Kids'))
+        if node.get (b'Type') != b'Pages' and not isinstance (kids, list):
+            for name in (b'CropBox', b'MediaBox'):
+                box = self.resolve (inherited.get (name))
+                if box is not None:
+                    return self.box (box)
+            return None
+        for kid in kids or []:
+            box = self.page_box (self.resolve (kid), inherited, depth + 1)
+            if box is not None:
+                return box
+        return None
+
+    def box (self, value):
+        if isinstance (value, list):
+            value = [self.resolve (x) for x in value]
+            if len (value) == 4 and all (isinstance (x, (int, float))
+                                         and not isinstance (x, bool)
+                                         for x in value):
+                return tuple (float (x) for x in value)
+        raise _invalid (_("page box"))
+
+def pdf_bbox (stream):
+    """Return the box of the first page of a PDF file and its version."""
+    stream.seek (0)
+    version = re.match (rb'%PDF-(\d\.\d)', stream.read (16))
+    version = version.group (1).decode ('ascii') if version else None
+    try:
+        box = _Document (stream).first_page_box ()
+    except (ValueError, TypeError, KeyError, IndexError, zlib.error) as e:
+        raise _invalid (e)
+    return box, version
+
+#--  Bitmaps  {{{1
+
+def _size_box (width, height, xdpi, ydpi):
+    return (0., 0., width * 72. / xdpi, height * 72. / ydpi)
+
+def png_size (stream):
+    """
+    Return the width and height in pixels of a PNG image, and its
+    horizontal and vertical resolutions in dots per inch (72 if absent).
+    """
+    stream.seek (8)
+    size = None
+    xdpi = ydpi = 72.
+    while True:
+        head = stream.read (8)
+        if len (head) < 8:
+            break
+        length, kind = struct.unpack ('>I4s', head)
+        if kind == b'IHDR':
+            size = struct.unpack ('>II', stream.read (8))
+            length -= 8
+        elif kind == b'pHYs':
+            x, y, unit = struct.unpack ('>IIB', stream.read (9))
+            length -= 9
+            if unit == 1 and x and y:
+                xdpi, ydpi = x * 0.0254, y * 0.0254
+        elif kind in (b'IDAT', b'IEND'):
+            break
+        stream.seek (length + 4, os.SEEK_CUR)
+    if size is None:
+        raise BoundingBoxError (_("no IHDR chunk was found"))
+    return size [0], size [1], xdpi, ydpi
+
+def png_bbox (stream):
+    """Return the box of a PNG image, at its resolution or 72 dpi."""
+    return _size_box (*png_size (stream))
+
+# The markers of JPEG segments without length.
+_standalone = {0x01} | set (range (0xd0, 0xd9))
+# The start of frame markers.
+_sof = set (range (0xc0, 0xd0)) - {0xc4, 0xc8, 0xcc}
+
+def jpeg_size (stream):
+    """Return the size and the resolution of a JPEG image, as png_size."""
+    stream.seek (2)
+    xdpi = ydpi = 72.
+    while True:
+        byte = stream.read (1)
+        if byte != b'\xff':
+            break
+        marker = stream.read (1)
+        while marker == b'\xff':
+            marker = stream.read (1)
+        if not marker:
+            break
+        marker = marker [0]
+        if marker in _standalone:
+            continue
+        length = stream.read (2)
+        if len (length) < 2:
+            break
+        length = struct.unpack ('>H', length) [0] - 2
+        if marker == 0xe0:
+            data = stream.read (length)
+            if data.startswith (b'JFIF\0') and len (data) >= 12:
+                unit, x, y = struct.unpack ('>BHH', data [7:12])
+                if unit in (1, 2) and x and y:
+                    scale = 2.54 if unit == 2 else 1.
+                    xdpi, ydpi = x * scale, y * scale
+        elif marker in _sof:
+            height, width = struct.unpack ('>xHH', stream.read (5))
+            return width, height, xdpi, ydpi
+        elif marker == 0xda:
+            break
+        else:
+            stream.seek (length, os.SEEK_CUR)
+    raise BoundingBoxError (_("no frame header was found"))
+
+def jpeg_bbox (stream):
+    """Return the box of a JPEG image, at its resolution or 72 dpi."""
+    return _size_box (*jpeg_size (stream))
+
+def bitmap_size (path):
+    """
+    Return the size and the resolution of a PNG or JPEG image, as
+    png_size.  Raise OSError or BoundingBoxError.
+    """
+    with open (path, 'rb') as stream:
+        magic = stream.read (8)
+        try:
+            if magic.startswith (b'\x89PNG\r\n\x1a\n'):
+                return png_size (stream)
+            if magic.startswith (b'\xff\xd8'):
+                return jpeg_size (stream)
+        except struct.error:
+            raise BoundingBoxError (_("truncated image"))
+    raise BoundingBoxError (_("unknown file format"))
+
+#--  Interface  {{{1
+
+def bounding_box (path):
+    """
+    Return the bounding box of a figure, its high resolution bounding box
+    (or None if the first one is exact) and the PDF version (or None).
+    Raise OSError or BoundingBoxError.
+    """
+    with open (path, 'rb') as stream:
+        magic = stream.read (8)
+        stream.seek (0)
+        if magic.startswith (b'\x1f\x8b'):
+            with gzip.open (stream) as data:
+                box, hires = ps_bbox (data, None)
+            return box, hires, None
+        if magic.startswith (b'%!') or magic.startswith (b'\xc5\xd0\xd3\xc6'):
+            box, hires = ps_bbox (stream, os.fstat (stream.fileno ()).st_size)
+            return box, hires, None
+        if magic.startswith (b'%PDF'):
+            box, version = pdf_bbox (stream)
+            return box, box, version
+        if magic.startswith (b'\x89PNG\r\n\x1a\n'):
+            box = png_bbox (stream)
+            return box, box, None
+        if magic.startswith (b'\xff\xd8'):
+            box = jpeg_bbox (stream)
+            return box, box, None
+    raise BoundingBoxError (_("unknown file format"))
+
+def _integer_box (box):
+    """
+    Round a box outwards, ignoring the errors of the conversion of the
+    resolution of bitmaps.
+    """
+    llx, lly, urx, ury = (round (x, 3) for x in box)
+    return '%d %d %d %d' % (math.floor (llx), math.floor (lly),
+                            math.ceil (urx), math.ceil (ury))
+
+def bbox_file (source, box, hires, version, extended):
+    """
+    Return the contents of the .bb file, or of the .xbb file if extended
+    is true, describing a figure.  The title is the name of the source as
+    stored by the file system, whatever its characters.
+    """
+    lines = ['%%Creator: rubber',
+             '%%BoundingBox: ' + _integer_box (box)]
+    if hires is not None and (extended or hires != box):
+        lines.append ('%%HiResBoundingBox: ' + ' '.join ('%f' % x for x in hires))
+    if extended and version is not None:
+        lines.append ('%%PDFVersion: ' + version)
+    return b'%%Title: ' + os.fsencode (source) + b'\n' \
+        + ''.join (line + '\n' for line in lines).encode ('ascii')
+
+class Dep (rubber.depend.Node):
+
+    def __init__ (self, target, source):
+        super ().__init__ ()
+        self.add_product (target)
+        self.add_source (source)
+        self.source = source
+        self.target = target
+
+    def artifact_key (self):
+        if rubber.cache.artifacts is None:
+            return None
+        return rubber.cache.key ('bbox', format_version, self.target,
+                                 rubber.contents.snapshot (self.source))
+
+    def run (self):
+        key = self.artifact_key ()
+        if key is not None and rubber.cache.artifacts.restore (key) is not None:
+            msg.info (_("%s restored from the artifact cache"), self.target)
+            return True
+        msg.info (_("extracting bounding box from %s"), self.source)
+        try:
+            box, hires, version = bounding_box (self.source)
+        except (OSError, EOFError, struct.error, BoundingBoxError) as e:
+            if not self.extractbb ():
+                msg.error (_("cannot find the bounding box of %s: %s"),
+                           self.source, e)
+                return False
+        else:
+            data = bbox_file (self.source, box, hires, version,
+                              self.target.endswith ('.xbb'))
+            self.write_target (lambda target: target.write (data) == len (data))
+        if key is not None:
+            rubber.depend.save_artifacts (self, key)
+        return True
+
+    def extractbb (self):
+        """
+        Run extractbb on a PDF file that bounding_box cannot read, and
+        return true on success.
+        """
+        if not self.source.endswith ('.pdf') \
+           or not rubber.util.prog_available ('extractbb'):
+            return False
+        command = ['extractbb', '-O']
+        if not self.target.endswith ('.xbb'):
+            command.append ('-m')
+        command.append (self.source)
+        msg.info (_("running: %s"), ' '.join (command))
+        return self.write_target (lambda target: subprocess.call (
+            command, stdin=subprocess.DEVNULL, stdout=target) == 0)
+
+    def write_target (self, write):
+        """
+        Call write on a temporary file open for writing bytes, and rename
+        it as the target if it returns true, which is returned.  So an
+        interrupted or failed run never leaves a partial target, which
+        would be up to date on the next run.
+        """
+        fd, tmp = tempfile.mkstemp (
+            dir=os.path.dirname (self.target) or '.',
+            prefix='.' + os.path.basename (self.target) + '-')
+        try:
+            rubber.util.set_replacement_mode (fd, self.target)
+            with open (fd, 'wb') as target:
+                done = write (target)
+            if done:
+                os.replace (tmp, self.target)
+        finally:
+            if os.path.exists (tmp):
+                os.remove (tmp)
+        return done
+
+def convert (source, target, context, env):
+    return Dep (target, source)
@@ -2,19 +2,147 @@
 # (c) Nicolas Boulenguez 2015
 """
 Compressing the output of Rubber.
+
+The codecs are those of the gzip, bz2 and lzma modules of the standard
+library.  When more than one job is allowed (see the option --jobs), gzip
+and bzip2 compress independent blocks in parallel threads, and write them
+as a concatenation of members, which gunzip and bunzip2 decompress as a
+single file.
 """
 
+import collections
+import concurrent.futures
+import importlib
 import logging
 msg = logging.getLogger (__name__)
+import shutil
 from rubber.util import _
 import rubber.depend
 
+# For each codec, the extension of the compressed files, the module
+# implementing it, its class of compressed files, the name of the
+# keyword argument of the level, the range of levels and the default.
+codecs = {
+    'gzip':  ('.gz',  'gzip', 'GzipFile',  'compresslevel', range (0, 10), 9),
+    'bzip2': ('.bz2', 'bz2',  'BZ2File',   'compresslevel', range (1, 10), 9),
+    'xz':    ('.xz',  'lzma', 'LZMAFile',  'preset',        range (0, 10), 6),
+}
+
+# The codecs which may compress blocks in parallel.
+parallel_codecs = ('gzip', 'bzip2')
+
+# The size of the blocks compressed in parallel, and of the blocks copied.
+block_size = 4 * 1024 * 1024
+
+def parse (value):
+    """
+    Parse a CODEC[:LEVEL] specification, and return (codec, level), where
+    level is None for the default.  Raise ValueError if it is invalid.
+    """
+    codec, sep, level = value.partition (':')
+    if codec not in codecs:
+        raise ValueError (_("unknown codec %s, expected one of %s")
+                          % (codec, ', '.join (codecs)))
+    if not sep:
+        return codec, None
+    levels = codecs [codec][4]
+    try:
+        level = int (level)
+    except ValueError:
+        level = None
+    if level not in levels:
+        raise ValueError (_("the level of %s must be between %i and %i")
+                          % (codec, levels [0], levels [-1]))
+    return codec, level
+
+class Compressor:
+    """
+    A codec with a compression level.  Calling it like gzip.GzipFile
+    opens a compressed file for writing.
+    """
+    def __init__ (self, codec, level=None):
+        self.codec = codec
+        self.extension, module, cls, self.keyword, levels, default \
+            = codecs [codec]
+        self.level = default if level is None else level
+        try:
+            self.module = importlib.import_module (module)
+        except ImportError:
+            raise rubber.GenericError (
+                _("the Python module %s, needed by %s, is not available")
+                % (module, codec))
+        self.file_class = getattr (self.module, cls)
+
+    def compress (self, data):
+        """Return data compressed as a complete member."""
+        return self.module.compress (data, **{self.keyword: self.level})
+
+    def __call__ (self, path, mode='wb'):
+        assert mode == 'wb'
+        threads = rubber.depend.jobs
+        if threads > 1 and self.codec in parallel_codecs:
+            return BlockWriter (path, self.compress, threads)
+        return self.file_class (path, mode, **{self.keyword: self.level})
+
+class BlockWriter:
+    """
+    A file compressing what is written to it by blocks of block_size
+    bytes, compressed in parallel threads as independent members, and
+    written in order.
+    """
+    def __init__ (self, path, compress, threads):
+        self.file = open (path, 'wb')
+        self.compress = compress
+        self.threads = threads
+        self.executor = concurrent.futures.ThreadPoolExecutor (
+            max_workers=threads)
+        self.pending = collections.deque ()
+        self.buffer = bytearray ()
+        self.blocks = 0
+
+    def __enter__ (self):
+        return self
+
+    def __exit__ (self, exc_type, exc_value, traceback):
+        self.close ()
+
+    def write (self, data):
+        self.buffer += data
+        while len (self.buffer) >= block_size:
+            self.submit (bytes (self.buffer [:block_size]))
+            del self.buffer [:block_size]
+        return len (data)
+
+    def submit (self, block):
+        self.pending.append (self.executor.submit (self.compress, block))
+        self.blocks += 1
+        # Keep every thread busy, but bound the memory used by the
+        # blocks waiting to be written.
+        while len (self.pending) > 2 * self.threads:
+            self.file.write (self.pending.popleft ().result ())
+
+    def close (self):
+        if self.file.closed:
+            return
+        try:
+            # An empty input still gives a valid compressed file.
+            if self.buffer or not self.blocks:
+                self.submit (bytes (self.buffer))
+                self.buffer.clear ()
+            while self.pending:
+                self.file.write (self.pending.popleft ().result ())
+        finally:
+            for future in self.pending:
+                future.cancel ()
+            self.executor.shutdown ()
+            self.file.close ()
+
 class Node (rubber.depend.Node):
 
-    def __init__ (self, constructor, extension, source):
+    def __init__ (self, compressor, source):
         super ().__init__ ()
-        self.constructor = constructor
-        self.target = source + extension
+        self.compressor = compressor
+        self.target = source + compressor.extension
         self.source = source
         self.add_product (self.target)
         self.add_source (source)
@@ -23,9 +151,9 @@ class Node (rubber.depend.Node):
         msg.info (_("compressing %s into %s") % (self.source, self.target))
         try:
             with open (self.source, 'rb') as f_in:
-                with self.constructor (self.target, 'wb') as f_out:
-                    f_out.writelines (f_in)
-        except:
-            msg.error (_ ("compression failed"))
+                with self.compressor (self.target, 'wb') as f_out:
+                    shutil.copyfileobj (f_in, f_out, block_size)
+        except Exception as e:
+            msg.error (_ ("compression failed: %s"), e)
             return False
         return True
@@ -0,0 +1,101 @@
+# This file is covered by the GPL as part of Rubber.
+# vim: noet:ts=4
+"""
+Low resolution copies of bitmaps, for fast draft builds.
+
+With --draft-graphics, the graphics module asks for a copy of each PNG or
+JPEG figure under the directory returned by directory(), whose name holds
+the limit in pixels of the copies, and LaTeX searches this directory before
+the others.  Each copy is reduced with 'convert' (from ImageMagick) so that
+its largest side fits the limit, and its resolution is reduced in the same
+ratio, so that the figure keeps its natural size and LaTeX lays out the
+document exactly as with the original.
+
+The copies are kept in the artifact cache under the checksum of the
+original and the limit.  Without --draft-graphics, the directory is not
+searched, so the copies are never used.
+"""
+
+import logging
+msg = logging.getLogger (__name__)
+import os.path
+import shutil
+from rubber.util import _, prog_available
+import rubber.cache
+import rubber.contents
+import rubber.converters.bbox
+import rubber.depend
+import rubber.util
+
+root = '.rubber-draft'
+
+def directory (limit):
+    """Return the directory of the copies reduced to limit pixels."""
+    return os.path.join (root, str (limit))
+
+def proxy (path, limit):
+    """
+    Return the path of the copy of the bitmap path, or None if LaTeX
+    could not find it in the directory of the copies.
+    """
+    path = os.path.normpath (path)
+    if os.path.isabs (path) or path.split (os.sep) [0] == os.pardir:
+        return None
+    return os.path.join (directory (limit), path)
+
+class Proxy (rubber.depend.Shell):
+
+    def __init__ (self, target, source, limit):
+        super ().__init__ (('convert', source, target))
+        self.add_product (target)
+        self.add_source (source)
+        self.source = source
+        self.target = target
+        self.limit = limit
+        self.rule = 'draft'
+
+    def artifact_key (self):
+        if rubber.cache.artifacts is None:
+            return None
+        return rubber.cache.key ('draft', self.limit, self.target,
+                                 rubber.cache.tool_identity ('convert'),
+                                 rubber.contents.snapshot (self.source))
+
+    def run (self):
+        os.makedirs (os.path.dirname (self.target), exist_ok=True)
+        if self.restore_artifacts ():
+            return True
+        try:
+            width, height, xdpi, ydpi = \
+                rubber.converters.bbox.bitmap_size (self.source)
+        except (OSError, rubber.converters.bbox.BoundingBoxError) as e:
+            msg.error (_("cannot read the size of %s: %s"), self.source, e)
+            return False
+        scale = self.limit / max (width, height)
+        if scale >= 1:
+            shutil.copyfile (self.source, self.target)
+            self.save_artifacts ()
+            return True
+        new_width = max (1, round (width * scale))
+        new_height = max (1, round (height * scale))
+        density = '%fx%f' % (xdpi * new_width / width,
+                             ydpi * new_height / height)
+        self.command = ('convert', self.source,
+                        '-resize', '%ix%i!' % (new_width, new_height),
+                        '-units', 'PixelsPerInch', '-density', density,
+                        self.target)
+        msg.info (_("reducing %s to %ix%i pixels"),
+                  self.source, new_width, new_height)
+        if rubber.util.execute (self.command) != 0 \
+           or not os.path.exists (self.target):
+            msg.error (_("convert failed on %s"), self.source)
+            return False
+        self.save_artifacts ()
+        return True
+
+def check (source, target, context):
+    return prog_available ('convert')
+
+def convert (source, target, context, env):
+    limit = int (os.path.relpath (target, root).split (os.sep, 1) [0])
+    return Proxy (target, source, limit)
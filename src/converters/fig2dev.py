@@ -25,6 +25,7 @@ def convert (source, target, context, env):
 
         language = target[target.rfind('.')+1:]
         result = Shell (('fig2dev', '-L', language, source, target))
+        result.rule = context ['name']
         result.add_product (target)
         result.add_source (source)
         return result
@@ -49,11 +50,13 @@ def convert (source, target, context, env):
             image_file = base_name + '.eps'
 
         temp = Shell (('fig2dev', '-L', language, source, image_file))
+        temp.rule = context ['name']
         temp.add_product (image_file)
         temp.add_source (source)
 
         result = Shell (('fig2dev', '-L', language + '_t',
                          '-p', image_reference, source, target))
+        result.rule = context ['name']
         result.add_product (target)
         result.add_source (source)
         result.add_source (image_file)
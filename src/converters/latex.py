@@ -16,8 +16,11 @@ import logging
 msg = logging.getLogger (__name__)
 import rubber.util
 from rubber.util import _, parse_line
+import rubber.cache
 import rubber.depend
 import rubber.contents
+import rubber.converters.draft
+import rubber.dircache
 import rubber.latex_modules
 
 from rubber.tex import EOF, OPEN, SPACE, END_LINE
@@ -73,7 +76,7 @@ class Modules:
         ]
         for path in rub_searchpath:
             file = os.path.join(path, name + ".rub")
-            if os.path.exists(file):
+            if rubber.dircache.exists (file):
                 msg.error (rubber.util._format ({'file':file},
                     'Ignoring %s. Please contact the authors for a replacement.' % file))
         for directory in (
@@ -81,10 +84,10 @@ class Modules:
             "/usr/local/share/rubber/latex_modules",
             "/usr/share/rubber/latex_modules",
         ):
-            path = os.path.join(path, name + ".py")
-            if (os.path.exists (path)):
+            file = os.path.join (directory, name + ".py")
+            if rubber.dircache.exists (file):
                 msg.error (rubber.util._format ({'file':file},
-                    'Ignoring %s. Please contact the authors for a replacement.' % path))
+                    'Ignoring %s. Please contact the authors for a replacement.' % file))
 
         # Import the built-in python module, if any.
 
@@ -511,14 +514,22 @@ class SourceParser (rubber.tex.Parser):
         return False
 
     def skip_until (self, expr):
+        """
+        Skip the input lines until one matches expr, and continue after
+        the match.  Return the list of the skipped lines, for verbatim
+        environments whose content matters.
+        """
         regexp = re.compile(expr)
+        skipped = []
         while rubber.tex.Parser.read_line(self):
             match = regexp.match(self.line)
             if match is None:
+                skipped.append (self.line)
                 continue
             self.line = self.line[match.end():]
             self.pos_char += match.end()
-            return
+            return skipped
+        return skipped
 
 class EndDocument (Exception):
     """ This is the exception raised when \\end{document} is found. """
@@ -780,6 +791,7 @@ class LaTeXDep (rubber.depend.Node):
                 file = dep.primary_product ()
                 # Do not process this source.
                 self.add_source (file)
+                rubber.depend.start (dep)
                 return file
             assert dep is None
 
@@ -1141,13 +1153,13 @@ class LaTeXDep (rubber.depend.Node):
 
     #--  Compilation steps  {{{2
 
-    def compile (self):
+    def command_line (self):
         """
-        Run one LaTeX compilation on the source. Return true on success or
-        false if errors occured.
+        Return the command line and the environment variables for one
+        LaTeX compilation, as a (list, dictionary) pair.  This has no
+        side effect, so that callers may use it to identify the
+        compilation.
         """
-        msg.info (_("compiling %s"), self.source)
-
         file = self.source()
 
         if file.find(" ") >= 0:
@@ -1155,26 +1167,18 @@ class LaTeXDep (rubber.depend.Node):
 
         cmd = [self.program]
 
-        if self.set_job:
-            if self.engine == "VTeX":
-                msg.error(_("I don't know how set the job name with VTeX."))
-            else:
-                cmd.append("-jobname=" + self.basename ())
+        if self.set_job and self.engine != "VTeX":
+            cmd.append("-jobname=" + self.basename ())
 
         specials = self.src_specials
-        if specials != "":
-            if self.engine == "VTeX":
-                msg.warning(_("I don't know how to make source specials with VTeX."))
-                self.src_specials = ""
-            elif specials == "yes":
+        if specials != "" and self.engine != "VTeX":
+            if specials == "yes":
                 cmd.append("-src-specials")
             else:
                 cmd.append("-src-specials=" + specials)
 
         if self.env.is_in_unsafe_mode_:
             cmd.append ('--shell-escape')
-        elif self.env.doc_requires_shell_:
-            msg.error (_("the document tries to run external programs which could be dangerous.  use rubber --unsafe if the document is trusted."))
 
         if self.env.synctex:
             cmd.append ("-synctex=1")
@@ -1183,8 +1187,6 @@ class LaTeXDep (rubber.depend.Node):
         # this could do arbitrary things such as enable shell escape (write18)
         if self.env.is_in_unsafe_mode_:
             cmd.extend (self.arguments)
-        elif len (self.arguments) > 0:
-            msg.error (_("the document tries to modify the LaTeX command line which could be dangerous.  use rubber --unsafe if the document is trusted."))
 
         cmd.extend (x.replace ("%s", file) for x in self.cmdline)
 
@@ -1192,17 +1194,102 @@ class LaTeXDep (rubber.depend.Node):
         # with special characters if there are any (except that ':' in paths
         # is not handled).
 
-        inputs = ":".join (self.env.path)
+        path = self.env.path
+        if self.env.draft_graphics is not None:
+            path = [rubber.converters.draft.directory (self.env.draft_graphics)] + path
+        inputs = ":".join (path)
 
         if inputs == "":
             env = {}
         else:
             inputs = inputs + ":" + os.getenv("TEXINPUTS", "")
             env = {"TEXINPUTS": inputs}
+        return cmd, env
+
+    def compile (self):
+        """
+        Run one LaTeX compilation on the source. Return true on success or
+        false if errors occured.
+        """
+        msg.info (_("compiling %s"), self.source ())
+
+        if self.engine == "VTeX":
+            if self.set_job:
+                msg.error(_("I don't know how set the job name with VTeX."))
+            if self.src_specials != "":
+                msg.warning(_("I don't know how to make source specials with VTeX."))
+                self.src_specials = ""
+
+        if not self.env.is_in_unsafe_mode_:
+            if self.env.doc_requires_shell_:
+                msg.error (_("the document tries to run external programs which could be dangerous.  use rubber --unsafe if the document is trusted."))
+            if len (self.arguments) > 0:
+                msg.error (_("the document tries to modify the LaTeX command line which could be dangerous.  use rubber --unsafe if the document is trusted."))
+
+        cmd, env = self.command_line ()
+
+        key = self.pass_key (cmd, env)
+        if key is not None and rubber.cache.passes.restore (key) is not None:
+            msg.info (_("%s: same sources as a previous pass, restored"),
+                      self.primary_product ())
+            return self.check_compilation (cmd)
+
+        before = self.job_files ()
         if rubber.util.execute (cmd, env=env) != 0:
             msg.error(_("Running %s resulted in a non-zero exit status."), cmd [0])
             return False
 
+        if not self.check_compilation (cmd):
+            return False
+        if key is not None:
+            after = self.job_files ()
+            written = set (path for path in after
+                           if before.get (path) != after [path])
+            written.update (path for path in self.products ()
+                            if path in after)
+            rubber.cache.passes.insert (key, sorted (written))
+        return True
+
+    def pass_key (self, cmd, env):
+        """
+        Return the key of the next compilation in the cache of passes,
+        or None if it must not be memoized.  With shell escape, LaTeX may
+        run anything and write anywhere, so the outputs are unknown.
+        The files read by LaTeX without being declared as sources (for
+        example, the installed packages) are not part of the key.
+        """
+        if rubber.cache.passes is None or self.env.is_in_unsafe_mode_:
+            return None
+        return rubber.cache.key (
+            cmd, sorted (env.items ()), rubber.cache.tool_identity (cmd [0]),
+            tuple ((path, rubber.contents.snapshot (path))
+                   for path in self.sources))
+
+    def job_files (self):
+        """
+        Return a dictionary mapping the files named after the job to
+        their size and modification time, so that the files written by a
+        compilation can be found, including those not declared as
+        products (.idx, .glo...).
+        """
+        directory, prefix = os.path.split (self.basename ())
+        prefix += '.'
+        result = {}
+        try:
+            for entry in os.scandir (directory or '.'):
+                if entry.name.startswith (prefix) and entry.is_file ():
+                    st = entry.stat ()
+                    result [os.path.join (directory, entry.name)] = \
+                        (st.st_size, st.st_mtime_ns)
+        except OSError:
+            pass
+        return result
+
+    def check_compilation (self, cmd):
+        """
+        Read the log of the last compilation, and return true if it
+        succeeded.
+        """
         if not self.parse_log ():
             msg.error(_("Running %s failed.") % cmd[0])
             return False
@@ -1268,6 +1355,9 @@ class LaTeXDep (rubber.depend.Node):
         for mod in self.modules.objects.values():
             mod.clean()
 
+    def tools (self):
+        return (self.program,)
+
     #--  Building routine  {{{2
 
     def run (self):
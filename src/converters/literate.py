@@ -7,7 +7,9 @@ Literate programming support for Rubber.
 Nodes to make the main TeX file.
 """
 
+import os
 import rubber.depend
+import rubber.worker
 
 class LHSDep (rubber.depend.Pipe):
 
@@ -26,11 +28,36 @@ class CWebDep (rubber.depend.Shell):
         self.add_product (base + ".scn")
         self.add_source (source)
 
+# The program run by the knitr worker, see rubber.worker.  Each request
+# is a working directory and a source separated by a tab.
+knitr_worker = (
+    'library(knitr); con <- file("stdin", "r"); '
+    'while (length(request <- readLines(con, n = 1)) > 0) { '
+    'fields <- strsplit(request, "\t", fixed = TRUE)[[1]]; '
+    'status <- tryCatch({ setwd(fields[1]); '
+    'knit(fields[2], envir = new.env()); 0L }, '
+    'error = function(e) { message(conditionMessage(e)); 1L }); '
+    'cat(sprintf("\nrubber-worker: %d\n", status)); flush(stdout()) }')
+
 class KnitrDep (rubber.depend.Shell):
 
     def __init__ (self, target, source):
         super ().__init__ (('R', '-e', 'library(knitr); knit("%s")' % source))
+        self.source = source
         self.add_source (source)
         self.add_product (target)
 
+    def run (self):
+        if rubber.worker.enabled and '\t' not in os.getcwd () + self.source:
+            result = rubber.worker.request (
+                rubber.worker.socket_path (self.source),
+                ('R', '--slave', '-e', knitr_worker),
+                os.getcwd () + '\t' + self.source)
+            if result is not None:
+                return result
+        return super ().run ()
+
+    def clean (self):
+        rubber.worker.stop (rubber.worker.socket_path (self.source))
+
 literate_preprocessors = { ".lhs": LHSDep, ".w": CWebDep, ".Rtex": KnitrDep }
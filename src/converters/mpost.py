@@ -14,6 +14,7 @@ import re
 import logging
 msg = logging.getLogger (__name__)
 from rubber.util import _, prog_available
+import rubber.cache
 import rubber.depend
 import rubber.converters.latex
 
@@ -154,13 +155,26 @@ class Dep (rubber.depend.Node):
                 if m:
                     self.include (m.group ("file"))
 
+    def tools (self):
+        return (self.cmd [0],)
+
     def run (self):
         """
         Run Metapost from the source file's directory, so that figures are put
         next to their source file.
         """
+        key = None
+        if rubber.cache.artifacts is not None:
+            key = rubber.depend.artifact_key (self, 'mpost',
+                self.cmd + sorted (self.penv.items ()))
+            if rubber.cache.artifacts.restore (key) is not None:
+                msg.info (_("figures of %s restored from the artifact cache"),
+                          self.base + ".mp")
+                return True
         msg.info (_("running Metapost on %s"), self.base + ".mp")
         if rubber.util.execute (self.cmd, env=self.penv, pwd=self.cmd_pwd) == 0:
+            if key is not None:
+                rubber.depend.save_artifacts (self, key)
             return True
 
         # This creates a log file that has the same aspect as TeX logs.
@@ -8,17 +8,60 @@ The action of this rule is defined by variables specified in the rule file:
    other variables are substituted,
 - "source" is the input file name,
 - "target" is the output file name.
+
+The rule may also define a command making many targets in one process:
+- "batch_command" is a command line where $sources is replaced by the list
+   of sources, and $format by the suffix of the targets without the dot;
+   each target must be named as its source with this suffix,
+- "batch" is the maximal number of sources for one process (50 by default).
 """
 
+import os.path
 from rubber.util import parse_line, prog_available
-from rubber.depend import Shell
+from rubber.depend import Batch, Shell
 
 def check (source, target, context):
-    line = parse_line(context['command'], context)
-    return prog_available(line[0])
+    # The program is almost always given literally, and prog_available
+    # remembers its answers, so the command line is seldom parsed.
+    program = context ['command'].split (None, 1) [0]
+    if '$' in program or '"' in program:
+        program = parse_line (context ['command'], context) [0]
+    return prog_available (program)
 
 def convert (source, target, context, env):
     result = Shell (parse_line (context ['command'], context))
+    result.rule = context ['name']
     result.add_product (target)
     result.add_source (source)
+    if 'batch_command' in context:
+        join_batch (result, source, target, context, env)
     return result
+
+# Stands for the list of sources while parsing batch commands.
+_sources = '\0sources'
+
+def join_batch (node, source, target, context, env):
+    """
+    Add the node to the batch of its rule and target format, if the batch
+    command applies to it.
+    """
+    stem, suffix = os.path.splitext (target)
+    if os.path.splitext (source) [0] != stem:
+        return
+    vars = context.copy ()
+    vars ['format'] = suffix [1:]
+    vars ['sources'] = _sources
+    command = parse_line (context ['batch_command'], vars)
+    if not prog_available (command [0]):
+        return
+    command = tuple (None if arg == _sources else arg for arg in command)
+    key = (context ['name'], command)
+    try:
+        batch = env.batches [key]
+    except KeyError:
+        try:
+            size = int (context ['batch'])
+        except (KeyError, ValueError):
+            size = 50
+        batch = env.batches [key] = Batch (command, size)
+    batch.add (node)
@@ -3,11 +3,18 @@ This module contains code for handling dependency graphs.
 """
 # vim: noet:ts=4
 
+import concurrent.futures
 import logging
 msg = logging.getLogger (__name__)
 import os.path
+import shutil
 import subprocess
+import tempfile
+import threading
+import rubber.cache
 import rubber.contents
+import rubber.dircache
+import rubber.util
 from rubber.util import _
 
 class MakeError (Exception):
@@ -20,29 +27,90 @@ class MakeError (Exception):
 # It should not be used outside this module.
 _producer = {}
 
-def clean_all_products ():
-    """Clean all products of all recipes."""
-    for path in _producer:
+# Nodes are added by the parser while nodes made in the background
+# iterate over _producer, and concurrent threads may start making the
+# same node, so both are done with this lock held.
+_producer_lock = threading.RLock ()
+
+def clean_all_products (keep=()):
+    """Clean all products of all recipes, except the paths in keep."""
+    with _producer_lock:
+        paths = [path for path in _producer if path not in keep]
+    for path in paths:
         if os.path.exists (path):
             msg.info (_("removing %s"), path)
             os.remove (path)
 
+# The maximal number of nodes made at the same time, see make_together.
+jobs = 1
+
+# The cache file saved by flush_cache, as a (path, final node) pair, or
+# None, and whether a node was rebuilt since it was last saved.
+_cache_file = None
+_cache_changed = False
+
+# Guards _cache_changed, set by nodes made in concurrent threads.
+_cache_lock = threading.Lock ()
+
+def save_cache_on_exit (cache_path, final):
+    """
+    Make flush_cache save the cache file, with the nodes rebuilt until
+    then, so that the work done before a failure is not lost.  Saving
+    it after each node would write it N times for N nodes.
+    """
+    global _cache_file
+    _cache_file = (cache_path, final)
+
+def flush_cache ():
+    """
+    Save the cache file given to save_cache_on_exit, if a node was
+    rebuilt since it was last saved.
+    """
+    global _cache_changed
+    with _cache_lock:
+        if _cache_file is not None and _cache_changed:
+            save_cache (*_cache_file)
+            _cache_changed = False
+
+def _rebuilt ():
+    global _cache_changed
+    with _cache_lock:
+        _cache_changed = True
+
 def save_cache (cache_path, final):
     msg.debug (_('Creating or overwriting cache file %s') % cache_path)
-    with open (cache_path, 'tw') as f:
-        for node in final.all_producers ():
-            if node.snapshots is not None:
-                f.write (node.primary_product ())
+    # A reader, or a crash, must never see a truncated file.
+    fd, tmp = tempfile.mkstemp (dir=os.path.dirname (cache_path) or '.',
+                                prefix='.rubbercache-')
+    try:
+        rubber.util.set_replacement_mode (fd, cache_path)
+        with open (fd, 'tw') as f:
+            write_cache (f, final)
+        os.replace (tmp, cache_path)
+    except:
+        os.remove (tmp)
+        raise
+
+def write_cache (f, final):
+    for node in final.all_producers ():
+        if node.snapshots is not None:
+            f.write (node.primary_product ())
+            f.write ('\n')
+            # Sources added by the last run have no snapshot yet.
+            for source, snapshot in zip (node.sources, node.snapshots):
+                f.write ('  ')
+                f.write (rubber.contents.cs2str (snapshot))
+                f.write (' ')
+                f.write (source)
                 f.write ('\n')
-                for i in range (len (node.sources)):
-                    f.write ('  ')
-                    f.write (rubber.contents.cs2str (node.snapshots [i]))
-                    f.write (' ')
-                    f.write (node.sources [i])
-                    f.write ('\n')
 
-def load_cache (cache_path):
+def read_cache (cache_path):
+    """
+    Return a dictionary mapping the products in the cache file to the
+    sources and snapshots of their last successful build.
+    """
     msg.debug (_('Reading external cache file %s') % cache_path)
+    result = {}
     with open (cache_path) as f:
         line = f.readline ()
         while line:
@@ -56,20 +124,167 @@ def load_cache (cache_path):
                 limit = 2 + rubber.contents.cs_str_len
                 snapshots.append (rubber.contents.str2cs (line [2:limit]))
                 sources.append (line [limit + 1:-1])
-            try:
-                node = _producer [product]
-            except KeyError:
-                msg.debug (_('%s: no such recipe anymore') % product)
-            else:
-              if node.sources != sources:
-                msg.debug (_('%s: depends on %s not anymore on %s'), product,
-                    " ".join (node.sources), " ".join (sources))
-              elif node.snapshots is not None:
-                # FIXME: this should not happen. See cweb-latex test.
-                msg.debug (_('%s: rebuilt before cache read'), product)
-              else:
-                msg.debug (_('%s: using cached checksums'), product)
-                node.snapshots = snapshots
+            result [product] = (sources, snapshots)
+    return result
+
+def load_cache (cache_path):
+    for product, (sources, snapshots) in read_cache (cache_path).items ():
+        try:
+            node = _producer [product]
+        except KeyError:
+            msg.debug (_('%s: no such recipe anymore') % product)
+        else:
+            # The recipe may now produce it as a secondary product, from
+            # other files, see Pipeline.
+            if node.primary_product () == product:
+                _use_cache (node, sources, snapshots)
+
+def _use_cache (node, sources, snapshots):
+    product = node.primary_product ()
+    if node.sources != sources:
+        msg.debug (_('%s: depends on %s not anymore on %s'), product,
+            " ".join (node.sources), " ".join (sources))
+    elif node.snapshots is not None:
+        # FIXME: this should not happen. See cweb-latex test.
+        msg.debug (_('%s: rebuilt before cache read'), product)
+    else:
+        msg.debug (_('%s: using cached checksums'), product)
+        node.snapshots = snapshots
+
+# Whether the nodes passed to start are made while the document is
+# still being parsed.  This is only enabled when building.
+background = False
+
+# The contents of the cache file read before parsing, see preload_cache.
+_preloaded = {}
+
+# For each node made in the background, and each node it makes, the
+# future of this making.
+_started = {}
+
+_executor = None
+
+# Set in the threads of the executor.
+_local = threading.local ()
+
+# The nodes given to start since hold_background, or None.
+_held = None
+
+def hold_background ():
+    """
+    Keep the nodes given to start until release_background is called,
+    for instance until the build cache is checked.
+    """
+    global _held
+    _held = []
+
+def release_background (run):
+    """Start the nodes held since hold_background if run is true."""
+    global _held
+    held, _held = _held, None
+    if run and held:
+        for node in held:
+            start (node)
+
+def preload_cache (cache_path):
+    """
+    Read the cache file before parsing, so that the nodes made in the
+    background know their last successful build.  If cache_path is None
+    or does not exist, the nodes are made as on a first build.
+    """
+    global _preloaded
+    if cache_path is not None and os.path.exists (cache_path):
+        _preloaded = read_cache (cache_path)
+    else:
+        _preloaded = {}
+
+def _closure (node):
+    # Like all_producers, but stopping at the nodes being made.
+    result = set ()
+    todo = [node]
+    while todo:
+        node = todo.pop ()
+        if node in result or node.making:
+            continue
+        result.add (node)
+        for source in node.sources:
+            if source in _producer:
+                todo.append (_producer [source])
+    return result
+
+def start (node):
+    """
+    Start making node in the background, if enabled, so that external
+    conversions run while the document is parsed.  Failures are reported
+    when the node is made again, as if it was made at that time.  A node
+    sharing a producer with a node already started, or being made, is
+    left for later.
+    """
+    global _executor
+    if not background:
+        return
+    if _held is not None:
+        _held.append (node)
+        return
+    # Unlike in make_together, a producer being made is not an ancestor
+    # here but the node of another thread, which would prune it as a
+    # cyclic dependency.
+    with _producer_lock:
+        nodes = set (node.all_producers ())
+        if any (n.making or n in _started for n in nodes):
+            return
+    # The files produced by a compilation are not ready yet.
+    if any (isinstance (n, rubber.converters.latex.LaTeXDep) for n in nodes):
+        return
+    for n in nodes:
+        if n.primary_product () in _preloaded:
+            _use_cache (n, *_preloaded [n.primary_product ()])
+    if _executor is None:
+        _executor = concurrent.futures.ThreadPoolExecutor (max_workers=jobs)
+    msg.debug (_("%s: started in the background"), node.primary_product ())
+    future = _executor.submit (_make_in_thread, node, True)
+    for n in nodes:
+        _started [n] = (future, n is node)
+
+def _make_in_thread (node, in_background):
+    # The nodes made for a node started in the background must not wait
+    # for it, even in the threads of make_together.
+    _local.background = in_background
+    return node.make ()
+
+def wait_background ():
+    """
+    Wait until the nodes started in the background are made.  Their
+    failures are reported when they are made again.
+    """
+    concurrent.futures.wait ([future for future, root in _started.values ()])
+
+def artifact_key (node, rule, command):
+    """
+    Compute the key of the products of node in the artifact cache,
+    from the state of its sources and the command producing them.
+    """
+    sources = tuple ((path, rubber.contents.snapshot (path))
+                     for path in node.sources)
+    return rubber.cache.key (rule, tuple (command),
+                             rubber.cache.tool_identity (command [0]),
+                             sources, sorted (node.products ()))
+
+def products_of (nodes):
+    """
+    Return the sorted list of the products of the nodes in the given
+    iterable.  This is more efficient than calling their products
+    method in turn.
+    """
+    nodes = set (nodes)
+    with _producer_lock:
+        return sorted (path for path, node in _producer.items ()
+                       if node in nodes)
+
+def save_artifacts (node, key):
+    """Save the existing products of node in the artifact cache."""
+    rubber.cache.artifacts.insert (
+        key, [p for p in sorted (node.products ()) if os.path.exists (p)])
 
 class Node (object):
     """
@@ -93,42 +308,57 @@ class Node (object):
         self.snapshots = None
         # making is the lock guarding against making a node while making it
         self.making = False
+        # Whether this node may be made in a thread of its own, while
+        # other sources of the same node are made, see make_together.
+        self.parallel = False
 
-    def all_producers (self):
+    def all_producers (self, stop=()):
+        """
+        Yield this node and the nodes producing its sources, recursively,
+        without entering the nodes in stop.
+        """
+        # The making lock cannot be used to detect cycles here,
+        # because this may be called while making a node.
+        seen = set (stop)
         def rec (node):
-            if not node.making:
-                node.making = True
-                try:
-                    yield node
-                    for source in node.sources:
-                        try:
-                            child = _producer [source]
-                        except KeyError:
-                            pass
-                        else:
-                            yield from rec (child)
-                finally:
-                    self.making = False
+            if node not in seen:
+                seen.add (node)
+                yield node
+                for source in node.sources:
+                    try:
+                        child = _producer [source]
+                    except KeyError:
+                        pass
+                    else:
+                        yield from rec (child)
         yield from rec (self)
 
     def all_leaves (self):
         """Show sources that are not produced."""
         # We need to build a set in order to remove duplicates.
         result = set ()
-        def rec (node):
-            if not node.making:
-                node.making = True
-                try:
-                    for source in node.sources:
-                        if source in _producer:
-                            rec (_producer [source])
-                        else:
-                            result.add (source)
-                finally:
-                    self.making = False
-        rec (self)
+        for node in self.all_producers ():
+            for source in node.sources:
+                if source not in _producer:
+                    result.add (source)
         return result
 
+    def tools (self):
+        """
+        The names of the external programs run by this node, whose
+        version may influence the products.
+        """
+        return ()
+
+    def snapshot_source (self, path):
+        """
+        Return a snapshot of a source, compared with the one taken before
+        the last run to decide whether the node must be rebuilt.  A node
+        reading only a part of a source may redefine this method, and
+        return the MD5 digest of this part, or NO_SUCH_FILE.
+        """
+        return rubber.contents.snapshot (path)
+
     def add_source (self, name):
         """
         Register a new source for this node. If the source is unknown, a leaf
@@ -151,14 +381,16 @@ class Node (object):
         """An iterable with all all products for this recipe.
         This function is not efficient, but called only once by
         cmdline.py with a specific command-line option."""
-        return (key for key, value in _producer.items () if value is self)
+        with _producer_lock:
+            return [key for key, value in _producer.items () if value is self]
 
     def add_product (self, name):
         """
         Register a new product for this node.
         """
         # TODO: why does this break? assert name not in _producer, name
-        _producer [name] = self
+        with _producer_lock:
+            _producer [name] = self
         if self.product is None:
             self.product = name
 
@@ -168,9 +400,10 @@ class Node (object):
     def replace_product (self, name):
         """Trick for latex.py"""
         # TODO: why does this break? assert name not in _producer, name
-        del _producer [self.product]
-        self.product = name
-        _producer [name] = self
+        with _producer_lock:
+            del _producer [self.product]
+            self.product = name
+            _producer [name] = self
 
     def make (self):
         """
@@ -186,12 +419,21 @@ class Node (object):
 
         pp = self.primary_product ()
 
-        if self.making:
-            msg.debug (_("%s: cyclic dependency, pruning"), pp)
-            return False
+        if _started and not getattr (_local, 'background', False) \
+           and self in _started:
+            future, root = _started.pop (self)
+            if root:
+                # Raises the MakeError of the background thread, if any.
+                return future.result ()
+            future.exception ()
+
+        with _producer_lock:
+            if self.making:
+                msg.debug (_("%s: cyclic dependency, pruning"), pp)
+                return False
+            self.making = True
 
         rv = False
-        self.making = True
         try:
             for patience in range (5):
                 msg.debug (_('%s: made from %s   attempt %i'),
@@ -199,6 +441,7 @@ class Node (object):
                            patience)
 
                 # make our sources
+                deferred = []
                 for source in self.sources:
                     try:
                         dep = _producer [source]
@@ -207,11 +450,17 @@ class Node (object):
                     else:
                         msg.debug (_("%s: needs %s, making %s"), pp, source,
                                    dep.primary_product ())
-                        rv = dep.make () or rv
+                        if jobs > 1 and dep.parallel:
+                            if dep not in deferred:
+                                deferred.append (dep)
+                        else:
+                            rv = dep.make () or rv
+                if deferred:
+                    rv = make_together (deferred) or rv
 
                 # Once all dependent recipes have been run, check the
                 # state of the sources on disk.
-                snapshots = tuple (map (rubber.contents.snapshot, self.sources))
+                snapshots = tuple (map (self.snapshot_source, self.sources))
 
                 missing = ','.join (
                     self.sources [i] for i in range (len (snapshots))
@@ -229,21 +478,27 @@ class Node (object):
                     msg.debug (_("%s: first attempt or --force, building"), pp)
                 else:
                     # There has already been a successful build.
+                    # The last run may have added sources.
                     changed = ','.join (
                         self.sources [i] for i in range (len (snapshots))
-                        if self.snapshots [i] != snapshots [i])
+                        if i >= len (self.snapshots)
+                        or self.snapshots [i] != snapshots [i])
                     if not changed:
                         msg.debug (_("%s: sources unchanged since last build"), pp)
                         return rv
                     msg.debug (_("%s: some sources changed: %s"), pp, changed)
 
-                if not self.run ():
+                success = self.run ()
+                # The run may have created or removed any file.
+                rubber.dircache.invalidate ()
+                if not success:
                     raise MakeError (_("Recipe for {} failed").format (pp),
                                      self.get_errors ())
 
                 # Build was successful.
                 self.snapshots = snapshots
                 rv = True
+                _rebuilt ()
 
             # Patience exhausted.
             raise MakeError (_("Contents of {} do not settle").format (pp),
@@ -274,6 +529,47 @@ class Node (object):
         Files registered as products are removed by rubber.clean ().
         """
 
+def make_together (nodes):
+    """
+    Make the nodes in the given list, and return true if any of them
+    was rebuilt.  Nodes that do not share any producer (except those
+    being made, which they will not make again) are made in concurrent
+    threads, at most 'jobs' at a time, then the others are made in turn.
+    """
+    independent = []
+    dependent = []
+    claimed = set ()
+    with _producer_lock:
+        for node in nodes:
+            producers = _closure (node)
+            if producers.isdisjoint (claimed):
+                independent.append (node)
+                claimed.update (producers)
+            else:
+                dependent.append (node)
+    rv = False
+    if len (independent) < 2:
+        dependent = independent + dependent
+    else:
+        msg.debug (_("making %s together"),
+                   " ".join (node.primary_product () for node in independent))
+        with concurrent.futures.ThreadPoolExecutor (max_workers=jobs) as pool:
+            in_background = getattr (_local, 'background', False)
+            futures = [pool.submit (_make_in_thread, node, in_background)
+                       for node in independent]
+        error = None
+        for future in futures:
+            try:
+                rv = future.result () or rv
+            except MakeError as e:
+                if error is None:
+                    error = e
+        if error is not None:
+            raise error
+    for node in dependent:
+        rv = node.make () or rv
+    return rv
+
 class Shell (Node):
     """
     This class specializes Node for generating files using shell commands.
@@ -282,8 +578,65 @@ class Shell (Node):
         super ().__init__ ()
         self.command = command
         self.stdout = None
+        # The name of the conversion rule that created this node, if
+        # any.  The products of such a node only depend on its
+        # sources and command, so they may be shared through the
+        # artifact cache.
+        self.rule = None
+        # The Batch this node belongs to, if any.
+        self.batch = None
+
+    def tools (self):
+        return (self.command [0],)
+
+    def artifact_key (self):
+        """
+        Return the key of the products in the artifact cache, or None
+        if they should not be cached.
+        """
+        if self.rule is None or rubber.cache.artifacts is None:
+            return None
+        return artifact_key (self, self.rule, self.command)
+
+    def batch_artifact_key (self):
+        """
+        Return the key of the products when the batch makes them, or None.
+        The batch runs another program, which may give other results.
+        """
+        if self.batch is None or self.rule is None \
+           or rubber.cache.artifacts is None:
+            return None
+        return artifact_key (self, self.rule, self.batch.member_command (self))
+
+    def restore_artifacts (self):
+        """
+        Restore the products from the artifact cache, made by the command
+        of this node or by its batch, and return true on success.
+        """
+        for key in (self.artifact_key (), self.batch_artifact_key ()):
+            if key is not None \
+               and rubber.cache.artifacts.restore (key) is not None:
+                msg.info (_("%s restored from the artifact cache"),
+                          self.primary_product ())
+                return True
+        return False
+
+    def save_artifacts (self):
+        key = self.artifact_key ()
+        if key is not None:
+            save_artifacts (self, key)
 
     def run (self):
+        if self.batch is not None:
+            return self.batch.run (self)
+        if self.restore_artifacts ():
+            return True
+        return self.execute ()
+
+    def execute (self):
+        """
+        Run the command of this node alone.
+        """
         msg.info(_("running: %s") % ' '.join(self.command))
         process = subprocess.Popen (self.command,
             stdin=subprocess.DEVNULL,
@@ -291,8 +644,138 @@ class Shell (Node):
         if process.wait() != 0:
             msg.error(_("execution of %s failed") % self.command[0])
             return False
+        self.save_artifacts ()
         return True
 
+class Batch:
+    """
+    A group of Shell nodes that a single process can make together.  The
+    command of the batch contains None where the list of sources must
+    be inserted, and this list contains at most 'size' sources.
+
+    The first member to be made also makes the other members whose
+    sources have changed, and their results are kept until they are
+    made in turn.  If the batch fails, each member is made alone, so
+    that the errors are reported for each target.
+
+    Members may be made in several threads (see start).  The members of
+    a chunk being run are claimed by it, so that the other threads wait
+    for its results instead of making them again.
+    """
+    def __init__ (self, command, size):
+        self.command = command
+        self.size = max (size, 1)
+        self.members = []
+        # Guards results and claimed.
+        self.lock = threading.Lock ()
+        self.results = {}
+        # For each member of a chunk being run, an event set when the
+        # results of the chunk are known.
+        self.claimed = {}
+
+    def add (self, node):
+        node.batch = self
+        self.members.append (node)
+
+    def member_command (self, node):
+        """Return the command of the batch for node alone."""
+        return tuple (node.sources [0] if arg is None else arg
+                      for arg in self.command)
+
+    def outdated (self, node):
+        """
+        Return true if the node may be made now: its sources are not
+        produced by other nodes (except those being made, which will not
+        change them before this node is made), exist, and changed since
+        its last run.
+        """
+        for source in node.sources:
+            producer = _producer.get (source)
+            if producer is not None and not producer.making:
+                return False
+        snapshots = tuple (map (node.snapshot_source, node.sources))
+        if rubber.contents.NO_SUCH_FILE in snapshots:
+            return False
+        return node.snapshots != snapshots
+
+    def run (self, node):
+        chunks = []
+        with self.lock:
+            if node in self.results:
+                return self.results.pop (node)
+            event = self.claimed.get (node)
+            if event is None:
+                pending = [node] + [member for member in self.members
+                                    if member is not node
+                                    and member not in self.claimed
+                                    and member not in self.results
+                                    and self.outdated (member)]
+                for i in range (0, len (pending), self.size):
+                    chunks.append (pending [i:i + self.size])
+                    event = threading.Event ()
+                    for member in chunks [-1]:
+                        self.claimed [member] = event
+        if chunks:
+            for chunk in chunks:
+                try:
+                    self.run_chunk (chunk)
+                finally:
+                    with self.lock:
+                        for member in chunk:
+                            self.claimed.pop (member).set ()
+        else:
+            msg.debug (_("%s: made by another thread"), node.primary_product ())
+            event.wait ()
+        with self.lock:
+            result = self.results.pop (node, None)
+        if result is None:
+            # The chunk that was making node was interrupted.
+            return self.run (node)
+        return result
+
+    def run_chunk (self, nodes):
+        todo = []
+        for node in nodes:
+            if node.restore_artifacts ():
+                self.set_result (node, True)
+            else:
+                todo.append (node)
+        if len (todo) < 2:
+            for node in todo:
+                self.set_result (node, node.execute ())
+            return
+        command = []
+        for arg in self.command:
+            if arg is None:
+                command.extend (node.sources [0] for node in todo)
+            else:
+                command.append (arg)
+        # A product left by a previous run would hide a failure.
+        for node in todo:
+            if os.path.exists (node.primary_product ()):
+                os.remove (node.primary_product ())
+        msg.info(_("running: %s") % ' '.join(command))
+        if subprocess.call (command, stdin=subprocess.DEVNULL) != 0:
+            msg.info (_("execution of %s failed, making each file alone"),
+                      command [0])
+            for node in todo:
+                self.set_result (node, node.execute ())
+            return
+        for node in todo:
+            if os.path.exists (node.primary_product ()):
+                key = node.batch_artifact_key ()
+                if key is not None:
+                    save_artifacts (node, key)
+                self.set_result (node, True)
+            else:
+                msg.error (_("%s did not produce %s"), command [0],
+                           node.primary_product ())
+                self.set_result (node, False)
+
+    def set_result (self, node, result):
+        with self.lock:
+            self.results [node] = result
+
 class Pipe (Shell):
     """
     This class specializes Node for generating files using the stdout of shell commands.
@@ -306,3 +789,86 @@ class Pipe (Shell):
         with open (self.primary_product (), 'bw') as self.stdout:
             ret = super (Pipe, self).run ()
         return ret
+
+def streamable (node):
+    """Whether node may be a stage of a Pipeline."""
+    stream_command = getattr (node, 'stream_command', None)
+    return stream_command is not None and stream_command () is not None
+
+class Pipeline (Node):
+    """
+    This class specializes Node for running commands connected by pipes,
+    each one reading the standard output of the previous one, so that they
+    run at the same time.  A stage may be a command, or a node whose
+    stream_command method returns a command writing its primary product on
+    the standard output, in which case the sources of the node become
+    sources of the pipeline.  The standard output of the last stage is
+    written to 'product', through 'compressor' if it is not None, which is
+    called like gzip.GzipFile.
+
+    The files that the stages would exchange in a build without pipes are
+    given as 'virtual' products: they are registered, so that this node
+    makes them and the other producers are ignored, but never written.
+    """
+    def __init__ (self, stages, product, virtual=(), compressor=None):
+        super ().__init__ ()
+        self.stages = stages
+        self.virtual = tuple (virtual)
+        self.compressor = compressor
+        self.add_product (product)
+        for path in self.virtual:
+            self.add_product (path)
+        for stage in stages:
+            if isinstance (stage, Node):
+                for source in stage.sources:
+                    if source not in self.virtual:
+                        self.add_source (source)
+
+    def commands (self):
+        return [stage.stream_command () if isinstance (stage, Node)
+                else stage for stage in self.stages]
+
+    def tools (self):
+        return tuple (command [0] for command in self.commands ())
+
+    def run (self):
+        commands = self.commands ()
+        product = self.primary_product ()
+        msg.info (_("running: %s"),
+                  ' | '.join (' '.join (command) for command in commands))
+        processes = []
+        stdin = subprocess.DEVNULL
+        try:
+            for command in commands:
+                process = subprocess.Popen (command, stdin=stdin,
+                                            stdout=subprocess.PIPE)
+                # The next stage holds the only read end of the pipe, so
+                # that the previous stage stops if the next one fails.
+                if stdin is not subprocess.DEVNULL:
+                    stdin.close ()
+                processes.append (process)
+                stdin = process.stdout
+            if self.compressor is None:
+                out = open (product, 'wb')
+            else:
+                out = self.compressor (product, 'wb')
+            with out:
+                shutil.copyfileobj (stdin, out, 1 << 20)
+        except OSError as e:
+            msg.error (_("cannot run %s: %s"), ' | '.join (
+                command [0] for command in commands), e)
+            for process in processes:
+                process.kill ()
+            success = False
+        else:
+            success = True
+        finally:
+            if stdin is not subprocess.DEVNULL:
+                stdin.close ()
+        for command, process in zip (commands, processes):
+            if process.wait () != 0 and success:
+                msg.error (_("execution of %s failed"), command [0])
+                success = False
+        if not success and os.path.exists (product):
+            os.remove (product)
+        return success
@@ -0,0 +1,144 @@
+# This file is part of Rubber and thus covered by the GPL
+# vim: noet:ts=4
+"""
+An in-memory index of the names in the directories searched for files.
+
+Looking for a figure, a module or a bibliography tries many candidate
+names in a few directories.  Instead of one stat per candidate, each
+directory is read once with os.scandir, and the names are looked up in
+memory.
+
+A listing is checked against the modification time of the directory
+when an external program may have changed the file system, that is
+after each run of a node or an external program.  Between these
+events, for example during the parsing of the document, no system call
+is needed at all.
+
+A directory modified during the tick of the clock when it was read may
+change again without a visible change of its modification time, so
+such listings are never trusted (as Git does with its index): they are
+read again on the next validation, and until then a name absent from
+them is looked up with a system call.  This also covers the files
+written by Rubber itself just after the directory was read.
+
+As with os.path.exists, a broken symbolic link does not exist.
+
+The names are compared exactly, so on a case-insensitive file system a
+name differing only by case from an existing file is not found.
+"""
+
+import os
+import stat
+import threading
+import time
+
+# The number of times the file system may have changed.
+_generation = 0
+
+# For each directory, a list [generation, mtime, names, extensions] where
+# names maps each entry to True for regular files (after symbolic links)
+# and False for other types, and extensions is the set of the parts of
+# the names after their last dot, computed when first needed.  The mtime
+# is None if the listing must be read again.
+_directories = {}
+
+# Directories modified less than this (in nanoseconds) before they are
+# read are read again on the next validation.
+_racy_delay = 2 * 10**9
+
+# The nodes made in concurrent threads look up and invalidate the
+# listings together.
+_lock = threading.Lock ()
+
+def invalidate ():
+    """
+    Record that the file system may have been modified, so that the
+    listings must be checked again before their next use.
+    """
+    global _generation
+    with _lock:
+        _generation += 1
+
+def _scan (directory):
+    names = {}
+    for entry in os.scandir (directory):
+        try:
+            if entry.is_symlink ():
+                # Fails for a broken link.
+                names [entry.name] = stat.S_ISREG (entry.stat ().st_mode)
+            else:
+                names [entry.name] = entry.is_file ()
+        except OSError:
+            pass
+    return names
+
+def listing (directory):
+    """
+    Return a dictionary mapping the names in the directory to True for
+    regular files, or None if directory cannot be read.
+    """
+    entry = _entry (directory)
+    return None if entry is None else entry [2]
+
+def _entry (directory):
+    """Return the valid item of _directories for directory, or None."""
+    directory = directory or os.curdir
+    with _lock:
+        return _listing (directory)
+
+def _listing (directory):
+    cached = _directories.get (directory)
+    if cached is not None and cached [0] == _generation:
+        return cached
+    try:
+        mtime = os.stat (directory).st_mtime_ns
+        if cached is not None and cached [1] == mtime:
+            cached [0] = _generation
+            return cached
+        now = time.time_ns ()
+        names = _scan (directory)
+    except OSError:
+        _directories.pop (directory, None)
+        return None
+    if now - mtime < _racy_delay:
+        mtime = None
+    cached = _directories [directory] = [_generation, mtime, names, None]
+    return cached
+
+def exists (path):
+    """Like os.path.exists, for paths in indexed directories."""
+    directory, name = os.path.split (path)
+    if name in ('', os.curdir, os.pardir):
+        return os.path.exists (path)
+    entry = _entry (directory)
+    if entry is None:
+        return False
+    if name in entry [2]:
+        return True
+    return entry [1] is None and os.path.exists (path)
+
+def has_extension (directory, extensions):
+    """
+    Return false if no name in the directory ends with a dot followed by
+    one of the extensions, as far as the listing can be trusted.
+    """
+    entry = _entry (directory)
+    if entry is None:
+        return False
+    if entry [1] is None:
+        return True
+    if entry [3] is None:
+        entry [3] = set (name [name.rfind ('.') + 1:] for name in entry [2])
+    return not entry [3].isdisjoint (extensions)
+
+def isfile (path):
+    """Like os.path.isfile, for paths in indexed directories."""
+    directory, name = os.path.split (path)
+    if name in ('', os.curdir, os.pardir):
+        return os.path.isfile (path)
+    entry = _entry (directory)
+    if entry is None:
+        return False
+    if name in entry [2]:
+        return entry [2] [name]
+    return entry [1] is None and os.path.isfile (path)
@@ -45,17 +45,36 @@ class Dvip_Tool_Dep_Node (rubber.depend.Node):
     def do_options (self, args):
         self.extra_args.extend (args)
 
-    def run (self):
-        # build command line
+    def tools (self):
+        return (self.tool,)
+
+    def command (self, output=None):
+        """
+        Return the command line, writing the product to output if it is
+        not None.
+        """
         tool = self.tool
         if tool == 'dvips' and self.doc.engine == 'Omega':
             tool = 'odvips'
         cmd = [ tool ]
         cmd.extend (self.extra_args)
+        if output is not None:
+            cmd.extend (('-o', output))
         cmd.append (self.source)
+        return cmd
 
-        # run
+    def stream_command (self):
+        """
+        Return the command line writing the product on the standard
+        output, or None if the tool cannot, see rubber.depend.Pipeline.
+        """
+        if self.tool != 'dvips':
+            return None
+        return self.command ('-')
+
+    def run (self):
+        cmd = self.command ()
         if rubber.util.execute (cmd) != 0:
-            msg.error (_('%s failed on %s') % (tool, self.source))
+            msg.error (_('%s failed on %s') % (cmd [0], self.source))
             return False
         return True
@@ -15,6 +15,7 @@ import logging
 msg = logging.getLogger (__name__)
 import rubber.converters
 from rubber.convert import Converter
+import rubber.dircache
 
 class Environment:
     """
@@ -34,9 +35,28 @@ class Environment:
 
         self.doc_requires_shell_ = False
         self.synctex = False
+        # The limit in pixels of the copies of bitmaps used instead of the
+        # originals, or None, see rubber.converters.draft.
+        self.draft_graphics = None
+        # Whether post-processing tools write to pipes instead of
+        # intermediate files, see rubber.depend.Pipeline.
+        self.streaming = False
         self.main = None
         self.final = None
         self.graphics_suffixes = []
+        # The groups of conversions made by a single process, see
+        # rubber.depend.Batch.
+        self.batches = {}
+        # The LaTeX documents built together, by absolute path of their
+        # main source, see rubber.latex_modules.xr.
+        self.documents = {}
+        # Absolute paths of directories where conversions must not write.
+        # Their files are converted into the current directory instead,
+        # under the same relative path, see rubber-pipe.
+        self.read_only_path = []
+        # Directories searched by BibTeX and makeindex before those of
+        # their environment variables, see rubber-pipe.
+        self.tool_path = []
 
     def find_file (self, name, suffix=None):
         """
@@ -46,9 +66,9 @@ class Environment:
         """
         for path in self.path:
             test = os.path.join(path, name)
-            if suffix and os.path.exists(test + suffix) and os.path.isfile(test + suffix):
+            if suffix and rubber.dircache.isfile (test + suffix):
                 return test + suffix
-            elif os.path.exists(test) and os.path.isfile(test):
+            elif rubber.dircache.isfile (test):
                 return test
         return None
 
@@ -102,7 +122,7 @@ class Environment:
 
             # Check if the target exists.
 
-            if prefs is None and os.path.exists(t):
+            if prefs is None and rubber.dircache.exists (t):
                 if last is not None and last["cost"] <= 0:
                     break
                 msg.debug(_("`%s' is `%s', no rule applied") % (target, t))
@@ -110,10 +130,40 @@ class Environment:
 
         if last is None:
             return None
+        if self.read_only_path:
+            self.relocate (last)
         msg.debug(_("`%s' is `%s', made from `%s' by rule `%s'") %
                 (target, last["target"], last["source"], last["name"]))
         return self.converter.apply(last)
 
+    def relocate (self, instance):
+        """
+        Change the targets of a rule instance, and of the instances making
+        its source, that are in a directory of read_only_path, so that
+        they are written in the current directory.
+        """
+        while instance is not None:
+            instance ['target'] = self.writable_path (instance ['target'])
+            previous = instance.get ('previous')
+            if previous is not None:
+                instance ['source'] = self.writable_path (instance ['source'])
+            instance = previous
+
+    def writable_path (self, path):
+        path = os.path.abspath (path)
+        # The current directory may be inside a read-only directory.
+        if not os.path.relpath (path).startswith (os.pardir):
+            return os.path.relpath (path)
+        for directory in self.read_only_path:
+            relative = os.path.relpath (path, directory)
+            if not relative.startswith (os.pardir):
+                parent = os.path.dirname (relative)
+                if parent:
+                    os.makedirs (parent, exist_ok=True)
+                    rubber.dircache.invalidate ()
+                return relative
+        return path
+
     def may_produce (self, name):
         """
         Return true if the given filename may be that of a file generated by
@@ -6,6 +6,7 @@ Common support for makeindex and xindy external tools.
 """
 import logging
 msg = logging.getLogger (__name__)
+import os
 import rubber.depend
 from rubber.util import _
 
@@ -77,6 +78,9 @@ class Index (rubber.depend.Node):
             msg.error (_("unknown indexing tool '%s'") % tool)
         self.cmd [0] = tool
 
+    def tools (self):
+        return (self.cmd [0],)
+
     def run (self):
         # No more settings are expected, we compute the
         # command once and for all.
@@ -105,8 +109,9 @@ class Index (rubber.depend.Node):
                     self.cmd.append (self.lang)
                 path_var = "XINDY_SEARCHPATH"
 
-            if self.path != []:
-                self.command_env = { path_var: ':'.join(self.path + [os.getenv(path_var, '')]) }
+            path = self.path + self.doc.env.tool_path
+            if path != []:
+                self.command_env = { path_var: ':'.join(path + [os.getenv(path_var, '')]) }
             else:
                 self.command_env = {}
 
@@ -30,9 +30,13 @@ options, only the former is recognized.
 
 Asymptote insists on replacing the main .aux file with an empty one,
 so we backup its content before running the external tool.
+
+All figures whose .asy file changed are processed by a single 'asy'
+process, so the backup is done once for all of them.
 """
 
 import os
+import sys
 import rubber.depend
 import rubber.module_interface
 import rubber.util
@@ -66,6 +70,7 @@ class Module (rubber.module_interface.Module):
             self.format = ".eps"
 
         self.global_inline = inline_option (opt, default=False)
+        self.batch = Batch_Restoring_Aux (document.basename (with_suffix = '.aux'))
 
         document.hook_begin ("asy", self.on_begin_asy)
 
@@ -84,8 +89,8 @@ class Module (rubber.module_interface.Module):
         inline = inline_option (environment_options, default=self.global_inline)
 
         self.doc.add_product (source)
-        node = Shell_Restoring_Aux (self.doc.basename (with_suffix = '.aux'),
-                                    source)
+        node = rubber.depend.Shell (('asy', source))
+        self.batch.add (node)
         if inline:
             node.add_product (prefix + ".tex")
             node.add_product (prefix + "_0" + self.format)
@@ -96,22 +101,22 @@ class Module (rubber.module_interface.Module):
             self.doc.add_source (prefix + self.format)
         node.add_source (source)
 
-class Shell_Restoring_Aux (rubber.depend.Shell):
-    """This class replaces Shell because of a bug in asymptote. Every run
+class Batch_Restoring_Aux (rubber.depend.Batch):
+    """This class extends Batch because of a bug in asymptote. Every run
 of /usr/bin/asy flushes the .aux file.
 
     """
 
-    def __init__ (self, aux, source):
-        super ().__init__ (command = ('asy', source))
+    def __init__ (self, aux):
+        super ().__init__ (command = ('asy', None), size = sys.maxsize)
         self.aux = aux
 
-    def run (self):
+    def run_chunk (self, nodes):
         bak = self.aux + '.away_from_asymptote'
         msg.debug (_("saving %s to %s"), self.aux, bak)
         os.rename (self.aux, bak)
         try:
-            return super ().run ()
+            super ().run_chunk (nodes)
         finally:
             msg.debug (_("restoring %s to %s"), bak, self.aux)
             os.rename (bak, self.aux)
@@ -6,13 +6,18 @@
 BibLaTeX support for Rubber
 """
 
+import glob
+import hashlib
 import logging
 msg = logging.getLogger (__name__)
+import os.path
 from rubber.util import _
+import rubber.contents
 import rubber.util
 import rubber.biblio
 import re
 import rubber.module_interface
+import xml.etree.ElementTree
 
 class Module (rubber.module_interface.Module):
 
@@ -40,10 +45,49 @@ re_error = re.compile (
 biber_to_rubber = { "ERROR": "error",
     "WARN": "warning" }
 
+# The children of the root of the .bcf that Biber reads: the options
+# and templates, the data model, the data sources and the citations of
+# each section, and the lists of entries.  The rest, like the comments
+# and the layout, does not change the .bbl.
+biber_elements = frozenset ((
+    "options", "optionscope", "datafieldset", "sourcemap",
+    "labelalphatemplate", "labelalphanametemplate", "extradatespec",
+    "inheritance", "noinit", "nonamestring", "nosort", "transliteration",
+    "uniquenametemplate", "namehashtemplate", "sortingnamekeytemplate",
+    "sortingtemplate", "sorting", "presort", "sortexclusion",
+    "sortinclusion", "datamodel", "bibdata", "section", "datalist"))
+
+# The options that only change the messages of Biber.
+cosmetic_options = frozenset (("debug",))
+
+def local_name (element):
+    """The tag of an XML element, without its namespace."""
+    return element.tag.rpartition ("}") [2]
+
+def is_cosmetic (element):
+    """Whether an element of the .bcf is an option in cosmetic_options."""
+    if local_name (element) != "option":
+        return False
+    for child in element:
+        if local_name (child) == "key":
+            return (child.text or "").strip () in cosmetic_options
+    return False
+
+def digest_element (element, digest):
+    digest.update (element.tag.encode ("utf_8"))
+    for key, value in sorted (element.attrib.items ()):
+        digest.update (("\0" + key + "=" + value).encode ("utf_8"))
+    digest.update (b"\0")
+    digest.update ((element.text or "").strip ().encode ("utf_8"))
+    for child in element:
+        if not is_cosmetic (child):
+            digest_element (child, digest)
+    digest.update (b"\1")
+
 class BibLaTeXDep (rubber.biblio.BibToolDep):
 
     def __init__ (self, doc, tool):
-        super ().__init__ ()
+        super ().__init__ (doc.env)
         self.doc = doc
         self.tool = tool
         self.blg = doc.basename (with_suffix = ".blg")
@@ -66,6 +110,59 @@ class BibLaTeXDep (rubber.biblio.BibToolDep):
     def build_command (self):
         return [ self.tool, self.source ]
 
+    def snapshot_source (self, path):
+        """
+        The .bcf file is reduced to the elements in biber_elements,
+        without comments, layout or cosmetic_options, followed by the
+        checksums of the data sources it lists.  So Biber runs again when
+        the citations, the options or a data source change, even if the
+        data source was not seen while parsing the document, but not when
+        only the rest of the .bcf changes.
+        """
+        if self.tool != "biber" or path != self.source:
+            return super ().snapshot_source (path)
+        if not os.path.exists (path):
+            return rubber.contents.NO_SUCH_FILE
+        try:
+            root = xml.etree.ElementTree.parse (path).getroot ()
+        except (OSError, xml.etree.ElementTree.ParseError) as e:
+            msg.debug (_("cannot parse %s: %s"), path, e)
+            return super ().snapshot_source (path)
+        digest = hashlib.md5 ()
+        # The root only carries the versions of the format and biblatex.
+        digest.update (root.tag.encode ("utf_8"))
+        for key, value in sorted (root.attrib.items ()):
+            digest.update (("\0" + key + "=" + value).encode ("utf_8"))
+        elements = [child for child in root
+                    if local_name (child) in biber_elements]
+        for child in elements:
+            digest_element (child, digest)
+        for child in elements:
+            for element in child.iter ():
+                if local_name (element) == "datasource":
+                    for filename in self.datasource_files (element):
+                        digest.update (filename.encode ("utf_8"))
+                        digest.update (rubber.contents.snapshot (filename))
+        return digest.digest ()
+
+    def datasource_files (self, element):
+        """
+        Return the local files matching a datasource element of the .bcf.
+        """
+        name = (element.text or "").strip ()
+        if element.get ("type", "file") != "file" or "://" in name:
+            return []
+        if element.get ("glob") == "true":
+            for path in [""] + self.bib_paths:
+                result = sorted (glob.glob (os.path.join (path, name)))
+                if result:
+                    return result
+            return []
+        filename = self.find_bib (name)
+        if filename is None:
+            return []
+        return [filename]
+
     def add_bib_resource (self, doc, opt, name):
         msg.debug (_("bibliography resource discovered: %s") % name)
         options = rubber.util.parse_keyval (opt)
@@ -1,7 +1,159 @@
+# This file is part of Rubber and thus covered by the GPL
+# vim: noet:ts=4
+"""
+Support for the gnuplottex package.
+
+LaTeX writes the code of each gnuplot environment to the script
+<job>-gnuplottex-fig<N>.gnuplot, and includes the figure produced by
+gnuplot if it exists.  Instead of letting LaTeX run gnuplot through shell
+escape on each compilation, the package is loaded with the option 'noshell',
+and each script is run by a node of its own, which depends on the contents
+of the script, so that unchanged figures are not drawn again.  The scripts
+are run in parallel (see the option --jobs).
+
+Since gnuplot may run arbitrary commands, the scripts are only run with
+--unsafe.  Otherwise, the document is handled as with the option 'shell':
+it requires shell escape, which is refused.
+
+The scripts are looked for after each compilation, so the figures added to
+the document are drawn before the next one.
+"""
+
+import os.path
+import re
+from rubber.util import _
+import logging
+msg = logging.getLogger (__name__)
+import rubber.depend
+import rubber.dircache
 import rubber.module_interface
+import rubber.util
+
+re_terminal = re.compile (r'^\s*set\s+term(inal)?\s+(?P<name>\w+)(?P<options>.*)$',
+                          re.MULTILINE)
+re_output = re.compile (r'''^\s*set\s+out(put)?\s+(['"])(?P<path>[^'"]*)\2''',
+                        re.MULTILINE)
+re_string = re.compile (r'''(['"])(?P<path>[^'"\n]+)\1''')
+
+# The graphics file written next to the .tex file by the terminals that
+# split the figure, as a function of the options of the terminal.
+split_terminals = {
+    'epslatex': lambda options: '.eps',
+    'cairolatex': lambda options: '.eps' if re.search (r'\beps\b', options) else '.pdf',
+}
+
+class Script (rubber.depend.Node):
+    """
+    Run gnuplot on a script written by gnuplottex.  The products are the
+    files named by 'set output' in the script, and the sources are the
+    script and the files it quotes that exist, such as data files.
+    """
+    def __init__ (self, doc, script, outputs, data):
+        super ().__init__ ()
+        self.doc = doc
+        self.script = script
+        self.parallel = True
+        self.add_source (script)
+        for path in data:
+            self.add_source (path)
+        for path in outputs:
+            self.add_product (path)
+
+    def tools (self):
+        return ('gnuplot',)
+
+    def run (self):
+        if not self.doc.env.is_in_unsafe_mode_:
+            msg.error (_("the document tries to run gnuplot scripts which could be dangerous.  use rubber --unsafe if the document is trusted."))
+            return False
+        msg.info (_("running gnuplot on %s"), self.script)
+        if rubber.util.execute (('gnuplot', self.script)) != 0:
+            msg.error (_("gnuplot failed on %s"), self.script)
+            return False
+        return True
+
+def script_files (script):
+    """
+    Return the outputs of a gnuplot script, and the other files it quotes
+    that exist, or None if the script cannot be read.
+    """
+    try:
+        with open (script, encoding='utf_8', errors='replace') as f:
+            text = f.read ()
+    except OSError:
+        return None
+    outputs = []
+    terminal = re_terminal.search (text)
+    for match in re_output.finditer (text):
+        path = match.group ('path')
+        outputs.append (path)
+        if terminal is not None and terminal.group ('name') in split_terminals:
+            suffix = split_terminals [terminal.group ('name')] (
+                terminal.group ('options'))
+            outputs.append (os.path.splitext (path) [0] + suffix)
+    data = []
+    for match in re_string.finditer (text):
+        path = match.group ('path')
+        if path not in outputs and path not in data \
+           and rubber.dircache.isfile (path):
+            data.append (path)
+    return outputs, data
 
 class Module (rubber.module_interface.Module):
 
     def __init__ (self, document, opt):
+        self.doc = document
+        options = rubber.util.parse_keyval (opt)
+        self.prefix = document.basename () + '-gnuplottex-fig'
+        if 'subfolder' in options:
+            self.prefix = os.path.join ('gnuplottex', self.prefix)
+        self.count = 0
+        # For each script, the node running it, None until the script is
+        # written, or False if it sets no output.
+        self.scripts = {}
+        if 'shell' in options or not document.env.is_in_unsafe_mode_:
+            msg.debug (_("gnuplottex runs gnuplot itself"))
+            document.env.doc_requires_shell_ = True
+            return
+        document.cmdline.insert (0, '\\PassOptionsToPackage{noshell}{gnuplottex}')
+        document.hook_begin ('gnuplot', self.begin_gnuplot)
+        document.hook_macro ('gnuplotloadfile', 'oa', self.hook_gnuplotloadfile)
+
+    def new_script (self):
+        self.count += 1
+        script = '{}{}.gnuplot'.format (self.prefix, self.count)
+        self.scripts [script] = None
+        self.doc.add_product (script)
+        # Scripts written by the last run are known before the first
+        # compilation, so that the cache file applies to their nodes.
+        self.add_script (script)
+
+    def begin_gnuplot (self, loc):
+        self.doc.parser.skip_until (r"[ \t]*\\end\{gnuplot\}.*")
+        self.new_script ()
+
+    def hook_gnuplotloadfile (self, loc, opt, path):
+        if rubber.dircache.isfile (path):
+            self.doc.add_source (path)
+        self.new_script ()
+
+    def post_compile (self):
+        for script, node in self.scripts.items ():
+            if node is None:
+                self.add_script (script)
+        return True
 
-        document.env.doc_requires_shell_ = True
+    def add_script (self, script):
+        files = script_files (script)
+        if files is None:
+            return
+        outputs, data = files
+        if not outputs:
+            self.scripts [script] = False
+            msg.warning (_("the gnuplot script %s sets no output"), script)
+            return
+        node = Script (self.doc, script, outputs, data)
+        self.scripts [script] = node
+        for path in outputs:
+            self.doc.add_source (path)
+        msg.debug (_("gnuplot script %s"), script)
@@ -17,8 +17,10 @@ incomplete, because \\includegraphics can have a complex format.
 
 import os, os.path
 import re
+import shutil
 import logging
 msg = logging.getLogger (__name__)
+import rubber.converters.draft
 import rubber.depend
 from rubber.util import _
 from rubber.util import parse_keyval
@@ -35,6 +37,7 @@ import rubber.module_interface
 drv_suffixes = {
     "dvipdf" : ["", ".eps", ".ps", ".eps.bb", ".ps.bb", ".eps.Z"],
     "dvipdfm" : ["", ".jpg", ".jpeg", ".pdf", ".png"],
+    "dvipdfmx" : ["", ".jpg", ".jpeg", ".pdf", ".png"],
     "dvips" : ["", ".eps", ".ps", ".eps.bb", ".ps.bb", ".eps.Z"],
     "dvipsone" : ["", ".eps", ".ps", ".pcx", ".bmp"],
     "dviwin" : ["", ".eps", ".ps", ".wmf", ".tif"],
@@ -51,6 +54,17 @@ drv_suffixes = {
               ".eps", ".ps", ".mps", ".emf", ".wmf"]
 }
 
+# The drivers reading the size of bitmaps and PDF figures from files made
+# by extractbb, with the suffix of these files.
+drv_bbox = {
+    "dvipdfm" : ".bb",
+    "dvipdfmx" : ".xbb",
+}
+bbox_suffixes = (".jpg", ".jpeg", ".pdf", ".png")
+
+# The figures replaced by reduced copies with --draft-graphics.
+draft_suffixes = (".jpg", ".jpeg", ".png")
+
 class Module (rubber.module_interface.Module):
 
     def __init__ (self, document, opt):
@@ -62,6 +76,8 @@ class Module (rubber.module_interface.Module):
 
         self.prefixes = [os.path.join(x, '') for x in document.env.path]
         self.files = []
+        # The targets already requested from the conversion rules.
+        self.requested = set ()
 
         #Latex accepts upper and lowercase filename extensions
         # to keep the above lists clean we auto-generate the
@@ -83,9 +99,11 @@ class Module (rubber.module_interface.Module):
 
         opts = parse_keyval (opt)
 
+        self.bbox_suffix = None
         for opt in opts.keys():
             if opt in drv_suffixes:
                 self.suffixes = drv_suffixes[opt]
+                self.bbox_suffix = drv_bbox.get (opt)
 
         document.env.graphics_suffixes = self.suffixes
 
@@ -152,9 +170,60 @@ class Module (rubber.module_interface.Module):
                        name, node.primary_product ())
             self.doc.add_source (node.primary_product ())
             self.files.append(node)
+            rubber.depend.start (node)
         else:
             assert node is None
             msg.warning (rubber.util._format (loc, _("graphics `%s' not found") % name))
+            return
+
+        produced = isinstance (node, rubber.depend.Node)
+        if produced:
+            node = node.primary_product ()
+        if self.doc.env.draft_graphics is not None:
+            self.add_proxy (node, produced)
+        if self.bbox_suffix is not None:
+            self.add_bbox (node)
+
+    def add_proxy (self, path, produced):
+        """
+        Make the reduced copy of a bitmap for draft builds, which LaTeX
+        finds before the original.
+        """
+        if os.path.splitext (path) [1].lower () not in draft_suffixes:
+            return
+        limit = self.doc.env.draft_graphics
+        proxy = rubber.converters.draft.proxy (path, limit)
+        if proxy is None or proxy in self.requested:
+            return
+        self.requested.add (proxy)
+        if produced:
+            # The rules would make the original a second time.
+            node = rubber.converters.draft.Proxy (proxy, path, limit)
+        else:
+            node = self.doc.env.convert (proxy, context=self.doc.vars)
+        if isinstance (node, rubber.depend.Node):
+            msg.debug (_("graphics %s replaced with %s"), path, proxy)
+            self.doc.add_source (proxy)
+            self.files.append (node)
+            rubber.depend.start (node)
+
+    def add_bbox (self, path):
+        """
+        Make the file giving the size of a figure to the driver, if the
+        driver reads one for this kind of figure.
+        """
+        base, suffix = os.path.splitext (path)
+        if suffix.lower () not in bbox_suffixes:
+            return
+        target = base + self.bbox_suffix
+        if target in self.requested:
+            return
+        self.requested.add (target)
+        node = self.doc.env.convert (target, context=self.doc.vars)
+        if isinstance (node, rubber.depend.Node):
+            self.doc.add_source (node.primary_product ())
+            self.files.append (node)
+            rubber.depend.start (node)
 
     def hook_graphicspath (self, loc, arg):
         # The argument of \graphicspath is a list (in the sense of TeX) of
@@ -181,8 +250,15 @@ class Module (rubber.module_interface.Module):
     def pre_compile (self):
         # Pre-compilation means running all needed conversions. This is not done
         # through the standard dependency mechanism because we do not want to
-        # interrupt compilation when a graphic is not found.
+        # interrupt compilation when a graphic is not found.  The conversions
+        # started in the background while parsing are only waited for.
         for node in self.files:
             assert not node.making
             node.make ()
         return True
+
+    def clean (self):
+        root = rubber.converters.draft.root
+        if os.path.isdir (root):
+            msg.info (_("removing tree %s"), root)
+            shutil.rmtree (root, ignore_errors=True)
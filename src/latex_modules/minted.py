@@ -0,0 +1,368 @@
+# This file is part of Rubber and thus covered by the GPL
+# vim: noet:ts=4
+"""
+Support for the minted package.
+
+Minted runs pygmentize through shell escape for each listing, so by
+default the document requires --unsafe.  With the directive
+'minted.highlight', this module collects the listings while parsing the
+document, in the order LaTeX typesets them, highlights them with Pygments
+before the compilation, and loads minted with the option 'frozencache', so
+that LaTeX reads the results from the cache directory (_minted-<job> by
+default) and runs no external program.
+
+The results are saved in the cache directory under a digest of the code,
+the lexer and the options, so each listing is highlighted once, in threads
+(see the option --jobs).  They are then copied to the listing<n>.pygtex
+files read by minted.
+
+The listings must be numbered as minted numbers them, so listings produced
+by user macros or conditionals, or inline listings in moving arguments, are
+not supported: minted would silently typeset the wrong listings.  This is
+why the directive is needed.  This requires minted 2.2 or later (but not
+minted 3), and Pygments.
+"""
+
+import concurrent.futures
+import os.path
+import re
+import shutil
+import textwrap
+from rubber.util import _
+import logging
+msg = logging.getLogger (__name__)
+import rubber.cache
+import rubber.depend
+import rubber.dircache
+import rubber.module_interface
+import rubber.tex
+import rubber.util
+
+# The options of minted that are passed to Pygments, with their default
+# values in minted.
+lexer_options = {'stripnl': False, 'stripall': None, 'startinline': None,
+                 'funcnamehighlighting': None, 'ensurenl': None}
+formatter_options = {'texcl': None, 'texcomments': None, 'mathescape': None,
+                     'escapeinside': None}
+
+re_environment = re.compile (r'\s*(\[(?P<opt>[^]]*)\])?\s*\{(?P<lexer>[^}]*)\}')
+
+def pygments_options (options):
+    """
+    Return the keyword arguments of the lexer and of the formatter, the
+    gobble count and whether the code must be dedented, for a dictionary of
+    minted options.
+    """
+    def value (key, default):
+        if key not in options:
+            return default
+        val = options [key]
+        if val is None:
+            return True
+        if val.lower () in ('true', 'false'):
+            return val.lower () == 'true'
+        return val
+    lexer = {}
+    for key, default in lexer_options.items ():
+        val = value (key, default)
+        if val is not None:
+            lexer [key] = val
+    formatter = {'commandprefix': 'PYG'}
+    for key, default in formatter_options.items ():
+        val = value (key, default)
+        if val is not None:
+            formatter [key] = val
+    gobble = int (value ('gobble', 0))
+    return lexer, formatter, gobble, bool (value ('autogobble', False))
+
+def highlight (lexer_name, options, code):
+    """
+    Return the output of pygmentize for a listing, as in
+    'pygmentize -l lexer -f latex -P commandprefix=PYG -F tokenmerge'.
+    This runs in a separate thread.
+    """
+    import pygments
+    import pygments.formatters
+    import pygments.lexers
+    lexer_args, formatter_args, gobble, autogobble = pygments_options (options)
+    if autogobble:
+        code = textwrap.dedent (code)
+    lexer = pygments.lexers.get_lexer_by_name (lexer_name, **lexer_args)
+    if gobble:
+        lexer.add_filter ('gobble', n=gobble)
+    lexer.add_filter ('tokenmerge')
+    formatter = pygments.formatters.LatexFormatter (**formatter_args)
+    return pygments.highlight (code, lexer, formatter)
+
+def style_definitions (style, prefix):
+    """Return the output of 'pygmentize -S style -f latex -P commandprefix=prefix'."""
+    import pygments.formatters
+    formatter = pygments.formatters.LatexFormatter (style=style,
+                                                    commandprefix=prefix)
+    return formatter.get_style_defs () + '\n'
+
+def inline_code (parser):
+    """
+    Read the code of an inline listing, delimited by braces or by twice
+    the same character, and return it, or None if it does not end on the
+    same line.  The delimiter may already be read by the parser, so the
+    first token is read through it, and the code character by character,
+    since it is verbatim.
+    """
+    parser.skip_space ()
+    delimiter = parser.get_token ()
+    if delimiter.cat == rubber.tex.EOF:
+        return None
+    if delimiter.cat == rubber.tex.OPEN:
+        end = '}'
+    else:
+        end = delimiter.raw
+    level = 0
+    code = ''
+    while True:
+        if parser.next:
+            token = parser.next.pop ()
+        else:
+            token = parser.read_char ()
+        if token.cat == rubber.tex.EOF or token.raw == '\n':
+            return None
+        if token.raw == end and level == 0:
+            return code
+        if end == '}':
+            if token.raw == '{':
+                level += 1
+            elif token.raw == '}':
+                level -= 1
+        code += token.raw
+
+class Module (rubber.module_interface.Module):
+
+    def __init__ (self, document, opt):
+        self.doc = document
+        options = rubber.util.parse_keyval (opt)
+        self.cachedir = options.get ('cachedir') \
+            or '_minted-' + document.basename ()
+        # For each listing, in the order minted numbers them, a tuple
+        # (location, lexer, options, code, path).
+        self.listings = []
+        self.global_options = {}
+        self.lexer_specific_options = {}
+        # Whether the directive minted.highlight was given, or None if
+        # minted manages its cache itself.
+        self.highlighting = False
+        if 'finalizecache' in options or 'frozencache' in options:
+            msg.debug (_("minted manages its cache itself"))
+            self.highlighting = None
+            if 'finalizecache' in options:
+                document.env.doc_requires_shell_ = True
+            return
+        for name, format, hook in (
+                ('setminted', 'oa', self.hook_setminted),
+                ('inputminted', 'oaa', self.hook_inputminted),
+                ('mint', '', self.hook_mint),
+                ('mintinline', '', self.hook_mint),
+                ('newminted', 'oaa', self.hook_newminted),
+                ('newmint', 'oaa', self.hook_newmint),
+                ('newmintinline', 'oaa', self.hook_newmintinline),
+                ('newmintedfile', 'oaa', self.hook_newmintedfile)):
+            document.hook_macro (name, format, hook)
+        document.hook_begin ('minted', self.begin_minted)
+
+    def command (self, cmd, args):
+        super ().command (cmd, args, self)
+
+    def do_highlight (self, args):
+        if args:
+            raise rubber.SyntaxError (_("invalid syntax for directive '{}'")
+                                      .format ('highlight'))
+        if self.highlighting is None:
+            msg.warning (_("minted manages its cache itself, ignoring the directive minted.highlight"))
+        elif not self.highlighting:
+            self.highlighting = True
+            self.doc.cmdline.insert (0, '\\PassOptionsToPackage{frozencache}{minted}')
+
+    #--  Parsing  {{{2
+
+    def add_listing (self, loc, lexer, local_options, code=None, path=None):
+        options = dict (self.global_options)
+        options.update (self.lexer_specific_options.get (lexer, {}))
+        options.update (local_options)
+        self.listings.append ((dict (loc), lexer, options, code, path))
+
+    def hook_setminted (self, loc, lexer, options):
+        options = rubber.util.parse_keyval (options)
+        if lexer is None:
+            self.global_options.update (options)
+        else:
+            self.lexer_specific_options.setdefault (lexer, {}).update (options)
+
+    def hook_inputminted (self, loc, opt, lexer, path, fixed_options={}):
+        options = dict (fixed_options)
+        options.update (rubber.util.parse_keyval (opt))
+        self.add_listing (loc, lexer, options, path=path)
+        if rubber.dircache.isfile (path):
+            self.doc.add_source (path)
+
+    def hook_mint (self, loc, lexer=None, fixed_options={}):
+        parser = self.doc.parser
+        opt = parser.get_latex_optional_text ()
+        if lexer is None:
+            lexer = parser.get_argument_text ()
+        options = dict (fixed_options)
+        options.update (rubber.util.parse_keyval (opt))
+        code = inline_code (parser)
+        if code is None:
+            msg.warning (rubber.util._format (loc,
+                _("cannot find the end of the inline listing")))
+            return
+        self.add_listing (loc, lexer, options, code=code + '\n')
+
+    def begin_minted (self, loc, lexer=None, fixed_options={}, env='minted'):
+        parser = self.doc.parser
+        options = dict (fixed_options)
+        match = re_environment.match (parser.line) if lexer is None \
+            else re.match (r'\s*(\[(?P<opt>[^]]*)\])?', parser.line)
+        if match is not None:
+            options.update (rubber.util.parse_keyval (match.group ('opt')))
+            if lexer is None:
+                lexer = match.group ('lexer')
+        lines = parser.skip_until (r"[ \t]*\\end\{%s\}.*" % re.escape (env))
+        if lexer is not None:
+            self.add_listing (loc, lexer, options, code=''.join (lines))
+
+    def hook_newminted (self, loc, name, lexer, options):
+        options = rubber.util.parse_keyval (options)
+        env = name or lexer + 'code'
+        self.doc.hook_begin (env, lambda loc: self.begin_minted (
+            loc, lexer, options, env))
+        self.doc.hook_begin (env + '*', lambda loc: self.begin_minted (
+            loc, lexer, options, env + '*'))
+
+    def hook_newmint (self, loc, name, lexer, options):
+        options = rubber.util.parse_keyval (options)
+        self.doc.hook_macro (name or lexer, '',
+            lambda loc: self.hook_mint (loc, lexer, options))
+
+    def hook_newmintinline (self, loc, name, lexer, options):
+        options = rubber.util.parse_keyval (options)
+        self.doc.hook_macro (name or lexer + 'inline', '',
+            lambda loc: self.hook_mint (loc, lexer, options))
+
+    def hook_newmintedfile (self, loc, name, lexer, options):
+        options = rubber.util.parse_keyval (options)
+        self.doc.hook_macro (name or lexer + 'file', 'oa',
+            lambda loc, opt, path: self.hook_inputminted (
+                loc, opt, lexer, path, options))
+
+    #--  Highlighting  {{{2
+
+    def pre_compile (self):
+        if self.highlighting is False:
+            # minted runs pygmentize itself.
+            self.doc.env.doc_requires_shell_ = True
+        if not self.highlighting:
+            return True
+        if not self.listings:
+            return True
+        try:
+            import pygments
+        except ImportError:
+            msg.error (_("Pygments is required to highlight the listings of minted"))
+            return False
+        try:
+            os.makedirs (self.cachedir, exist_ok=True)
+        except OSError as e:
+            msg.error (_("cannot create %s: %s"), self.cachedir, e)
+            return False
+
+        styles = {'default-pyg-prefix': ('default', 'PYG')}
+        todo = {}
+        keys = []
+        for loc, lexer, options, code, path in self.listings:
+            if code is None:
+                try:
+                    with open (path, encoding='utf_8') as f:
+                        code = f.read ()
+                except OSError as e:
+                    msg.error (rubber.util._format (loc,
+                        _("cannot read {}: {}").format (path, e.strerror)))
+                    return False
+            key = rubber.cache.key (lexer, sorted (options.items ()), code,
+                                    pygments.__version__)
+            keys.append (key)
+            if not os.path.exists (self.saved (key)):
+                todo [key] = (loc, lexer, options, code)
+            style = options.get ('style') or 'default'
+            styles [style] = (style, 'PYG' + style)
+
+        if not self.highlight (todo):
+            return False
+
+        for style, (name, prefix) in styles.items ():
+            path = os.path.join (self.cachedir, style + '.pygstyle')
+            if not os.path.exists (path):
+                with open (path, 'w', encoding='utf_8') as f:
+                    f.write (style_definitions (name, prefix))
+        for number, key in enumerate (keys, start=1):
+            self.update (number, key)
+        # Forget the results of the listings removed from the document.
+        for name in os.listdir (self.cachedir):
+            if name.startswith ('rubber-') and name.endswith ('.pygtex') \
+               and name [7:-7] not in keys:
+                os.remove (os.path.join (self.cachedir, name))
+        return True
+
+    def saved (self, key):
+        return os.path.join (self.cachedir, 'rubber-' + key + '.pygtex')
+
+    def highlight (self, todo):
+        """
+        Highlight the listings in the todo dictionary, mapping keys to
+        (location, lexer, options, code), and save the results under
+        their keys.  Return true on success.
+        """
+        if not todo:
+            return True
+        msg.info (_("highlighting %i listings"), len (todo))
+        # Not a process pool: forking while the threads of
+        # rubber.depend.start run is unsafe, and the scripts of Rubber
+        # cannot be imported again by spawned processes.
+        executor = concurrent.futures.ThreadPoolExecutor (
+            max_workers=min (len (todo), rubber.depend.jobs))
+        success = True
+        with executor:
+            futures = {key: executor.submit (highlight, lexer, options, code)
+                       for key, (loc, lexer, options, code) in todo.items ()}
+            for key, future in futures.items ():
+                try:
+                    result = future.result ()
+                except Exception as e:
+                    msg.error (rubber.util._format (todo [key][0],
+                        _("cannot highlight the listing: {}").format (e)))
+                    success = False
+                    continue
+                with open (self.saved (key), 'w', encoding='utf_8') as f:
+                    f.write (result)
+        return success
+
+    def update (self, number, key):
+        """
+        Copy the result saved under key to the file read by minted for
+        the listing with this number, unless it is already there.
+        """
+        with open (self.saved (key), encoding='utf_8') as f:
+            text = f.read ()
+        path = os.path.join (self.cachedir, 'listing%i.pygtex' % number)
+        try:
+            with open (path, encoding='utf_8') as f:
+                if f.read () == text:
+                    return
+        except OSError:
+            pass
+        with open (path, 'w', encoding='utf_8') as f:
+            f.write (text)
+
+    def clean (self):
+        if os.path.isdir (self.cachedir):
+            msg.info (_("removing tree %s"), self.cachedir)
+            shutil.rmtree (self.cachedir, ignore_errors=True)
@@ -0,0 +1,14 @@
+# This file is part of Rubber and thus covered by the GPL
+# vim: noet:ts=4
+"""
+The pgfplots package loads TikZ, whose externalization library is handled
+by the tikz module.  This module only registers it, so that a document
+loading both packages has a single list of pictures.
+"""
+
+import rubber.module_interface
+
+class Module (rubber.module_interface.Module):
+
+    def __init__ (self, document, opt):
+        document.modules.register ('tikz')
@@ -3,9 +3,12 @@
 # (c) Emmanuel Beffara, 2004--2006
 """
 PostScript to PDF conversion using GhostScript.
+
+With --streaming, when the PostScript is produced by dvips, dvips writes it
+to a pipe read by ps2pdf, so that the PostScript is never written.
 """
 
-from rubber.depend import Shell
+from rubber.depend import Pipeline, Shell, streamable
 from rubber.util import _
 import logging
 msg = logging.getLogger (__name__)
@@ -18,7 +21,11 @@ class Module (rubber.module_interface.Module):
         if not ps.endswith ('.ps'):
             raise rubber.GenericError (_("ps2pdf cannot produce PS"))
         pdf = ps[:-2] + 'pdf'
-        dep = Shell (('ps2pdf', ps, pdf))
-        dep.add_product (pdf)
-        dep.add_source (ps)
+        final = document.env.final
+        if document.env.streaming and streamable (final):
+            dep = Pipeline ((final, ('ps2pdf', '-', '-')), pdf, virtual=(ps,))
+        else:
+            dep = Shell (('ps2pdf', ps, pdf))
+            dep.add_product (pdf)
+            dep.add_source (ps)
         document.env.final = dep
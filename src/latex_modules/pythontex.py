@@ -4,36 +4,141 @@
 # vim: noet:ts=4
 """
 pythontex support for Rubber
+
+LaTeX rewrites the .pytxcode file on each compilation, with the input file
+and line of each code block.  PythonTeX runs again only when the code, or
+the other fields of its headers, change in at least one session.
 """
 
 from rubber.util import _
+import hashlib
 import logging
 msg = logging.getLogger (__name__)
 import os.path
 import shutil
+import rubber.contents
+import rubber.depend
 import rubber.module_interface
 
+def session_digests (path):
+    """
+    Return a dictionary mapping each session of a .pytxcode file, as a
+    'family#session#restart' string, to the MD5 digest (in hexadecimal)
+    of its code and of its headers without the input file and line.
+    The settings written at the end of the file are digested under the
+    key 'SETTINGS'.
+    """
+    digests = {}
+    current = digests.setdefault ('', hashlib.md5 ())
+    with open (path, 'rb') as f:
+        for line in f:
+            if line.startswith (b'=>PYTHONTEX#'):
+                # =>PYTHONTEX#family#session#restart#instance#command
+                #   #context#args_run#args_prettyprint#file#line#
+                fields = line.split (b'#')
+                key = b'#'.join (fields [1:4]).decode ('utf_8', 'replace')
+                current = digests.setdefault (key, hashlib.md5 ())
+                line = b'#'.join (fields [:9] + fields [11:])
+            elif line.startswith (b'=>PYTHONTEX:SETTINGS#'):
+                current = digests.setdefault ('SETTINGS', hashlib.md5 ())
+            current.update (line)
+    return {key: digest.hexdigest () for key, digest in digests.items ()}
+
 class PythonTeXDep (rubber.depend.Shell):
 
     def __init__ (self, document):
         self.doc = document
         basename = self.doc.basename ()
         super ().__init__ (('pythontex', basename))
+        self.basename = basename
         self.pythontex_files = 'pythontex-files-' + basename
+        # The value of the --jobs option, or None for rubber --jobs.
+        self.jobs = None
 
         pytxcode = basename + '.pytxcode'
+        self.pytxcode = pytxcode
         self.doc.add_product (pytxcode)
         self.add_source (pytxcode)
+        # The session digests of the last .pytxcode read, with its checksum.
+        self.sessions = (None, None)
 
         pytxmcr = os.path.join (self.pythontex_files, basename + '.pytxmcr')
         self.add_product (pytxmcr)
         self.doc.add_source (pytxmcr)
 
+        # The session digests of the last successful run.
+        self.sessions_file = os.path.join (self.pythontex_files,
+                                           'rubber-sessions')
+
+    def do_jobs (self, args):
+        if len (args) != 1 or not args [0].isdigit () or args [0] == '0':
+            raise rubber.SyntaxError (_("invalid syntax for directive '{}'")
+                                      .format ('jobs'))
+        self.jobs = int (args [0])
+
+    def session_digests (self):
+        """
+        Return the session digests of the .pytxcode file, or None if
+        it does not exist.  The result is reused while the file does
+        not change.
+        """
+        checksum = rubber.contents.snapshot (self.pytxcode)
+        if checksum == rubber.contents.NO_SUCH_FILE:
+            return None
+        if self.sessions [0] != checksum:
+            self.sessions = (checksum, session_digests (self.pytxcode))
+        return self.sessions [1]
+
+    def snapshot_source (self, path):
+        if path != self.pytxcode:
+            return super ().snapshot_source (path)
+        digests = self.session_digests ()
+        if digests is None:
+            return rubber.contents.NO_SUCH_FILE
+        digest = hashlib.md5 ()
+        for key in sorted (digests):
+            digest.update ('{} {}\n'.format (digests [key], key)
+                           .encode ('utf_8'))
+        return digest.digest ()
+
+    def read_sessions (self):
+        """Return the session digests saved by the last run, if any."""
+        result = {}
+        try:
+            with open (self.sessions_file, encoding='utf_8') as f:
+                for line in f:
+                    digest, key = line.rstrip ('\n').split (' ', 1)
+                    result [key] = digest
+        except (OSError, ValueError):
+            pass
+        return result
+
+    def write_sessions (self, digests):
+        try:
+            with open (self.sessions_file, 'w', encoding='utf_8') as f:
+                for key in sorted (digests):
+                    f.write ('{} {}\n'.format (digests [key], key))
+        except OSError as e:
+            msg.debug (_("cannot write %s: %s"), self.sessions_file, e)
+
     def run (self):
         if not self.doc.env.is_in_unsafe_mode_:
             msg.error (_('The document tries to run embedded Python code which could be dangerous.  Use rubber --unsafe if the document is trusted.'))
             return False
-        return super (PythonTeXDep, self).run ()
+        digests = self.session_digests ()
+        if digests is not None:
+            previous = self.read_sessions ()
+            changed = [key for key in sorted (digests)
+                       if key and previous.get (key) != digests [key]]
+            msg.info (_("pythontex sessions changed: %s"),
+                      ' '.join (changed) or _("none"))
+        jobs = self.jobs or rubber.depend.jobs
+        self.command = ('pythontex', '--jobs', str (jobs), self.basename)
+        if not super (PythonTeXDep, self).run ():
+            return False
+        if digests is not None:
+            self.write_sessions (digests)
+        return True
 
 class Module (rubber.module_interface.Module):
 
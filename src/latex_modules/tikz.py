@@ -0,0 +1,137 @@
+# This file is part of Rubber and thus covered by the GPL
+# vim: noet:ts=4
+"""
+Support for the externalization library of TikZ.
+
+With \\tikzexternalize and the option 'mode=list and make', LaTeX does not
+typeset the pictures, but writes their names in <job>.figlist, and the MD5
+digest of the code of each picture in <picture>.md5.  Each picture is then
+compiled by a node of its own, which depends on this digest only, so that
+unchanged pictures are not compiled again.  The pictures are compiled in
+parallel (see the option --jobs).
+
+Without --unsafe, the pictures are compiled with the LaTeX program of the
+document, which must produce PDF.  With --unsafe, the commands of the
+makefile written by TikZ are run instead, so that the 'system call' option
+of the library is honoured.
+
+The list is read after each compilation, so the pictures added to the
+document are compiled before the next one.
+"""
+
+import os.path
+import re
+from rubber.util import _
+import logging
+msg = logging.getLogger (__name__)
+import rubber.depend
+import rubber.module_interface
+import rubber.util
+
+# A rule of the makefile written by TikZ, with the first line of its recipe.
+re_rule = re.compile (r'^(?P<target>[^\t#:][^:]*):[ \t]*\n\t(?P<recipe>.*)$',
+                      re.MULTILINE)
+
+class Picture (rubber.depend.Node):
+    """
+    Compile an externalized picture.  The command is run in the
+    environment of the LaTeX compilations of the document, for the
+    search path.
+    """
+    def __init__ (self, doc, name, command, suffix):
+        super ().__init__ ()
+        self.doc = doc
+        self.name = name
+        self.command = command
+        self.parallel = True
+        self.add_source (name + '.md5')
+        self.add_product (name + suffix)
+        for other in ('.log', '.dpth', '.aux'):
+            self.add_product (name + other)
+
+    def tools (self):
+        return (self.command [0],)
+
+    def run (self):
+        cmd, env = self.doc.command_line ()
+        if rubber.util.execute (self.command, env=env) != 0 \
+           or not os.path.exists (self.primary_product ()):
+            msg.error (_("compilation of the picture %s failed, see %s"),
+                       self.name, self.name + '.log')
+            return False
+        return True
+
+class Module (rubber.module_interface.Module):
+
+    def __init__ (self, document, opt):
+        self.doc = document
+        self.figlist = None
+        self.pictures = {}
+        document.hook_macro ('tikzexternalize', 'o', self.hook_externalize)
+
+    def hook_externalize (self, loc, opt):
+        if self.figlist is not None:
+            return
+        self.figlist = self.doc.basename (with_suffix='.figlist')
+        self.makefile = self.doc.basename (with_suffix='.makefile')
+        self.doc.add_product (self.figlist)
+        self.doc.add_product (self.makefile)
+        # Pictures listed by the last run are known before the first
+        # compilation, so that the cache file applies to their nodes.
+        self.add_pictures ()
+
+    def post_compile (self):
+        if self.figlist is not None:
+            self.add_pictures ()
+        return True
+
+    def add_pictures (self):
+        try:
+            with open (self.figlist, encoding='utf_8') as f:
+                names = [line.strip () for line in f if line.strip ()]
+        except OSError:
+            return
+        names = [name for name in names if name not in self.pictures]
+        if not names:
+            return
+        recipes = self.read_makefile ()
+        for name in names:
+            picture = self.picture (name, recipes)
+            self.pictures [name] = picture
+            if picture is None:
+                continue
+            self.doc.add_product (name + '.md5')
+            self.doc.add_source (picture.primary_product ())
+            msg.debug (_("externalized picture %s"), name)
+
+    def read_makefile (self):
+        """
+        Return a dictionary mapping the targets of the makefile to the
+        commands making them, or None if the makefile must not be used.
+        """
+        if not self.doc.env.is_in_unsafe_mode_:
+            return None
+        try:
+            with open (self.makefile, encoding='utf_8') as f:
+                text = f.read ()
+        except OSError:
+            return {}
+        return {m.group ('target').strip (): m.group ('recipe').replace ('$$', '$')
+                for m in re_rule.finditer (text)}
+
+    def picture (self, name, recipes):
+        """Return a node compiling the picture, or None."""
+        if recipes is not None:
+            for target, recipe in recipes.items ():
+                base, suffix = os.path.splitext (target)
+                if base == name and suffix != '.dep':
+                    return Picture (self.doc, name, ('sh', '-c', recipe), suffix)
+        if self.doc.program not in ('pdflatex', 'xelatex', 'lualatex') \
+           or '\\pdfoutput=0' in self.doc.cmdline:
+            msg.error (_("cannot compile the picture %s, only PDF is supported without --unsafe"), name)
+            return None
+        texsource = '\\def\\tikzexternalrealjob{%s}\\input{%s}' \
+            % (self.doc.basename (), self.doc.source ())
+        command = (self.doc.program, '-halt-on-error',
+                   '-interaction=batchmode', '-jobname', name, texsource)
+        return Picture (self.doc, name, command, '.pdf')
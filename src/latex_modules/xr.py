@@ -6,19 +6,40 @@ Dependency analysis for the xr package.
 The xr package allows one to put references in one document to other
 (external) LaTeX documents. It works by reading the external document's .aux
 file, so this support package registers these files as dependencies.
+
+When the source of the external document is found in the working directory,
+it is compiled by a node of its own, with the same engine as the main
+document.  External documents referring to each other share their nodes, and
+the usual fixpoint of Node.make resolves the mutual references.  Independent
+external documents may be compiled in parallel.  Their files are not
+removed by --clean, unless they are also given on the command line.
 """
 
+import os.path
 from rubber.util import _
 import logging
 msg = logging.getLogger (__name__)
+import rubber.converters.latex
+import rubber.dircache
+import rubber.environment
 import rubber.module_interface
 
+# The modules selecting the LaTeX engine, copied to external documents.
+engines = ('aleph', 'lualatex', 'omega', 'pdftex', 'vtex', 'xelatex')
+
 class Module (rubber.module_interface.Module):
     def __init__ (self, document, opt):
         self.doc=document
+        document.env.documents.setdefault (
+            os.path.abspath (document.source ()), document)
         document.hook_macro('externaldocument', 'oa', self.hook_externaldocument)
 
     def hook_externaldocument (self, loc, opt, name):
+        sub = self.external_document (name)
+        if sub:
+            self.doc.add_source (sub.basename (with_suffix='.aux'))
+            msg.debug (_("%s compiled for external references"), sub.source ())
+            return
         aux = self.doc.env.find_file(name + '.aux')
         if aux:
             self.doc.add_source(aux)
@@ -27,3 +48,37 @@ class Module (rubber.module_interface.Module):
         else:
             msg.debug(_(
                 "file %s.aux is required by xr package but not found") % name)
+
+    def external_document (self, name):
+        """
+        Return the node compiling the external document, or None if its
+        source is not found.  LaTeX writes the .aux file in the working
+        directory, so only sources in this directory are considered.
+        """
+        if os.path.dirname (name):
+            return None
+        source = name + '.tex'
+        if not rubber.dircache.isfile (source):
+            return None
+        env = self.doc.env
+        documents = env.documents
+        path = os.path.abspath (source)
+        if path in documents:
+            return documents [path]
+
+        subenv = rubber.environment.Environment ()
+        subenv.path = list (env.path)
+        subenv.is_in_unsafe_mode_ = env.is_in_unsafe_mode_
+        subenv.synctex = env.synctex
+        subenv.batches = env.batches
+        subenv.documents = documents
+        sub = rubber.converters.latex.LaTeXDep (subenv, source, None)
+        subenv.main = subenv.final = sub
+        sub.parallel = True
+        documents [path] = sub
+        for engine in engines:
+            if engine in self.doc.modules:
+                mode = getattr (self.doc.modules [engine], 'mode', None)
+                sub.modules.register (engine, mode)
+        sub.parse ()
+        return sub
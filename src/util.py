@@ -12,6 +12,7 @@ import imp
 import logging
 msg = logging.getLogger (__name__)
 import re
+import rubber.dircache
 from string import whitespace
 import subprocess
 import sys
@@ -100,6 +101,25 @@ def match_brace (str):
     return (str, "")
 
 
+#-- Writing files --{{{1
+
+# Reading the umask requires changing it, so it is done once, before
+# any thread is started.
+_umask = os.umask (0o022)
+os.umask (_umask)
+
+def set_replacement_mode (fd, path):
+    """
+    Give the file open as fd, created by tempfile.mkstemp with mode 0600
+    to replace path, the permissions of path if it exists, or else those
+    of a file created with the current umask.
+    """
+    try:
+        mode = stat.S_IMODE (os.stat (path).st_mode)
+    except OSError:
+        mode = 0o666 & ~_umask
+    os.fchmod (fd, mode)
+
 #-- Checking for program availability --{{{1
 
 checked_progs = {}
@@ -236,6 +256,18 @@ def explode_path (name = "PATH"):
     else:
         return []
 
+def tool_path (env, name):
+    """
+    Return the search path of a tool run after LaTeX: the directories of
+    env.tool_path, then those of the environment variable name.  If the
+    variable is not set, an empty element stands for the default path of
+    kpathsea.
+    """
+    path = explode_path (name)
+    if env.tool_path and not path:
+        path = [""]
+    return env.tool_path + path
+
 def find_resource (name, suffix = "", paths = []):
     """
     find the indicated file, mimicking what latex would do:
@@ -244,16 +276,16 @@ def find_resource (name, suffix = "", paths = []):
     """
     name = name.strip ()
 
-    if os.path.exists (name):
+    if rubber.dircache.exists (name):
         return name
-    elif suffix != "" and os.path.exists (name + suffix):
+    elif suffix != "" and rubber.dircache.exists (name + suffix):
         return name + suffix
 
     for path in paths:
         fullname = os.path.join (path, name)
-        if os.path.exists (fullname):
+        if rubber.dircache.exists (fullname):
             return fullname
-        elif suffix != "" and os.path.exists (fullname + suffix):
+        elif suffix != "" and rubber.dircache.exists (fullname + suffix):
             return fullname + suffix
 
     return None
@@ -296,5 +328,6 @@ def execute (prog, env={}, pwd=None, out=None):
         process.stdout.readlines()
 
     ret = process.wait()
+    rubber.dircache.invalidate ()
     msg.debug(_("process %d (%s) returned %d") % (process.pid, prog[0], ret))
     return ret
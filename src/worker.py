@@ -0,0 +1,184 @@
+# This file is part of Rubber and thus covered by the GPL
+# vim: noet:ts=4
+"""
+Interpreters kept running in the background between runs of Rubber.
+
+Starting R and loading knitr often costs more than knitting the document.
+With the option --daemon, the interpreter is started once as a worker, and
+each run of Rubber sends it a request instead.
+
+The worker reads one request per line on its standard input.  After each
+request, it writes a line starting with 'rubber-worker: ' followed by 0 on
+success, anything else on failure.  Other lines are forwarded to Rubber
+and logged.
+
+The worker is the child of a small server, forked from Rubber, listening
+on a Unix socket named after the document.  A client sends a line
+starting with 'run ' followed by the request, or the line 'quit', and
+reads the output until the status line.  The server handles one client at
+a time, and exits when the worker dies or stays idle for 'idle' seconds.
+"""
+
+import logging
+msg = logging.getLogger (__name__)
+import os
+import socket
+import subprocess
+from rubber.util import _
+
+# Whether the preprocessors should be sent to background workers.
+enabled = False
+
+# The number of seconds a worker waits for the next request.
+idle = 600
+
+marker = 'rubber-worker: '
+
+def socket_path (source):
+    """The path of the socket of the worker for a given source."""
+    directory, name = os.path.split (source)
+    return os.path.join (directory, '.' + name + '.worker')
+
+def _connect (path):
+    client = socket.socket (socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect (path)
+    except OSError:
+        client.close ()
+        raise
+    return client
+
+def _exchange (client, line):
+    """
+    Send a line to the server, log its output and return true if the
+    status is 0, or None if the status line is missing.
+    """
+    with client, client.makefile ('rw', encoding='utf_8',
+                                  errors='replace') as stream:
+        stream.write (line + '\n')
+        stream.flush ()
+        for output in stream:
+            if output.startswith (marker):
+                return output [len (marker):].strip () == '0'
+            msg.info (output.rstrip ('\n'))
+    return None
+
+def request (path, command, line):
+    """
+    Send a request to the worker listening on path, first starting it
+    with command if needed.  Return true on success, false on failure,
+    or None if the worker cannot be used (the caller should then run
+    the preprocessor itself).
+    """
+    if not hasattr (socket, 'AF_UNIX') or not hasattr (os, 'fork') \
+       or '\n' in line:
+        return None
+    try:
+        client = _connect (path)
+    except OSError:
+        client = None
+    if client is None:
+        try:
+            client = _start (path, command)
+        except OSError as e:
+            msg.debug (_("cannot start a worker on %s: %s"), path, e)
+            return None
+    try:
+        result = _exchange (client, 'run ' + line)
+    except OSError as e:
+        msg.debug (_("worker on %s failed: %s"), path, e)
+        return None
+    if result is None:
+        msg.info (_("worker on %s stopped, running %s directly"),
+                  path, command [0])
+    return result
+
+def stop (path):
+    """Stop the worker listening on path, if any."""
+    try:
+        client = _connect (path)
+    except OSError:
+        # Left by a server killed by a signal.
+        if os.path.exists (path):
+            os.remove (path)
+        return
+    msg.info (_("stopping the worker on %s"), path)
+    try:
+        _exchange (client, 'quit')
+    except OSError:
+        pass
+
+def _start (path, command):
+    """
+    Fork a server listening on path and running command, and return a
+    client connected to it.  The socket is bound before forking, so the
+    connection cannot fail because the server is not ready yet.
+    """
+    server = socket.socket (socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        try:
+            server.bind (path)
+        except OSError:
+            # A stale socket, since the connection failed.
+            os.remove (path)
+            server.bind (path)
+        server.listen ()
+        msg.info (_("starting a worker on %s: %s"), path, command [0])
+        pid = os.fork ()
+    except:
+        server.close ()
+        raise
+    if pid == 0:
+        status = 1
+        try:
+            _serve (server, os.path.abspath (path), command)
+            status = 0
+        finally:
+            os._exit (status)
+    server.close ()
+    return _connect (path)
+
+def _serve (server, path, command):
+    os.setsid ()
+    null = os.open (os.devnull, os.O_RDWR)
+    for fd in (0, 1, 2):
+        os.dup2 (null, fd)
+    try:
+        worker = subprocess.Popen (command, stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+            encoding='utf_8', errors='replace')
+    except OSError:
+        os.remove (path)
+        server.close ()
+        return
+    try:
+        server.settimeout (idle)
+        while True:
+            try:
+                client, address = server.accept ()
+            except socket.timeout:
+                break
+            client.settimeout (None)
+            with client, client.makefile ('rw', encoding='utf_8',
+                                          errors='replace') as stream:
+                line = stream.readline ()
+                if not line.startswith ('run '):
+                    os.remove (path)
+                    stream.write (marker + '0\n')
+                    return
+                worker.stdin.write (line [4:])
+                worker.stdin.flush ()
+                for output in worker.stdout:
+                    stream.write (output)
+                    if output.startswith (marker):
+                        break
+                else:
+                    # The worker died, the client sees no status.
+                    break
+                stream.flush ()
+    finally:
+        if os.path.exists (path):
+            os.remove (path)
+        server.close ()
+        worker.stdin.close ()
+        worker.wait ()
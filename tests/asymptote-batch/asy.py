@@ -0,0 +1,99 @@
+# vim: noet:ts=4
+# The changed figures of a document are made by a single asy process.
+import os
+import shutil
+import stat
+import tempfile
+import unittest
+import rubber.converters.latex
+import rubber.depend
+import rubber.dircache
+import rubber.environment
+
+document = r"""\documentclass{minimal}
+\usepackage{asymptote}
+\begin{document}
+\begin{asy}
+  draw ((0,0)--(100,100));
+\end{asy}
+\begin{asy}
+  dot ((0,0));
+\end{asy}
+\end{document}
+"""
+
+# Like the real asy, the stand-in empties the .aux file.
+asy = """#!/bin/sh
+echo "$@" >> runs.log
+for source; do
+	echo figure > "${source%.asy}.eps"
+done
+: > doc.aux
+"""
+
+class TestBatch (unittest.TestCase):
+
+	def setUp (self):
+		self.cwd = os.getcwd ()
+		self.path = os.environ ['PATH']
+		self.tmp = tempfile.mkdtemp ()
+		os.chdir (self.tmp)
+		os.mkdir ('bin')
+		self.write (os.path.join ('bin', 'asy'), asy)
+		os.chmod (os.path.join ('bin', 'asy'), stat.S_IRWXU)
+		os.environ ['PATH'] = os.path.abspath ('bin') + os.pathsep + self.path
+		self.write ('doc.tex', document)
+		env = rubber.environment.Environment ()
+		self.doc = rubber.converters.latex.LaTeXDep (env, 'doc.tex', None)
+		env.final = env.main = self.doc
+		self.doc.parse ()
+		# LaTeX is not run, the tests write the .asy files instead.  The
+		# figures are made while the document is.
+		self.doc.make = lambda: False
+		self.doc.making = True
+		self.write ('doc.aux', '\\relax\n')
+		self.write ('doc-1.asy', 'draw ((0,0)--(100,100));\n')
+		self.write ('doc-2.asy', 'dot ((0,0));\n')
+		self.figures = [rubber.depend._producer [name]
+						for name in ('doc-1.eps', 'doc-2.eps')]
+
+	def tearDown (self):
+		rubber.depend._producer.clear ()
+		os.environ ['PATH'] = self.path
+		os.chdir (self.cwd)
+		shutil.rmtree (self.tmp)
+		rubber.dircache.invalidate ()
+
+	def write (self, path, text):
+		with open (path, 'w') as f:
+			f.write (text)
+		rubber.dircache.invalidate ()
+
+	def make (self):
+		for node in self.figures:
+			node.make ()
+
+	def runs (self):
+		with open ('runs.log') as f:
+			return f.read ().splitlines ()
+
+	def test_single_run (self):
+		self.make ()
+		self.assertEqual (self.runs (), ['doc-1.asy doc-2.asy'])
+		self.assertTrue (os.path.exists ('doc-1.eps'))
+		self.assertTrue (os.path.exists ('doc-2.eps'))
+		with open ('doc.aux') as f:
+			self.assertEqual (f.read (), '\\relax\n')
+
+	def test_changed_only (self):
+		self.make ()
+		self.make ()
+		self.assertEqual (len (self.runs ()), 1)
+		self.write ('doc-2.asy', 'dot ((1,1));\n')
+		self.make ()
+		self.assertEqual (self.runs (), ['doc-1.asy doc-2.asy', 'doc-2.asy'])
+		with open ('doc.aux') as f:
+			self.assertEqual (f.read (), '\\relax\n')
+
+if __name__ == '__main__':
+	unittest.main ()
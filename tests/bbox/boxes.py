@@ -0,0 +1,224 @@
+# vim: noet:ts=4
+import io
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+import zlib
+
+from rubber.converters.bbox import *
+
+def pdf(objects, xref_stream=False, compressed=(), extra=b''):
+	"""
+	Return a PDF file with the given objects, a dictionary mapping their
+	numbers to their text, and object 1 as the catalog.  The objects
+	whose numbers are in compressed are stored in an object stream.
+	"""
+	data = b'%PDF-1.5\n' + extra
+	offsets = {}
+	for num in sorted(objects):
+		if num in compressed:
+			continue
+		offsets[num] = len(data)
+		data += b'%d 0 obj\n%s\nendobj\n' % (num, objects[num])
+	size = max(objects) + 3
+	index = {}
+	if compressed:
+		header = b''
+		body = b''
+		for i, num in enumerate(compressed):
+			header += b'%d %d ' % (num, len(body))
+			body += objects[num] + b'\n'
+			index[num] = i
+		stream = zlib.compress(header + body)
+		offsets[size - 2] = len(data)
+		data += (b'%d 0 obj\n<< /Type /ObjStm /N %d /First %d /Filter /FlateDecode'
+			b' /Length %d >>\nstream\n' % (size - 2, len(compressed),
+			len(header), len(stream))) + stream + b'\nendstream\nendobj\n'
+	start = len(data)
+	if xref_stream:
+		offsets[size - 1] = start
+		rows = b''
+		previous = bytes(5)
+		for num in range(size):
+			if num in index:
+				row = struct.pack('>BHH', 2, size - 2, index[num])
+			elif num in offsets:
+				row = struct.pack('>BHH', 1, offsets[num], 0)
+			else:
+				row = bytes(5)
+			# The Up predictor, as used by most writers.
+			rows += b'\x02' + bytes((a - b) & 0xff for a, b in zip(row, previous))
+			previous = row
+		stream = zlib.compress(rows)
+		data += (b'%d 0 obj\n<< /Type /XRef /Size %d /W [1 2 2] /Root 1 0 R'
+			b' /Filter /FlateDecode /DecodeParms << /Columns 5 /Predictor 12 >>'
+			b' /Length %d >>\nstream\n' % (size - 1, size, len(stream))) \
+			+ stream + b'\nendstream\nendobj\n'
+	else:
+		data += b'xref\n0 %d\n0000000000 65535 f \n' % size
+		for num in range(1, size):
+			if num in offsets:
+				data += b'%010d 00000 n \n' % offsets[num]
+			else:
+				data += b'0000000000 00000 f \n'
+		data += b'trailer\n<< /Size %d /Root 1 0 R >>\n' % size
+	return data + b'startxref\n%d\n%%%%EOF\n' % start
+
+class CountingStream(io.BytesIO):
+
+	def __init__(self, data):
+		super().__init__(data)
+		self.count = 0
+
+	def read(self, size=-1):
+		data = super().read(size)
+		self.count += len(data)
+		return data
+
+# The first page in the page tree is object 5, after object 4 in the file.
+tree = {
+	1: b'<< /Type /Catalog /Pages 2 0 R >>',
+	2: b'<< /Type /Pages /Kids [3 0 R 4 0 R] /Count 2 /MediaBox [0 0 200 100] >>',
+	3: b'<< /Type /Pages /Kids [5 0 R] /Count 1 /Parent 2 0 R >>',
+	4: b'<< /Type /Page /Parent 2 0 R /MediaBox [0 0 9 9] >>',
+	5: b'<< /Type /Page /Parent 3 0 R >>',
+}
+
+class TestPDF(unittest.TestCase):
+
+	def box(self, data):
+		return pdf_bbox(io.BytesIO(data))
+
+	def test_first_page_of_tree(self):
+		self.assertEqual(self.box(pdf(tree)), ((0., 0., 200., 100.), '1.5'))
+
+	def test_crop_box(self):
+		objects = dict(tree)
+		objects[5] = b'<< /Type /Page /Parent 3 0 R /CropBox [10 20 30.5 40] >>'
+		self.assertEqual(self.box(pdf(objects))[0], (10., 20., 30.5, 40.))
+
+	def test_indirect_box(self):
+		objects = dict(tree)
+		objects[5] = b'<< /Type /Page /Parent 3 0 R /MediaBox 6 0 R >>'
+		objects[6] = b'[0 0 7 0 R 50]'
+		objects[7] = b'60'
+		self.assertEqual(self.box(pdf(objects))[0], (0., 0., 60., 50.))
+
+	def test_xref_stream(self):
+		self.assertEqual(self.box(pdf(tree, xref_stream=True))[0],
+			(0., 0., 200., 100.))
+
+	def test_object_stream(self):
+		self.assertEqual(self.box(pdf(tree, xref_stream=True,
+			compressed=(2, 3, 5)))[0], (0., 0., 200., 100.))
+
+	def test_incremental_update(self):
+		data = pdf(tree)
+		start = len(data)
+		data += b'5 0 obj\n<< /Type /Page /Parent 3 0 R /MediaBox [0 0 1 2] >>\nendobj\n'
+		xref = len(data)
+		data += b'xref\n5 1\n%010d 00000 n \ntrailer\n' % start
+		data += b'<< /Size 8 /Root 1 0 R /Prev %d >>\n' % int(
+			data.split(b'startxref\n')[1].split(b'\n')[0])
+		data += b'startxref\n%d\n%%%%EOF\n' % xref
+		self.assertEqual(self.box(data)[0], (0., 0., 1., 2.))
+
+	def test_reads_only_needed_bytes(self):
+		objects = dict(tree)
+		objects[6] = (b'<< /Length %d >>\nstream\n' % 10**6) + bytes(10**6) \
+			+ b'\nendstream'
+		stream = CountingStream(pdf(objects))
+		self.assertEqual(pdf_bbox(stream)[0], (0., 0., 200., 100.))
+		self.assertLess(stream.count, 10**5)
+
+	def test_no_page(self):
+		objects = dict(tree)
+		objects[2] = b'<< /Type /Pages /Kids [] /Count 0 >>'
+		with self.assertRaises(BoundingBoxError):
+			self.box(pdf(objects))
+
+	def test_no_xref(self):
+		with self.assertRaises(BoundingBoxError):
+			self.box(b'%PDF-1.4\n1 0 obj\n<< /MediaBox [0 0 1 1] >>\nendobj\n')
+
+class TestPostScript(unittest.TestCase):
+
+	def box(self, data):
+		return ps_bbox(io.BytesIO(data), len(data))
+
+	def test_header(self):
+		self.assertEqual(self.box(b'%!PS-Adobe-3.0 EPSF-3.0\n'
+			b'%%BoundingBox: 0 0 10 20\n%%HiResBoundingBox: 0 0 9.5 19.5\n'
+			b'%%EndComments\n%%BoundingBox: 1 1 1 1\n'),
+			((0., 0., 10., 20.), (0., 0., 9.5, 19.5)))
+
+	def test_atend(self):
+		self.assertEqual(self.box(b'%!PS-Adobe-3.0 EPSF-3.0\n'
+			b'%%BoundingBox: (atend)\n%%EndComments\nshowpage\n'
+			b'%%Trailer\n%%BoundingBox: 1 2 3 4\n'),
+			((1., 2., 3., 4.), None))
+
+	def test_dos_eps(self):
+		ps = b'%!PS-Adobe-3.0 EPSF-3.0\r%%BoundingBox: 0 0 5 6\r%%EndComments\r'
+		header = b'\xc5\xd0\xd3\xc6' + struct.pack('<II', 32, len(ps)) + bytes(20)
+		self.assertEqual(self.box(header + ps), ((0., 0., 5., 6.), None))
+
+	def test_missing(self):
+		with self.assertRaises(BoundingBoxError):
+			self.box(b'%!PS-Adobe-3.0\n%%EndComments\n')
+
+def chunk(kind, data):
+	return struct.pack('>I', len(data)) + kind + data \
+		+ struct.pack('>I', zlib.crc32(kind + data))
+
+class TestBitmaps(unittest.TestCase):
+
+	def test_png(self):
+		data = b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', struct.pack('>IIBBBBB',
+			300, 150, 8, 2, 0, 0, 0))
+		self.assertEqual(png_bbox(io.BytesIO(data + chunk(b'IEND', b''))),
+			(0., 0., 300., 150.))
+		# 300 dpi.
+		data += chunk(b'pHYs', struct.pack('>IIB', 11811, 11811, 1))
+		box = png_bbox(io.BytesIO(data + chunk(b'IEND', b'')))
+		self.assertAlmostEqual(box[2], 72., places=2)
+		self.assertAlmostEqual(box[3], 36., places=2)
+
+	def test_jpeg(self):
+		jfif = b'JFIF\0\x01\x02' + struct.pack('>BHH', 1, 144, 144) + b'\0\0'
+		sof = struct.pack('>BHHB', 8, 100, 200, 3) + bytes(9)
+		data = b'\xff\xd8' + b'\xff\xe0' + struct.pack('>H', len(jfif) + 2) \
+			+ jfif + b'\xff\xc0' + struct.pack('>H', len(sof) + 2) + sof
+		self.assertEqual(jpeg_bbox(io.BytesIO(data)), (0., 0., 100., 50.))
+
+	def test_jpeg_without_frame(self):
+		with self.assertRaises(BoundingBoxError):
+			jpeg_bbox(io.BytesIO(b'\xff\xd8\xff\xda\0\2'))
+
+class TestFile(unittest.TestCase):
+
+	def setUp(self):
+		self.cwd = os.getcwd()
+		self.dir = tempfile.mkdtemp()
+		os.chdir(self.dir)
+
+	def tearDown(self):
+		os.chdir(self.cwd)
+		shutil.rmtree(self.dir)
+
+	def test_name_outside_latin_1(self):
+		with open('\u56fe.png', 'wb') as f:
+			f.write(b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR',
+				struct.pack('>IIBBBBB', 30, 15, 8, 2, 0, 0, 0))
+				+ chunk(b'IEND', b''))
+		self.assertTrue(Dep('\u56fe.bb', '\u56fe.png').run())
+		with open('\u56fe.bb', 'rb') as f:
+			self.assertEqual(f.read(), b'%%Title: \xe5\x9b\xbe.png\n'
+				b'%%Creator: rubber\n%%BoundingBox: 0 0 30 15\n')
+		# No temporary file is left.
+		self.assertEqual(sorted(os.listdir()), ['\u56fe.bb', '\u56fe.png'])
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,97 @@
+# vim: noet:ts=4
+import os
+import shutil
+import tempfile
+import unittest
+
+import rubber.converters.latex
+import rubber.environment
+
+bcf = '''<?xml version="1.0" encoding="UTF-8"?>
+<bcf:controlfile version="3.7" bltxversion="3.14" xmlns:bcf="https://sourceforge.net/projects/biblatex">
+  <!-- BIBER OPTIONS -->
+  <bcf:options component="biber" type="global">
+    <bcf:option type="singlevalued">
+      <bcf:key>debug</bcf:key>
+      <bcf:value>%(debug)s</bcf:value>
+    </bcf:option>
+    <bcf:option type="singlevalued">
+      <bcf:key>sortcase</bcf:key>
+      <bcf:value>%(sortcase)s</bcf:value>
+    </bcf:option>
+  </bcf:options>
+  %(extra)s
+  <bcf:bibdata section="0">
+    <bcf:datasource type="file" datatype="bibtex" glob="false">biblio.bib</bcf:datasource>
+  </bcf:bibdata>
+  <bcf:section number="0">
+    <bcf:citekey order="1" intorder="1">%(key)s</bcf:citekey>
+  </bcf:section>
+</bcf:controlfile>
+'''
+
+class TestControlFile(unittest.TestCase):
+
+	def setUp(self):
+		self.cwd = os.getcwd()
+		self.dir = tempfile.mkdtemp()
+		os.chdir(self.dir)
+		with open('doc.tex', 'w') as f:
+			f.write('\\documentclass{article}\n\\usepackage{biblatex}\n'
+				+ '\\begin{document}\n\\cite{ref}\n\\end{document}\n')
+		with open('biblio.bib', 'w') as f:
+			f.write('@misc{ref, title={Title}}\n')
+		env = rubber.environment.Environment()
+		doc = rubber.converters.latex.LaTeXDep(env, 'doc.tex', None)
+		env.final = env.main = doc
+		doc.parse()
+		# LaTeX is not run, the tests write the .bcf instead.
+		doc.make = lambda: False
+		self.dep = doc.modules['biblatex'].dep
+		self.runs = 0
+		self.dep.run = self.run_biber
+		self.write()
+		self.dep.make()
+
+	def tearDown(self):
+		os.chdir(self.cwd)
+		shutil.rmtree(self.dir)
+
+	def run_biber(self):
+		self.runs += 1
+		return True
+
+	def write(self, debug='0', sortcase='1', extra='', key='ref'):
+		with open('doc.bcf', 'w') as f:
+			f.write(bcf % {'debug': debug, 'sortcase': sortcase,
+				'extra': extra, 'key': key})
+		rubber.dircache.invalidate()
+
+	def test_first(self):
+		self.assertEqual(self.runs, 1)
+		self.assertEqual(self.dep.sources, ['doc.bcf'])
+
+	def test_cosmetic(self):
+		self.write(debug='1',
+			extra='<!-- A comment -->\n<bcf:unknown>text</bcf:unknown>')
+		self.dep.make()
+		self.assertEqual(self.runs, 1)
+
+	def test_option(self):
+		self.write(sortcase='0')
+		self.dep.make()
+		self.assertEqual(self.runs, 2)
+
+	def test_citation(self):
+		self.write(key='other')
+		self.dep.make()
+		self.assertEqual(self.runs, 2)
+
+	def test_datasource(self):
+		with open('biblio.bib', 'a') as f:
+			f.write('@misc{other, title={Other}}\n')
+		self.dep.make()
+		self.assertEqual(self.runs, 2)
+
+if __name__ == '__main__':
+	unittest.main()
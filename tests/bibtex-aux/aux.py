@@ -0,0 +1,96 @@
+# vim: noet:ts=4
+import os
+import shutil
+import tempfile
+import unittest
+
+import rubber.converters.latex
+import rubber.dircache
+import rubber.environment
+
+aux = '''\\relax
+\\citation{%(key)s}
+\\@input{chap.aux}
+\\newlabel{sec}{{1}{%(page)s}}
+\\bibstyle{%(style)s}
+\\bibdata{biblio}
+\\@writefile{toc}{\\contentsline {section}{Lorem}{%(page)s}}
+'''
+
+class TestAuxFile(unittest.TestCase):
+
+	def setUp(self):
+		self.cwd = os.getcwd()
+		self.dir = tempfile.mkdtemp()
+		os.chdir(self.dir)
+		with open('doc.tex', 'w') as f:
+			f.write('\\documentclass{article}\n\\begin{document}\n'
+				+ '\\cite{ref}\n\\bibliographystyle{plain}\n'
+				+ '\\bibliography{biblio}\n\\end{document}\n')
+		with open('biblio.bib', 'w') as f:
+			f.write('@misc{ref, title={Title}}\n')
+		env = rubber.environment.Environment()
+		doc = rubber.converters.latex.LaTeXDep(env, 'doc.tex', None)
+		env.final = env.main = doc
+		doc.parse()
+		# LaTeX is not run, the tests write the .aux files instead.
+		doc.make = lambda: False
+		self.dep = doc.modules['bibtex'].dep
+		self.runs = 0
+		self.dep.run = self.run_bibtex
+		self.write()
+		self.write_chapter()
+		self.dep.make()
+
+	def tearDown(self):
+		os.chdir(self.cwd)
+		shutil.rmtree(self.dir)
+
+	def run_bibtex(self):
+		self.runs += 1
+		return True
+
+	def write(self, key='ref', page='1', style='plain'):
+		with open('doc.aux', 'w') as f:
+			f.write(aux % {'key': key, 'page': page, 'style': style})
+		rubber.dircache.invalidate()
+
+	def write_chapter(self, key='ref', page='2'):
+		with open('chap.aux', 'w') as f:
+			f.write('\\relax\n\\citation{%s}\n\\newlabel{chap}{{2}{%s}}\n'
+				% (key, page))
+		rubber.dircache.invalidate()
+
+	def test_first(self):
+		self.assertEqual(self.runs, 1)
+
+	def test_labels(self):
+		self.write(page='3')
+		self.write_chapter(page='4')
+		self.dep.make()
+		self.assertEqual(self.runs, 1)
+
+	def test_citation(self):
+		self.write(key='other')
+		self.dep.make()
+		self.assertEqual(self.runs, 2)
+
+	def test_included_citation(self):
+		self.write_chapter(key='other')
+		self.dep.make()
+		self.assertEqual(self.runs, 2)
+
+	def test_style(self):
+		self.write(style='alpha')
+		self.dep.make()
+		self.assertEqual(self.runs, 2)
+
+	def test_database(self):
+		with open('doc.aux', 'a') as f:
+			f.write('\\bibdata{other}\n')
+		rubber.dircache.invalidate()
+		self.dep.make()
+		self.assertEqual(self.runs, 2)
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,96 @@
+# vim: noet:ts=4
+import os
+import re
+import shutil
+import tempfile
+import unittest
+
+import rubber.biblio
+import rubber.converters.latex
+import rubber.environment
+
+database = '''@string{jan = "January"}
+@preamble{"\\newcommand{\\noop}[1]{}"}
+@comment{Entries of the test}
+
+@misc{cited, title={Cited {with} braces}, month=jan}
+
+@book{Collection, title={Collection}}
+
+@incollection(part,
+  title={Part},
+  crossref={collection}
+)
+
+@misc{uncited, title={Uncited}}
+'''
+
+class TestSubset(unittest.TestCase):
+
+	def setUp(self):
+		self.cwd = os.getcwd()
+		self.dir = tempfile.mkdtemp()
+		os.chdir(self.dir)
+		with open('doc.tex', 'w') as f:
+			f.write('% rubber: bibtex.subset 0\n\\documentclass{article}\n'
+				+ '\\begin{document}\n\\cite{cited,PART}\n'
+				+ '\\bibliographystyle{plain}\n\\bibliography{biblio}\n'
+				+ '\\end{document}\n')
+		with open('biblio.bib', 'w') as f:
+			f.write(database)
+		env = rubber.environment.Environment()
+		doc = rubber.converters.latex.LaTeXDep(env, 'doc.tex', None)
+		env.final = env.main = doc
+		doc.parse()
+		self.dep = doc.modules['bibtex'].dep
+
+	def tearDown(self):
+		os.chdir(self.cwd)
+		shutil.rmtree(self.dir)
+
+	def write_aux(self, keys):
+		with open('doc.aux', 'w') as f:
+			f.write('\\relax\n\\citation{%s}\n\\bibstyle{plain}\n'
+				'\\bibdata{biblio}\n' % keys)
+
+	def subset(self):
+		with open(os.path.join('doc-subset', 'biblio.bib')) as f:
+			return f.read()
+
+	def test_cited_and_crossrefs(self):
+		self.write_aux('cited,PART')
+		self.assertTrue(self.dep.write_subsets())
+		data = self.subset()
+		self.assertEqual(re.findall(r'^@[a-z]+[{(]([^,\n]+),', data, re.M),
+			['cited', 'Collection', 'part'])
+		self.assertIn('@string{jan = "January"}', data)
+		self.assertIn('@preamble{', data)
+		self.assertIn('Cited {with} braces', data)
+		self.dep.clean()
+		self.assertFalse(os.path.exists('doc-subset'))
+
+	def test_unchanged(self):
+		self.write_aux('cited')
+		self.dep.write_subsets()
+		os.utime(os.path.join('doc-subset', 'biblio.bib'), (0, 0))
+		self.dep.write_subsets()
+		self.assertEqual(
+			os.path.getmtime(os.path.join('doc-subset', 'biblio.bib')), 0)
+		self.write_aux('cited,uncited')
+		self.dep.write_subsets()
+		self.assertIn('@misc{uncited', self.subset())
+
+	def test_all_entries(self):
+		self.write_aux('*')
+		self.assertFalse(self.dep.write_subsets())
+		self.assertFalse(os.path.exists('doc-subset'))
+
+	def test_index(self):
+		entries, always = rubber.biblio.index_database(database.encode())
+		self.assertEqual(sorted(entries),
+			['cited', 'collection', 'part', 'uncited'])
+		self.assertEqual(entries['part'][2], ['collection'])
+		self.assertEqual(len(always), 2)
+
+if __name__ == '__main__':
+	unittest.main()
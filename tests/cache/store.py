@@ -0,0 +1,148 @@
+# vim: noet:ts=4
+# Tests of the persistent cache which need no TeX installation.
+import os
+import shutil
+import tempfile
+import time
+import unittest
+import rubber.cache
+import rubber.contents
+import rubber.dircache
+
+class TestStore (unittest.TestCase):
+
+	def setUp (self):
+		self.cwd = os.getcwd ()
+		self.tmp = tempfile.mkdtemp ()
+		os.chdir (self.tmp)
+		self.store = rubber.cache.Store (os.path.join (self.tmp, 'store'), 500)
+
+	def tearDown (self):
+		os.chdir (self.cwd)
+		shutil.rmtree (self.tmp)
+		rubber.dircache.invalidate ()
+
+	def write (self, path, text):
+		with open (path, 'w') as f:
+			f.write (text)
+
+	def read (self, path):
+		with open (path) as f:
+			return f.read ()
+
+	def test_key (self):
+		self.assertEqual (rubber.cache.key ('a', (1, b'b')),
+						  rubber.cache.key ('a', (1, b'b')))
+		self.assertNotEqual (rubber.cache.key ('a', 'b'),
+							 rubber.cache.key ('ab'))
+		self.assertNotEqual (rubber.cache.key ('a', 'b'),
+							 rubber.cache.key ('b', 'a'))
+
+	def test_insert_restore (self):
+		self.write ('a.pdf', 'A')
+		self.write ('a.log', 'L')
+		self.store.insert ('k1', ['a.pdf', 'a.log'])
+		os.remove ('a.pdf')
+		self.write ('a.log', 'changed')
+		self.assertEqual (self.store.restore ('k1'), ['a.pdf', 'a.log'])
+		self.assertEqual (self.read ('a.pdf'), 'A')
+		self.assertEqual (self.read ('a.log'), 'L')
+		self.assertIsNone (self.store.restore ('k2'))
+		self.assertEqual ((self.store.hits, self.store.misses), (1, 1))
+
+	def test_restore_without_overwrite (self):
+		self.write ('a.aux', 'old')
+		self.write ('a.toc', 'old')
+		self.store.insert ('k', ['a.aux', 'a.toc'])
+		os.remove ('a.toc')
+		self.write ('a.aux', 'new')
+		self.assertEqual (self.store.restore ('k', overwrite=False), ['a.toc'])
+		self.assertEqual (self.read ('a.aux'), 'new')
+		self.assertEqual (self.read ('a.toc'), 'old')
+
+	def test_insert_keeps_existing_entry (self):
+		self.write ('a.pdf', 'first')
+		self.store.insert ('k', ['a.pdf'])
+		self.write ('a.pdf', 'second')
+		self.store.insert ('k', ['a.pdf'])
+		self.store.restore ('k')
+		self.assertEqual (self.read ('a.pdf'), 'first')
+
+	def test_replace (self):
+		self.write ('a.aux', 'first')
+		self.store.replace ('k', ['a.aux'])
+		self.write ('a.aux', 'second')
+		self.store.replace ('k', ['a.aux'])
+		os.remove ('a.aux')
+		self.store.restore ('k')
+		self.assertEqual (self.read ('a.aux'), 'second')
+
+	def test_trim (self):
+		# Three entries of 400 bytes (and a small manifest) each, in a
+		# store of 500 bytes, the second one used last.
+		now = time.time ()
+		for i, age in enumerate ((30, 10, 20)):
+			self.write ('f', str (i) * 400)
+			self.store.insert ('k%i' % i, ['f'])
+			entry = self.store.entry ('k%i' % i)
+			os.utime (entry, (now - age, now - age))
+		self.store.trim ()
+		self.assertIsNone (self.store.restore ('k0'))
+		self.assertIsNone (self.store.restore ('k2'))
+		self.assertEqual (self.store.restore ('k1'), ['f'])
+		self.assertEqual (self.read ('f'), '1' * 400)
+
+	def test_trim_removes_stale_temporary_directories (self):
+		self.write ('f', 'x')
+		self.store.insert ('k', ['f'])
+		old = os.path.join (self.store.root, 'tmp-old')
+		os.mkdir (old)
+		os.utime (old, (0, 0))
+		self.store.trim ()
+		self.assertFalse (os.path.exists (old))
+
+	def test_cache_size (self):
+		# As with --cache-size, the stores are trimmed when closed.
+		rubber.cache.enable (os.path.join (self.tmp, 'cache'), 500)
+		try:
+			self.write ('f', 'x' * 400)
+			rubber.cache.artifacts.insert ('k0', ['f'])
+			os.utime (rubber.cache.artifacts.entry ('k0'), (0, 0))
+			rubber.cache.artifacts.insert ('k1', ['f'])
+			rubber.cache.close ()
+			self.assertIsNone (rubber.cache.artifacts.restore ('k0'))
+			self.assertIsNotNone (rubber.cache.artifacts.restore ('k1'))
+		finally:
+			rubber.cache.artifacts = rubber.cache.builds = None
+			rubber.cache.seeds = rubber.cache.passes = None
+			rubber.cache._stores.clear ()
+
+	def test_hit_in_another_directory (self):
+		for d in ('one', 'two'):
+			os.mkdir (d)
+			self.write (os.path.join (d, 'doc.tex'), 'same')
+		os.chdir ('one')
+		key = rubber.cache.key ('doc', rubber.contents.snapshot ('doc.tex'))
+		self.write ('doc.pdf', 'PDF')
+		self.store.insert (key, ['doc.pdf'])
+		os.chdir (os.path.join (os.pardir, 'two'))
+		self.assertEqual (key, rubber.cache.key (
+			'doc', rubber.contents.snapshot ('doc.tex')))
+		self.assertEqual (self.store.restore (key), ['doc.pdf'])
+		self.assertEqual (self.read ('doc.pdf'), 'PDF')
+
+	def test_copy_atomically (self):
+		self.write ('source', 'new')
+		self.write ('destination', 'old')
+		os.chmod ('destination', 0o640)
+		rubber.cache.copy_atomically ('source', 'destination')
+		self.assertEqual (self.read ('destination'), 'new')
+		self.assertEqual (os.stat ('destination').st_mode & 0o777, 0o640)
+		self.assertEqual (sorted (os.listdir ()), ['destination', 'source'])
+		umask = os.umask (0o022)
+		os.umask (umask)
+		rubber.cache.copy_atomically ('source', 'created')
+		self.assertEqual (os.stat ('created').st_mode & 0o777, 0o666 & ~umask)
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,265 @@
+# vim: noet:ts=4
+# Tests of the dependency graph which need no TeX installation.
+import gzip
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import unittest
+import rubber.cache
+import rubber.converters.latex
+import rubber.depend
+import rubber.dircache
+
+class Touch (rubber.depend.Node):
+	"""Write the product after waiting for the event 'go', if any."""
+	def __init__ (self, product, sources, go=None):
+		super ().__init__ ()
+		self.add_product (product)
+		for source in sources:
+			self.add_source (source)
+		self.go = go
+		self.runs = 0
+
+	def run (self):
+		self.runs += 1
+		if self.go is not None:
+			self.go.wait (10)
+		with open (self.primary_product (), 'w') as f:
+			f.write ('made\n')
+		return True
+
+class TestDepend (unittest.TestCase):
+
+	def setUp (self):
+		self.cwd = os.getcwd ()
+		self.tmp = tempfile.mkdtemp ()
+		os.chdir (self.tmp)
+		rubber.dircache.invalidate ()
+
+	def tearDown (self):
+		rubber.depend.wait_background ()
+		rubber.depend._started.clear ()
+		rubber.depend._producer.clear ()
+		rubber.depend.background = False
+		rubber.depend.jobs = 1
+		os.chdir (self.cwd)
+		shutil.rmtree (self.tmp)
+		rubber.dircache.invalidate ()
+
+	def write (self, path, text='source\n'):
+		with open (path, 'w') as f:
+			f.write (text)
+		rubber.dircache.invalidate ()
+
+class TestBackground (TestDepend):
+
+	def test_start_on_product_being_made (self):
+		# A graphics conversion is started, then the bounding box of its
+		# product is requested while the conversion runs.
+		rubber.depend.background = True
+		rubber.depend.jobs = 4
+		self.write ('fig.svg')
+		go = threading.Event ()
+		png = Touch ('fig.png', ['fig.svg'], go)
+		rubber.depend.start (png)
+		for i in range (100):
+			if png.making:
+				break
+			time.sleep (0.01)
+		self.assertTrue (png.making)
+		xbb = Touch ('fig.xbb', ['fig.png'])
+		rubber.depend.start (xbb)
+		go.set ()
+		rubber.depend.wait_background ()
+		self.assertTrue (xbb.make ())
+		self.assertTrue (os.path.exists ('fig.xbb'))
+		self.assertEqual (png.runs, 1)
+		self.assertEqual (xbb.runs, 1)
+
+class TestCacheFile (TestDepend):
+
+	def test_mode_of_new_file (self):
+		umask = os.umask (0o022)
+		os.umask (umask)
+		rubber.depend.save_cache ('doc.rubbercache', Touch ('doc.pdf', []))
+		self.assertEqual (os.stat ('doc.rubbercache').st_mode & 0o777,
+						  0o666 & ~umask)
+
+	def test_mode_of_replaced_file (self):
+		self.write ('doc.rubbercache')
+		os.chmod ('doc.rubbercache', 0o640)
+		rubber.depend.save_cache ('doc.rubbercache', Touch ('doc.pdf', []))
+		self.assertEqual (os.stat ('doc.rubbercache').st_mode & 0o777, 0o640)
+
+	def test_saved_once (self):
+		saved = []
+		save_cache = rubber.depend.save_cache
+		def counting (path, final):
+			saved.append (path)
+			save_cache (path, final)
+		rubber.depend.save_cache = counting
+		try:
+			self.write ('fig0')
+			for i in range (1, 6):
+				final = Touch ('fig%i' % i, ['fig%i' % (i - 1)])
+			rubber.depend.save_cache_on_exit ('doc.rubbercache', final)
+			self.assertTrue (final.make ())
+			self.assertEqual (saved, [])
+			rubber.depend.flush_cache ()
+			self.assertEqual (saved, ['doc.rubbercache'])
+			# Nothing was rebuilt since.
+			rubber.depend.flush_cache ()
+			self.assertEqual (saved, ['doc.rubbercache'])
+		finally:
+			rubber.depend.save_cache = save_cache
+			rubber.depend._cache_file = None
+		with open ('doc.rubbercache') as f:
+			self.assertEqual (len ([line for line in f
+									if not line.startswith (' ')]), 5)
+
+# Stand-ins for convert and mogrify.
+convert = 'import shutil, sys; shutil.copyfile (sys.argv [1], sys.argv [2])'
+mogrify = '''import os, shutil, sys
+for source in sys.argv [2:]:
+	shutil.copyfile (source, os.path.splitext (source) [0] + '.' + sys.argv [1])
+'''
+
+# The same stand-ins, logging their arguments, and slow enough for the
+# threads to overlap.
+logged = '''import sys, time
+with open ('commands.log', 'a') as log:
+	log.write (' '.join (sys.argv [1:]) + '\\n')
+time.sleep (0.2)
+'''
+
+class TestBatch (TestDepend):
+
+	def setUp (self):
+		super ().setUp ()
+		rubber.cache.enable (os.path.join (self.tmp, 'cache'), 2**20)
+
+	def tearDown (self):
+		rubber.cache.artifacts = None
+		rubber.cache._stores.clear ()
+		super ().tearDown ()
+
+	def test_artifact_key (self):
+		batch = rubber.depend.Batch (
+			(sys.executable, '-c', mogrify, 'png', None), 50)
+		nodes = []
+		for name in ('a', 'b'):
+			self.write (name + '.gif')
+			node = rubber.depend.Shell ((sys.executable, '-c', convert,
+										 name + '.gif', name + '.png'))
+			node.rule = 'convert'
+			node.add_product (name + '.png')
+			node.add_source (name + '.gif')
+			batch.add (node)
+			nodes.append (node)
+		for node in nodes:
+			self.assertTrue (node.make ())
+		# The products are saved under the command that made them.
+		store = rubber.cache.artifacts
+		for node in nodes:
+			self.assertIsNone (store.restore (node.artifact_key ()))
+			self.assertEqual (store.restore (node.batch_artifact_key ()),
+							  [node.primary_product ()])
+
+	def test_concurrent_members (self):
+		# Each member is started in its own thread.
+		rubber.depend.background = True
+		rubber.depend.jobs = 4
+		batch = rubber.depend.Batch (
+			(sys.executable, '-c', logged + mogrify, 'png', None), 50)
+		nodes = []
+		for name in ('a', 'b', 'c', 'd'):
+			self.write (name + '.gif')
+			node = rubber.depend.Shell ((sys.executable, '-c',
+										 logged + convert,
+										 name + '.gif', name + '.png'))
+			node.add_product (name + '.png')
+			node.add_source (name + '.gif')
+			batch.add (node)
+			nodes.append (node)
+		for node in nodes:
+			rubber.depend.start (node)
+		rubber.depend.wait_background ()
+		for node in nodes:
+			self.assertTrue (node.make ())
+			self.assertTrue (os.path.exists (node.primary_product ()))
+		with open ('commands.log') as f:
+			commands = f.read ().splitlines ()
+		self.assertEqual (len (commands), 1)
+		self.assertEqual (sorted (commands [0].split () [1:]),
+						  ['a.gif', 'b.gif', 'c.gif', 'd.gif'])
+
+# Stand-ins for the stages of a pipeline.
+upper = 'import sys; sys.stdout.write (sys.stdin.read ().upper ())'
+fail = '''import sys
+sys.stdout.write (sys.stdin.read () [:3])
+sys.exit (1)
+'''
+
+class Stream (rubber.depend.Node):
+	"""A node writing its source on the standard output of a pipeline."""
+	def __init__ (self, product, source):
+		super ().__init__ ()
+		self.add_product (product)
+		self.add_source (source)
+
+	def stream_command (self):
+		return (sys.executable, '-c', 'import shutil, sys; shutil.copyfileobj '
+				+ '(open (sys.argv [1]), sys.stdout)', self.sources [0])
+
+class TestPipeline (TestDepend):
+
+	def pipeline (self, *stages, compressor=None):
+		self.write ('doc.dvi', 'dvi\n')
+		return rubber.depend.Pipeline (
+			(Stream ('doc.ps', 'doc.dvi'),) + stages, 'doc.pdf',
+			virtual=('doc.ps',), compressor=compressor)
+
+	def read (self, path):
+		with open (path) as f:
+			return f.read ()
+
+	def test_run (self):
+		node = self.pipeline ((sys.executable, '-c', upper))
+		self.assertEqual (node.sources, ['doc.dvi'])
+		self.assertTrue (node.make ())
+		self.assertEqual (self.read ('doc.pdf'), 'DVI\n')
+		# The virtual product is never written.
+		self.assertFalse (os.path.exists ('doc.ps'))
+		self.assertFalse (node.make ())
+		self.write ('doc.dvi', 'changed\n')
+		self.assertTrue (node.make ())
+		self.assertEqual (self.read ('doc.pdf'), 'CHANGED\n')
+
+	def test_compressor (self):
+		node = self.pipeline ((sys.executable, '-c', upper),
+							  compressor=gzip.GzipFile)
+		self.assertTrue (node.make ())
+		with gzip.open ('doc.pdf', 'rt') as f:
+			self.assertEqual (f.read (), 'DVI\n')
+
+	def test_middle_stage_fails (self):
+		# The last stage writes what the failing one gave it, then the
+		# partial product is removed.
+		node = self.pipeline ((sys.executable, '-c', fail),
+							  (sys.executable, '-c', upper))
+		with self.assertRaises (rubber.depend.MakeError):
+			node.make ()
+		self.assertFalse (os.path.exists ('doc.pdf'))
+		self.assertIsNone (node.snapshots)
+
+	def test_missing_command (self):
+		node = self.pipeline (('rubber-no-such-command',),
+							  (sys.executable, '-c', upper))
+		self.assertFalse (node.run ())
+		self.assertFalse (os.path.exists ('doc.pdf'))
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,65 @@
+# vim: noet:ts=4
+# The index of directories must answer as os.path.exists and isfile.
+import os
+import shutil
+import tempfile
+import unittest
+import rubber.dircache
+
+class TestDircache (unittest.TestCase):
+
+	def setUp (self):
+		self.tmp = tempfile.mkdtemp ()
+		rubber.dircache.invalidate ()
+
+	def tearDown (self):
+		shutil.rmtree (self.tmp)
+		rubber.dircache.invalidate ()
+
+	def path (self, name):
+		return os.path.join (self.tmp, name)
+
+	def write (self, name):
+		with open (self.path (name), 'w') as f:
+			f.write ('x\n')
+
+	def assert_like_os (self, *names):
+		for name in names:
+			path = self.path (name)
+			self.assertEqual (rubber.dircache.exists (path),
+							  os.path.exists (path), name)
+			self.assertEqual (rubber.dircache.isfile (path),
+							  os.path.isfile (path), name)
+
+	def test_symbolic_links (self):
+		self.write ('file')
+		os.mkdir (self.path ('dir'))
+		os.symlink ('file', self.path ('to-file'))
+		os.symlink ('dir', self.path ('to-dir'))
+		os.symlink ('missing', self.path ('broken'))
+		self.assert_like_os ('file', 'dir', 'to-file', 'to-dir', 'broken',
+							 'missing')
+
+	def test_written_after_listing (self):
+		# The directory has just been modified, so its listing is not
+		# trusted, and a file written without invalidating it is found.
+		self.assertFalse (rubber.dircache.exists (self.path ('new')))
+		self.write ('new')
+		self.assertTrue (rubber.dircache.exists (self.path ('new')))
+		self.assertTrue (rubber.dircache.isfile (self.path ('new')))
+
+	def test_invalidate (self):
+		self.write ('old')
+		os.utime (self.tmp, (0, 0))
+		self.assert_like_os ('old', 'new')
+		self.write ('new')
+		os.utime (self.tmp, (1, 1))
+		rubber.dircache.invalidate ()
+		self.assert_like_os ('old', 'new')
+		os.remove (self.path ('old'))
+		os.utime (self.tmp, (2, 2))
+		rubber.dircache.invalidate ()
+		self.assert_like_os ('old', 'new')
+
+if __name__ == '__main__':
+	unittest.main()
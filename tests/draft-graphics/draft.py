@@ -0,0 +1,115 @@
+# vim: noet:ts=4
+import os
+import shutil
+import stat
+import struct
+import tempfile
+import unittest
+import zlib
+
+import rubber.converters.latex
+import rubber.depend
+import rubber.dircache
+import rubber.environment
+
+convert = '''#!/bin/sh
+echo "$@" >> runs.log
+for target; do :; done
+echo reduced > "$target"
+'''
+
+def chunk(kind, data):
+	return struct.pack('>I', len(data)) + kind + data \
+		+ struct.pack('>I', zlib.crc32(kind + data))
+
+def png(width, height):
+	"""Return a PNG image without pixels, at 5669 dots per meter (144 dpi)."""
+	return b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', struct.pack('>IIBBBBB',
+		width, height, 8, 2, 0, 0, 0)) \
+		+ chunk(b'pHYs', struct.pack('>IIB', 5669, 5669, 1)) \
+		+ chunk(b'IEND', b'')
+
+class TestDraft(unittest.TestCase):
+
+	@classmethod
+	def setUpClass(cls):
+		# The path of the programs is remembered by Rubber.
+		cls.path = os.environ['PATH']
+		cls.bin = tempfile.mkdtemp()
+		with open(os.path.join(cls.bin, 'convert'), 'w') as f:
+			f.write(convert)
+		os.chmod(os.path.join(cls.bin, 'convert'), stat.S_IRWXU)
+		os.environ['PATH'] = cls.bin + os.pathsep + cls.path
+
+	@classmethod
+	def tearDownClass(cls):
+		os.environ['PATH'] = cls.path
+		shutil.rmtree(cls.bin)
+
+	def setUp(self):
+		self.cwd = os.getcwd()
+		self.dir = tempfile.mkdtemp()
+		os.chdir(self.dir)
+		with open('doc.tex', 'w') as f:
+			f.write('% rubber: module pdftex\n'
+				+ '\\documentclass{article}\n\\usepackage{graphicx}\n'
+				+ '\\begin{document}\n\\includegraphics{fig}\n'
+				+ '\\includegraphics{small.png}\n\\end{document}\n')
+		with open('fig.png', 'wb') as f:
+			f.write(png(400, 200))
+		with open('small.png', 'wb') as f:
+			f.write(png(50, 20))
+		# The originals are older than any copy.
+		for name in ('fig.png', 'small.png'):
+			os.utime(name, (0, 0))
+		rubber.dircache.invalidate()
+		env = rubber.environment.Environment()
+		env.is_in_unsafe_mode_ = False
+		env.draft_graphics = 100
+		self.doc = rubber.converters.latex.LaTeXDep(env, 'doc.tex', None)
+		env.final = env.main = self.doc
+		self.doc.parse()
+
+	def tearDown(self):
+		rubber.depend._producer.clear()
+		os.chdir(self.cwd)
+		shutil.rmtree(self.dir)
+		rubber.dircache.invalidate()
+
+	def make(self, name):
+		rubber.depend._producer[os.path.join('.rubber-draft', '100', name)].make()
+
+	def assert_original(self, name, data):
+		with open(name, 'rb') as f:
+			self.assertEqual(f.read(), data)
+		self.assertEqual(os.path.getmtime(name), 0)
+
+	def test_proxy_used(self):
+		self.assertIn(os.path.join('.rubber-draft', '100', 'fig.png'),
+			self.doc.sources)
+		self.assertIn(os.path.join('.rubber-draft', '100', 'small.png'),
+			self.doc.sources)
+		# LaTeX finds the copies before the originals.
+		cmd, env = self.doc.command_line()
+		self.assertTrue(env['TEXINPUTS'].startswith('.rubber-draft/100:'))
+
+	def test_reduced(self):
+		self.make('fig.png')
+		with open('runs.log') as f:
+			self.assertEqual(f.read().split(), ['fig.png', '-resize', '100x50!',
+				'-units', 'PixelsPerInch', '-density', '35.998150x35.998150',
+				'.rubber-draft/100/fig.png'])
+		with open(os.path.join('.rubber-draft', '100', 'fig.png')) as f:
+			self.assertEqual(f.read(), 'reduced\n')
+		self.assert_original('fig.png', png(400, 200))
+
+	def test_small(self):
+		# A bitmap within the limit is copied.
+		self.make('small.png')
+		self.assertFalse(os.path.exists('runs.log'))
+		with open(os.path.join('.rubber-draft', '100', 'small.png'), 'rb') as f:
+			self.assertEqual(f.read(), png(50, 20))
+		self.assert_original('small.png', png(50, 20))
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,61 @@
+# vim: noet:ts=4
+import os
+import shutil
+import tempfile
+import unittest
+
+import rubber.converters.latex
+import rubber.environment
+import rubber.latex_modules.gnuplottex
+
+class TestSafeMode(unittest.TestCase):
+
+	def setUp(self):
+		self.cwd = os.getcwd()
+		self.dir = tempfile.mkdtemp()
+		os.chdir(self.dir)
+		with open('doc.tex', 'w') as f:
+			f.write('\\documentclass{article}\n\\usepackage{gnuplottex}\n'
+				+ '\\begin{document}\n\\begin{gnuplot}\nplot x\n'
+				+ '\\end{gnuplot}\n\\end{document}\n')
+		# The script that LaTeX would write, calling the shell.
+		with open('doc-gnuplottex-fig1.gnuplot', 'w') as f:
+			f.write('set terminal png\nset output "fig1.png"\n'
+				+ 's="sys"."tem(\\"touch pwned\\")"; eval s\n')
+
+	def tearDown(self):
+		os.chdir(self.cwd)
+		shutil.rmtree(self.dir)
+
+	def parse(self, unsafe):
+		env = rubber.environment.Environment()
+		env.is_in_unsafe_mode_ = unsafe
+		doc = rubber.converters.latex.LaTeXDep(env, 'doc.tex', None)
+		env.final = env.main = doc
+		doc.parse()
+		return doc
+
+	def test_safe(self):
+		doc = self.parse(False)
+		self.assertTrue(doc.env.doc_requires_shell_)
+		self.assertNotIn('\\PassOptionsToPackage{noshell}{gnuplottex}',
+			doc.cmdline)
+		self.assertEqual(doc.modules['gnuplottex'].scripts, {})
+
+	def test_unsafe(self):
+		doc = self.parse(True)
+		self.assertFalse(doc.env.doc_requires_shell_)
+		self.assertIn('\\PassOptionsToPackage{noshell}{gnuplottex}',
+			doc.cmdline)
+		node = doc.modules['gnuplottex'].scripts['doc-gnuplottex-fig1.gnuplot']
+		self.assertEqual(node.products(), ['fig1.png'])
+
+	def test_script_refused_in_safe_mode(self):
+		doc = self.parse(True)
+		node = doc.modules['gnuplottex'].scripts['doc-gnuplottex-fig1.gnuplot']
+		doc.env.is_in_unsafe_mode_ = False
+		self.assertFalse(node.run())
+		self.assertFalse(os.path.exists('pwned'))
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,74 @@
+# vim: noet:ts=4
+import os
+import shutil
+import tempfile
+import unittest
+
+import rubber.converters.latex
+import rubber.environment
+
+class TestInlineListings(unittest.TestCase):
+
+	def setUp(self):
+		self.cwd = os.getcwd()
+		self.dir = tempfile.mkdtemp()
+		os.chdir(self.dir)
+
+	def tearDown(self):
+		os.chdir(self.cwd)
+		shutil.rmtree(self.dir)
+
+	def parse(self, body, directive=''):
+		with open('doc.tex', 'w') as f:
+			f.write(directive + '\\documentclass{article}\n\\usepackage{minted}\n'
+				+ '\\begin{document}\n' + body + '\\end{document}\n')
+		env = rubber.environment.Environment()
+		doc = rubber.converters.latex.LaTeXDep(env, 'doc.tex', None)
+		env.final = env.main = doc
+		doc.parse()
+		return doc
+
+	def listings(self, body):
+		return [(lexer, code) for loc, lexer, options, code, path
+			in self.parse(body).modules['minted'].listings]
+
+	def test_shell_escape_by_default(self):
+		doc = self.parse('\\mint{python}|a = 1|\n')
+		self.assertNotIn('\\PassOptionsToPackage{frozencache}{minted}',
+			doc.cmdline)
+		self.assertTrue(doc.modules['minted'].pre_compile())
+		self.assertTrue(doc.env.doc_requires_shell_)
+		self.assertFalse(os.path.exists('_minted-doc'))
+
+	def test_highlight_directive(self):
+		doc = self.parse('\\mint{python}|a = 1|\n',
+			'% rubber: minted.highlight\n')
+		self.assertIn('\\PassOptionsToPackage{frozencache}{minted}',
+			doc.cmdline)
+		self.assertFalse(doc.env.doc_requires_shell_)
+
+	def test_mint(self):
+		self.assertEqual(self.listings(
+			'\\mint{python}|a = 1|\n\\mint[linenos]{python}{b = {2}}\n'),
+			[('python', 'a = 1\n'), ('python', 'b = {2}\n')])
+
+	def test_mintinline(self):
+		self.assertEqual(self.listings(
+			'x \\mintinline{python}{c = 3} y \\mintinline{c}!d % 4! z\n'),
+			[('python', 'c = 3\n'), ('c', 'd % 4\n')])
+
+	def test_newmint(self):
+		self.assertEqual(self.listings(
+			'\\newmint{python}{}\n\\newmintinline[pyin]{python}{}\n'
+			+ '\\python|b = 2|\n\\pyin{e = 5} \\python [linenos]{f = 6}\n'
+			+ '\\mintinline{python}{c = 3}\n'),
+			[('python', 'b = 2\n'), ('python', 'e = 5\n'),
+			 ('python', 'f = 6\n'), ('python', 'c = 3\n')])
+
+	def test_unterminated(self):
+		self.assertEqual(self.listings(
+			'\\mint{python}|a = 1\n\\mintinline{python}{c = 3}\n'),
+			[('python', 'c = 3\n')])
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,87 @@
+# vim: noet:ts=4
+import os
+import shutil
+import stat
+import tempfile
+import unittest
+
+import rubber.converters.latex
+import rubber.dircache
+import rubber.environment
+
+# The headers name the input file and line of each block.
+pytxcode = '''=>PYTHONTEX#py#default#default#0#code####doc.tex#%(line)s#
+x = %(value)s
+=>PYTHONTEX#py#default#default#1#i####doc.tex#%(other)s#
+x
+=>PYTHONTEX:SETTINGS#
+version=0.18
+outputdir=pythontex-files-doc
+'''
+
+pythontex = '''#!/bin/sh
+echo "$@" >> runs.log
+mkdir -p pythontex-files-doc
+echo macros > pythontex-files-doc/doc.pytxmcr
+'''
+
+class TestSessions(unittest.TestCase):
+
+	def setUp(self):
+		self.cwd = os.getcwd()
+		self.path = os.environ['PATH']
+		self.dir = tempfile.mkdtemp()
+		os.chdir(self.dir)
+		os.mkdir('bin')
+		with open(os.path.join('bin', 'pythontex'), 'w') as f:
+			f.write(pythontex)
+		os.chmod(os.path.join('bin', 'pythontex'), stat.S_IRWXU)
+		os.environ['PATH'] = os.path.abspath('bin') + os.pathsep + self.path
+		with open('doc.tex', 'w') as f:
+			f.write('\\documentclass{article}\n\\usepackage{pythontex}\n'
+				+ '\\begin{document}\n\\begin{pycode}\nx = 1\n'
+				+ '\\end{pycode}\n\\py{x}\n\\end{document}\n')
+		env = rubber.environment.Environment()
+		env.is_in_unsafe_mode_ = True
+		doc = rubber.converters.latex.LaTeXDep(env, 'doc.tex', None)
+		env.final = env.main = doc
+		doc.parse()
+		# LaTeX is not run, the tests write the .pytxcode instead.
+		doc.make = lambda: False
+		self.dep = doc.modules['pythontex'].dep
+		self.dep.jobs = 2
+		self.write()
+		self.dep.make()
+
+	def tearDown(self):
+		os.environ['PATH'] = self.path
+		os.chdir(self.cwd)
+		shutil.rmtree(self.dir)
+
+	def write(self, value='1', line='4', other='7'):
+		with open('doc.pytxcode', 'w') as f:
+			f.write(pytxcode % {'value': value, 'line': line, 'other': other})
+		rubber.dircache.invalidate()
+
+	def runs(self):
+		with open('runs.log') as f:
+			return f.read().splitlines()
+
+	def test_first(self):
+		self.assertEqual(self.runs(), ['--jobs 2 doc'])
+		with open(os.path.join('pythontex-files-doc', 'rubber-sessions')) as f:
+			self.assertEqual(len(f.readlines()), 3)
+
+	def test_prose(self):
+		# The code blocks moved down, after new paragraphs.
+		self.write(line='10', other='15')
+		self.dep.make()
+		self.assertEqual(len(self.runs()), 1)
+
+	def test_code(self):
+		self.write(value='2')
+		self.dep.make()
+		self.assertEqual(len(self.runs()), 2)
+
+if __name__ == '__main__':
+	unittest.main()
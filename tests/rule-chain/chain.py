@@ -0,0 +1,101 @@
+# vim: noet:ts=4
+# Chains of conversion rules, with the rules of rules.ini.
+import os
+import shutil
+import tempfile
+import unittest
+import rubber.convert
+import rubber.depend
+import rubber.dircache
+import rubber.environment
+
+class TestRuleChain (unittest.TestCase):
+
+	def setUp (self):
+		self.cwd = os.getcwd ()
+		rules = os.path.abspath ('rules.ini')
+		self.tmp = tempfile.mkdtemp ()
+		os.chdir (self.tmp)
+		rubber.dircache.invalidate ()
+		self.env = rubber.environment.Environment ()
+		# Only the rules of the fixture.
+		self.env.converter = rubber.convert.Converter (self.env)
+		self.env.converter.read_ini (rules)
+		with open ('x.a', 'w') as f:
+			f.write ('figure\n')
+		rubber.dircache.invalidate ()
+
+	def tearDown (self):
+		rubber.depend._producer.clear ()
+		os.chdir (self.cwd)
+		shutil.rmtree (self.tmp)
+		rubber.dircache.invalidate ()
+
+	def chain (self, target):
+		rule = self.env.converter.best_rule (target, None, {})
+		names = []
+		while rule is not None:
+			names.append (rule ['name'])
+			rule = rule.get ('previous')
+		return names
+
+	def test_cheapest_chain (self):
+		# a-b then b-c costs 2, less than a-c.
+		self.assertEqual (self.chain ('x.c'), ['b-c', 'a-b'])
+		self.assertEqual (
+			self.env.converter.best_rule ('x.c', None, {}) ['cost'], 2)
+
+	def test_limit (self):
+		self.assertEqual (rubber.convert.max_steps, 3)
+		self.assertEqual (self.chain ('x.d'), ['c-d', 'b-c', 'a-b'])
+		# The chain of four rules of cost 1 is too long.
+		self.assertEqual (self.chain ('x.e'), ['d-e', 'c-d', 'a-c'])
+		self.assertEqual (self.chain ('x.f'), [])
+
+	def test_equal_costs (self):
+		# As for single rules, the first source in alphabetical order.
+		with open ('x.z', 'w') as f:
+			f.write ('figure\n')
+		rubber.dircache.invalidate ()
+		self.assertEqual (self.chain ('x.h'), ['g-h', 'a-g'])
+
+	def test_source_extensions (self):
+		converter = self.env.converter
+		self.assertEqual (converter.source_extensions ('c'),
+						  ({'a', 'b'}, {'pre/'}))
+		self.assertEqual (converter.source_extensions ('f'),
+						  ({'c', 'd', 'e'}, set ()))
+
+	def test_no_source (self):
+		os.mkdir ('sub')
+		with open (os.path.join ('sub', 'x.q'), 'w') as f:
+			f.write ('figure\n')
+		# A listing of a directory just modified is not trusted.
+		os.utime ('sub', (0, 0))
+		rubber.dircache.invalidate ()
+		tried = []
+		def check (instance):
+			tried.append (instance ['source'])
+			return True
+		self.assertIsNone (self.env.converter.best_rule ('sub/x.c', check, {}))
+		self.assertEqual (tried, [])
+		# The names with the prefix of a rule are searched.
+		os.rename (os.path.join ('sub', 'x.q'), 'x.q')
+		rubber.dircache.invalidate ()
+		self.assertEqual (self.chain ('pre/x.c'), ['q-c'])
+
+	def test_apply (self):
+		node = self.env.convert ('x.c', context={})
+		self.assertIsInstance (node, rubber.depend.Node)
+		self.assertEqual (node.sources, ['x.b'])
+		self.assertTrue (node.make ())
+		with open ('x.c') as f:
+			self.assertEqual (f.read (), 'figure\n')
+		# The intermediate file is a product, removed with the others.
+		self.assertTrue (os.path.exists ('x.b'))
+		rubber.depend.clean_all_products ()
+		self.assertFalse (os.path.exists ('x.b'))
+		self.assertFalse (os.path.exists ('x.c'))
+
+if __name__ == '__main__':
+	unittest.main()
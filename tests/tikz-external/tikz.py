@@ -0,0 +1,105 @@
+# vim: noet:ts=4
+import os
+import shutil
+import tempfile
+import unittest
+
+import rubber.converters.latex
+import rubber.depend
+import rubber.dircache
+import rubber.environment
+import rubber.latex_modules.tikz
+
+# A recipe of the makefile, logging its runs.
+makefile = '''ALL_FIGURE_NAMES=$(shell cat doc.figlist)
+allimages: $(ALL_FIGURE_NAMES:%=%.pdf)
+
+doc-figure0.pdf:
+\techo $$PWD >> runs.log; touch doc-figure0.pdf
+'''
+
+class TestExternalize(unittest.TestCase):
+
+	def setUp(self):
+		self.cwd = os.getcwd()
+		self.dir = tempfile.mkdtemp()
+		os.chdir(self.dir)
+		with open('doc.tex', 'w') as f:
+			f.write('% rubber: module pdftex\n\\documentclass{article}\n'
+				+ '\\usepackage{tikz}\n\\usepackage{pgfplots}\n'
+				+ '\\usetikzlibrary{external}\n'
+				+ '\\tikzexternalize[mode=list and make]\n'
+				+ '\\begin{document}\n\\end{document}\n')
+		# The files written by the last compilation.
+		with open('doc.figlist', 'w') as f:
+			f.write('doc-figure0\n')
+		with open('doc.makefile', 'w') as f:
+			f.write(makefile)
+		self.write('doc-figure0.md5', 'digest\n')
+
+	def tearDown(self):
+		rubber.depend._producer.clear()
+		os.chdir(self.cwd)
+		shutil.rmtree(self.dir)
+
+	def write(self, path, text):
+		with open(path, 'w') as f:
+			f.write(text)
+		rubber.dircache.invalidate()
+
+	def parse(self, unsafe):
+		env = rubber.environment.Environment()
+		env.is_in_unsafe_mode_ = unsafe
+		doc = rubber.converters.latex.LaTeXDep(env, 'doc.tex', None)
+		env.final = env.main = doc
+		doc.parse()
+		return doc
+
+	def runs(self):
+		try:
+			with open('runs.log') as f:
+				return len(f.readlines())
+		except OSError:
+			return 0
+
+	def test_single_instance(self):
+		doc = self.parse(False)
+		modules = [name for name in ('tikz', 'pgfplots')
+			if isinstance(doc.modules[name], rubber.latex_modules.tikz.Module)]
+		self.assertEqual(modules, ['tikz'])
+		self.assertEqual(doc.sources.count('doc-figure0.pdf'), 1)
+
+	def test_safe_mode(self):
+		doc = self.parse(False)
+		picture = doc.modules['tikz'].pictures['doc-figure0']
+		self.assertEqual(picture.sources, ['doc-figure0.md5'])
+		self.assertEqual(picture.command[:5], ('pdflatex', '-halt-on-error',
+			'-interaction=batchmode', '-jobname', 'doc-figure0'))
+
+	def test_makefile(self):
+		doc = self.parse(True)
+		# LaTeX is not run, the tests write the digests instead.
+		doc.make = lambda: False
+		picture = doc.modules['tikz'].pictures['doc-figure0']
+		self.assertEqual(picture.command[:2], ('sh', '-c'))
+		self.assertTrue(picture.make())
+		self.assertEqual(self.runs(), 1)
+		self.assertTrue(os.path.exists('doc-figure0.pdf'))
+		# Only a new digest compiles the picture again.
+		self.assertFalse(picture.make())
+		self.assertEqual(self.runs(), 1)
+		self.write('doc-figure0.md5', 'other\n')
+		self.assertTrue(picture.make())
+		self.assertEqual(self.runs(), 2)
+
+	def test_new_picture(self):
+		doc = self.parse(False)
+		with open('doc.figlist', 'a') as f:
+			f.write('doc-figure1\n')
+		doc.modules['tikz'].post_compile()
+		self.assertEqual(sorted(doc.modules['tikz'].pictures),
+			['doc-figure0', 'doc-figure1'])
+		self.assertIn('doc-figure1.pdf', doc.sources)
+
+if __name__ == '__main__':
+	unittest.main()